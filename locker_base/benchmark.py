@@ -0,0 +1,76 @@
+"""
+Compares the latency of taking an image for a scan: opening the camera for every scan (Imagetaker.capture_once(), what the base used to do)
+against taking the latest frame from the capture service, which keeps the camera open.
+
+    python benchmark.py                                # replays a synthetic frame, no camera needed
+    python benchmark.py --source samples/ --open-delay 0.5
+    python benchmark.py --backend picamera             # on the base itself
+"""
+import argparse
+import os
+import statistics
+import tempfile
+from time import perf_counter, sleep
+import cv2
+import numpy as np
+from utils.capture import PiCameraBackend, ReplayBackend
+from utils.imagetaker import Imagetaker
+
+
+def make_backend(args, per_scan: bool):
+    if args.backend == "picamera":
+        # the old path captured from the still port without waiting for the sensor to settle.
+        return PiCameraBackend(use_video_port=False, warmup=0) if per_scan else PiCameraBackend()
+    return ReplayBackend(args.source, fps=args.fps, open_delay=args.open_delay)
+
+
+def summarize(label: str, latencies: list) -> str:
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return f"{label:<12}{statistics.mean(latencies) * 1000:>10.1f}{q[49] * 1000:>10.1f}{q[98] * 1000:>10.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=("replay", "picamera"), default="replay")
+    parser.add_argument("--source", help="Image, directory of images or video to replay. A synthetic frame if left out.")
+    parser.add_argument("--fps", type=float, default=30, help="Frame rate of the replay.")
+    parser.add_argument("--open-delay", type=float, default=0.0, help="Seconds the replay takes to open, like the warm-up of a sensor.")
+    parser.add_argument("--scans", type=int, default=30)
+    parser.add_argument("--interval", type=float, default=0.2, help="Seconds between scans.")
+    parser.add_argument("--process", action="store_true", help="Include Imagetaker.process_image() in every scan.")
+    args = parser.parse_args()
+
+    if args.backend == "replay" and not args.source:
+        args.source = os.path.join(tempfile.mkdtemp(), "frame.png")
+        cv2.imwrite(args.source, np.random.default_rng(0).integers(0, 256, (Imagetaker.HEIGHT_PX, Imagetaker.WIDTH_PX, 3), dtype=np.uint8))
+
+    per_scan = []
+    for i in range(args.scans):
+        started = perf_counter()
+        img = Imagetaker.capture_once(make_backend(args, per_scan=True))
+        if args.process:
+            Imagetaker.process_image(img)
+        per_scan.append(perf_counter() - started)
+        sleep(args.interval)
+
+    service = Imagetaker.start_capture(make_backend(args, per_scan=False))
+    latest = []
+    try:
+        for i in range(args.scans):
+            started = perf_counter()
+            with service.frame() as frame:
+                if args.process:
+                    Imagetaker.process_image(frame)
+            latest.append(perf_counter() - started)
+            sleep(args.interval)
+    finally:
+        Imagetaker.stop_capture()
+
+    print(f"{args.scans} scans of {Imagetaker.WIDTH_PX}x{Imagetaker.HEIGHT_PX} from {args.backend}" + (", processed" if args.process else ""))
+    print(f"{'path':<12}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    print(summarize("per scan", per_scan))
+    print(summarize("service", latest))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Compares the ways of finding and measuring the fiducial and the parcel on the scanning platform.
+
+Contours: Dimtaker.find_fiducial_and_parcel(), which measures the boxes of just the fiducial and the parcel in arrays,
+against making a PartialObject out of every contour found, what take_dimension_scale() used to do.
+Edges: Dimtaker.detect_edges_pyramid(), which picks the two out of a downscaled image and traces them at full resolution,
+against Dimtaker.detect_edges() on the full image. Reports how far the measurements of the two are apart for every frame.
+
+The frames are of a made-up platform with a parcel turned a little and specks around it, like dust and noise, unless a directory of recorded (processed) frames is given.
+
+    python benchmark_dimensions.py
+    python benchmark_dimensions.py --source samples/ --runs 5
+"""
+import argparse
+import os
+import statistics
+from time import perf_counter
+import cv2
+import numpy as np
+from utils.capture import ReplayBackend
+from utils.dimtaker import Dimtaker, PartialObject
+
+FRAME_SIZE = (2041, 1405)  # of a processed frame, see Imagetaker.PROCESS_CROP_COORDINATES
+
+
+def platform(specks: int, seed: int = 0) -> np.ndarray:
+    """A processed frame of the platform, with the fiducial in the top left corner, a parcel turned a little and specks scattered around."""
+    rng = np.random.default_rng(seed)
+    frame = np.full((FRAME_SIZE[1], FRAME_SIZE[0], 3), 200, dtype=np.uint8)
+    cv2.rectangle(frame, (40, 40), (140, 140), (30, 30, 30), -1)
+    size = (int(rng.integers(300, 1000)), int(rng.integers(300, 700)))
+    parcel = cv2.boxPoints(((1100, 750), size, float(rng.uniform(-30, 30)))).astype(np.int32)
+    cv2.fillPoly(frame, [parcel], (120, 90, 60))
+    for x, y, r in zip(rng.integers(200, FRAME_SIZE[0] - 10, specks), rng.integers(200, FRAME_SIZE[1] - 10, specks), rng.integers(2, 6, specks)):
+        cv2.circle(frame, (int(x), int(y)), int(r), (80, 80, 80), -1)
+    return frame
+
+
+def per_contour(cnts: list):
+    po_list = [PartialObject(c) for c in cnts]
+    fiducial = po_list.pop(0)
+    parcel = sorted(po_list, key=lambda po: po.contour_area, reverse=True)[0]
+    return fiducial, parcel
+
+
+def timed(function, *args):
+    started = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - started
+
+
+def summarize(label: str, latencies: list) -> str:
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return f"{label:<12}{statistics.mean(latencies) * 1000:>10.2f}{q[49] * 1000:>10.2f}{q[98] * 1000:>10.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="Directory of recorded processed frames. Made-up frames if left out.")
+    parser.add_argument("--frames", type=int, default=10, help="Number of made-up frames.")
+    parser.add_argument("--specks", type=int, default=400, help="Number of specks on every made-up frame.")
+    parser.add_argument("--runs", type=int, default=3, help="Runs of every frame.")
+    args = parser.parse_args()
+
+    if args.source:
+        names = [f for f in sorted(os.listdir(args.source)) if f.lower().endswith(ReplayBackend.IMAGE_EXTENSIONS)]
+        frames = [(name, cv2.imread(os.path.join(args.source, name))) for name in names]
+    else:
+        frames = [(f"platform {i}", platform(args.specks, seed=i)) for i in range(args.frames)]
+
+    latencies = {"per contour": [], "batched": [], "full": [], "pyramid": []}
+    print(f"{'frame':<16}{'contours':>10}{'fiducial px':>16}{'(pyramid)':>16}{'parcel px':>16}{'(pyramid)':>16}{'off px':>8}{'off %':>8}")
+    for name, frame in frames:
+        for i in range(args.runs):
+            cnts, latency = timed(Dimtaker.detect_edges, frame)
+            latencies["full"].append(latency)
+            pyramid_cnts, latency = timed(Dimtaker.detect_edges_pyramid, frame)
+            latencies["pyramid"].append(latency)
+            _, latency = timed(per_contour, cnts)
+            latencies["per contour"].append(latency)
+            measured, latency = timed(Dimtaker.find_fiducial_and_parcel, cnts)
+            latencies["batched"].append(latency)
+        pyramid = Dimtaker.find_fiducial_and_parcel(pyramid_cnts)
+        full = [(po.pixel_length, po.pixel_width) for po in measured]
+        refined = [(po.pixel_length, po.pixel_width) for po in pyramid]
+        off = max(abs(a - b) for f, r in zip(full, refined) for a, b in zip(f, r))
+        # how far the length and width of the parcel in fiducials are off, what its dimensions in mm are worked out from.
+        off_ratio = max(abs((refined[1][k] / refined[0][k]) / (full[1][k] / full[0][k]) - 1) for k in (0, 1))
+        print(
+            f"{name[:15]:<16}{len(cnts):>10}{'%.1f x %.1f' % full[0]:>16}{'%.1f x %.1f' % refined[0]:>16}"
+            f"{'%.1f x %.1f' % full[1]:>16}{'%.1f x %.1f' % refined[1]:>16}{off:>8.1f}{off_ratio * 100:>8.2f}"
+        )
+
+    print(f"{len(frames)} frames x {args.runs} runs")
+    print(f"{'path':<12}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for label, values in latencies.items():
+        print(summarize(label, values))
+
+
+if __name__ == "__main__":
+    main()
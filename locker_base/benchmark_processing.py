@@ -0,0 +1,82 @@
+"""
+Compares Imagetaker.process_image() against the original pipeline through PIL, process_image_pil(), on a frame of the size the camera captures.
+Reports the time each takes and how much memory it takes at its peak, and how far their outputs are apart.
+The peak is how far the resident set size of this process rises above where it was, which Linux keeps track of in /proc/self/status.
+
+    python benchmark_processing.py
+    python benchmark_processing.py --source samples/from_camera.jpg --runs 50
+"""
+import argparse
+import ctypes
+import statistics
+from time import perf_counter
+import cv2
+import numpy as np
+from utils.imagetaker import Imagetaker
+
+PIPELINES = {
+    "pil": Imagetaker.process_image_pil,
+    "opencv": Imagetaker.process_image,
+}
+
+
+def unpool_large_allocations():
+    """
+    Has glibc map every large allocation on its own and unmap it once freed. Otherwise it keeps freed frames around for later allocations,
+    which then don't add to the resident set size.
+    """
+    M_MMAP_THRESHOLD = -3
+    ctypes.CDLL("libc.so.6").mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+
+
+def memory_status(field: str) -> int:
+    """A field of /proc/self/status, in KiB."""
+    with open("/proc/self/status") as f:
+        return int(next(line for line in f if line.startswith(field)).split()[1])
+
+
+def peak_memory(name: str, frame: np.ndarray) -> int:
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")  # resets the peak resident set size to the current one
+    before = memory_status("VmRSS")
+    PIPELINES[name](frame)
+    return memory_status("VmHWM") - before
+
+
+def measure(name: str, frame: np.ndarray, runs: int) -> str:
+    peak = peak_memory(name, frame)
+
+    times = []
+    for i in range(runs):
+        started = perf_counter()
+        PIPELINES[name](frame)
+        times.append(perf_counter() - started)
+    q = statistics.quantiles(times, n=100) if len(times) > 1 else times * 99
+    return f"{name:<8}{statistics.mean(times) * 1000:>10.1f}{q[49] * 1000:>10.1f}{q[98] * 1000:>10.1f}{peak / 1024:>10.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="Image to process. A synthetic frame if left out.")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    unpool_large_allocations()
+
+    if args.source:
+        frame = cv2.resize(cv2.imread(args.source), (Imagetaker.WIDTH_PX, Imagetaker.HEIGHT_PX))
+    else:
+        # smoothed noise, so that sharpening has edges to work on.
+        frame = cv2.GaussianBlur(np.random.default_rng(0).integers(0, 256, (Imagetaker.HEIGHT_PX, Imagetaker.WIDTH_PX, 3), dtype=np.uint8), (7, 7), 0)
+    Imagetaker.process_image(frame)  # loads what OpenCV loads lazily before anything is measured
+
+    print(f"{args.runs} runs on a {Imagetaker.WIDTH_PX}x{Imagetaker.HEIGHT_PX} frame")
+    print(f"{'pipeline':<8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'peak MiB':>10}")
+    for name in PIPELINES:
+        print(measure(name, frame, args.runs))
+
+    difference = np.abs(Imagetaker.process_image(frame).astype(np.int16) - Imagetaker.process_image_pil(frame))
+    print(f"difference: max {difference.max()}, max inside the border {difference[1:-1, 1:-1].max()}, mean {difference.mean():.3f}")
+
+
+if __name__ == "__main__":
+    main()
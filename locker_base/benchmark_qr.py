@@ -0,0 +1,92 @@
+"""
+Compares reading QR codes with QREngine (what QRtaker.take_qr() does) against making a QRCodeDetector and running detectAndDecode() on the full image for every scan,
+what take_qr() used to do. Reports how many codes each reads and how long it takes, and the confidence of the engine.
+The images are labels of a made-up code of different sizes, rotations and tilts on a processed frame, unless a directory of recorded images is given,
+for which the number of codes read is reported without knowing what they should say.
+
+    python benchmark_qr.py
+    python benchmark_qr.py --source samples/
+"""
+import argparse
+import os
+import statistics
+from time import perf_counter
+import cv2
+import numpy as np
+from utils.capture import ReplayBackend
+from utils.qrtaker import QREngine
+
+DATA = "withdraw_1234_5_4f2a9c1e7b3d8a6f0e5c2b1a"
+SIZES = (120, 160, 240, 320, 480)  # px, the side of the code without its quiet zone
+ANGLES = (0, 20, 45)
+TILTS = (0, 0.1, 0.2)  # of the width, that the top corners are drawn in by for perspective
+FRAME_SIZE = (2041, 1405)  # of a processed frame, see Imagetaker.PROCESS_CROP_COORDINATES
+
+
+def label(size: int, angle: float, tilt: float, seed: int) -> np.ndarray:
+    """A frame with a label printed with DATA on it somewhere, slightly blurred and noisy like a photo."""
+    rng = np.random.default_rng(seed)
+    code = cv2.resize(cv2.QRCodeEncoder.create().encode(DATA), (size, size), interpolation=cv2.INTER_NEAREST)
+    code = cv2.copyMakeBorder(code, size // 8, size // 8, size // 8, size // 8, cv2.BORDER_CONSTANT, value=255)
+    n = int(code.shape[0] * (abs(np.cos(np.radians(angle))) + abs(np.sin(np.radians(angle))))) + 2
+    m = cv2.getRotationMatrix2D((code.shape[1] / 2, code.shape[0] / 2), angle, 1)
+    m[:, 2] += (n - code.shape[0]) / 2
+    code = cv2.warpAffine(code, m, (n, n), borderValue=180)
+    src = np.float32([[0, 0], [n, 0], [n, n], [0, n]])
+    dst = np.float32([[tilt * n, 0], [n - tilt * n, 0], [n, n], [0, n]])
+    code = cv2.warpPerspective(code, cv2.getPerspectiveTransform(src, dst), (n, n), borderValue=180)
+    frame = np.full(FRAME_SIZE[::-1], 180, dtype=np.uint8)
+    x, y = rng.integers(0, FRAME_SIZE[0] - n), rng.integers(0, FRAME_SIZE[1] - n)
+    frame[y:y + n, x:x + n] = code
+    frame = cv2.GaussianBlur(frame, (3, 3), 0) + rng.normal(0, 6, frame.shape)
+    return cv2.cvtColor(np.clip(frame, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+
+
+def per_scan(img: np.ndarray):
+    data, bbox, _ = cv2.QRCodeDetector().detectAndDecode(img)
+    return data or None
+
+
+def summarize(name: str, results: list, expected) -> str:
+    latencies = [latency for data, latency in results]
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    read = sum(1 for data, latency in results if data)
+    wrong = sum(1 for data, latency in results if data and expected and data != expected)
+    return f"{name:<10}{read:>8}{wrong:>8}{statistics.mean(latencies) * 1000:>10.1f}{q[49] * 1000:>10.1f}{q[98] * 1000:>10.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="Directory of recorded images to read. Made-up labels if left out.")
+    args = parser.parse_args()
+
+    if args.source:
+        images = [cv2.imread(os.path.join(args.source, f)) for f in sorted(os.listdir(args.source)) if f.lower().endswith(ReplayBackend.IMAGE_EXTENSIONS)]
+        expected = None
+    else:
+        images = [label(size, angle, tilt, seed=i) for i, (size, angle, tilt) in enumerate((s, a, t) for s in SIZES for a in ANGLES for t in TILTS)]
+        expected = DATA
+
+    old = []
+    for img in images:
+        started = perf_counter()
+        data = per_scan(img)
+        old.append((data, perf_counter() - started))
+    engine, new, confidences, stages = QREngine(), [], [], {}
+    for img in images:
+        result = engine.read(img)
+        new.append((result.data, result.latency))
+        if result.data:
+            confidences.append(result.confidence)
+            stages[result.stage] = stages.get(result.stage, 0) + 1
+
+    print(f"{len(images)} images" + ("" if args.source else f", codes of {SIZES} px at {ANGLES} degrees and tilts of {TILTS}"))
+    print(f"{'reader':<10}{'read':>8}{'wrong':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    print(summarize("per scan", old, expected))
+    print(summarize("engine", new, expected))
+    if confidences:
+        print(f"engine read {', '.join(f'{count} at {stage}' for stage, count in stages.items())}, mean confidence {statistics.mean(confidences):.2f}")
+
+
+if __name__ == "__main__":
+    main()
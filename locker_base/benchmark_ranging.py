@@ -0,0 +1,82 @@
+"""
+Compares the ways of timing the echo of the height sensor on a simulated sensor: polling the echo pin (what Dimtaker.take_distance() does),
+edge interrupts through RPi.GPIO, and the edge timestamps of pigpio. Reports how far the readings are off and spread out, and the CPU time each reading costs.
+--load runs threads that keep the interpreter busy, like the capture and scanning work of the base does.
+
+    python benchmark_ranging.py
+    python benchmark_ranging.py --load 2 --readings 300
+"""
+import argparse
+import statistics
+import threading
+from time import monotonic, process_time, sleep, thread_time
+from utils.dimtaker import Dimtaker
+from utils.ranging import EdgeEchoTimer, PigpioEchoTimer, PollingEchoTimer, RangingService
+from utils.simgpio import SimulatedGPIO, SimulatedPi
+
+TIMERS = {
+    "poll": lambda gpio: PollingEchoTimer(),
+    "edges": lambda gpio: EdgeEchoTimer(),
+    "pigpio": lambda gpio: PigpioEchoTimer(SimulatedPi(gpio)),
+}
+
+
+def busy(stop: threading.Event, cpu: list):
+    while not stop.is_set():
+        sum(range(1000))
+    cpu.append(thread_time())
+
+
+def run(args, name: str) -> str:
+    gpio = SimulatedGPIO(Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, distance=args.distance)
+    service = RangingService(gpio, Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, timer=TIMERS[name](gpio), interval=args.interval)
+    service.open()
+    stop, load_cpu = threading.Event(), []
+    load = [threading.Thread(target=busy, args=(stop, load_cpu), daemon=True) for i in range(args.load)]
+    for thread in load:
+        thread.start()
+
+    readings = []
+    started, cpu_started = monotonic(), process_time()
+    next_at = started
+    for i in range(args.readings):
+        readings.append(service.measure())
+        next_at = max(next_at + args.interval, monotonic())
+        sleep(max(next_at - monotonic(), 0))
+    elapsed, cpu = monotonic() - started, process_time() - cpu_started
+
+    stop.set()
+    for thread in load:
+        thread.join()
+    service.close()
+    # the CPU time of the load threads isn't the timer's. the simulated sensor runs in this process too, and costs little.
+    cpu -= sum(load_cpu)
+
+    errors = [r - args.distance for r in readings if r is not None]
+    missed = len(readings) - len(errors)
+    if not errors:
+        return f"{name:<8}{missed:>8}"
+    p99 = statistics.quantiles([abs(e) for e in errors], n=100)[98] if len(errors) > 1 else abs(errors[0])
+    return (
+        f"{name:<8}{missed:>8}{statistics.mean(errors):>10.2f}{statistics.pstdev(errors):>10.2f}{p99:>10.2f}"
+        f"{cpu / len(readings) * 1000:>12.3f}{cpu / elapsed * 100:>8.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timer", choices=TIMERS, action="append", help="Timer to run, all of them if left out. Can be given more than once.")
+    parser.add_argument("--distance", type=float, default=300, help="Distance of the simulated sensor in mm.")
+    parser.add_argument("--readings", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=RangingService.INTERVAL, help="Seconds between readings.")
+    parser.add_argument("--load", type=int, default=0, help="Number of threads keeping the interpreter busy.")
+    args = parser.parse_args()
+
+    print(f"{args.readings} readings at {args.distance} mm, every {args.interval * 1000:.0f} ms, {args.load} busy threads")
+    print(f"{'timer':<8}{'missed':>8}{'mean mm':>10}{'sd mm':>10}{'p99 mm':>10}{'cpu ms/rd':>12}{'cpu %':>8}")
+    for name in args.timer or TIMERS:
+        print(run(args, name))
+
+
+if __name__ == "__main__":
+    main()
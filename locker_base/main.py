@@ -1,12 +1,16 @@
-from time import sleep
+from time import sleep, time
 from utils.qrtaker import QRtaker
 from utils.imagetaker import Imagetaker
 from utils.dimtaker import Dimtaker
+from utils.ranging import RangingService
 from utils.jsonIO import jsonIO
+from utils.retrieval import Retrieval
 from utils.construct import construct_handler
 import requests
 import logging
 import json
+import queue
+import threading
 import paho.mqtt.client as mqtt
 
 
@@ -53,6 +57,8 @@ class LockerBase:
         DEPOSIT = "deposit"  # note: these needs complete param
         WITHDRAW = "withdraw"  # note: these needs complete param
         CHANGE_V_CODE = "change"
+        AVAILABILITY = "units/availability"
+        ALLOCATE = "allocate"
 
     class UnitCommand:
         QUERY_BASE = "locker_unit/query"
@@ -69,6 +75,7 @@ class LockerBase:
         self.id = self.CONFIG["id"]
         self.verification_code = self.CONFIG["verification_code"]
         self.webserver_address = self.CONFIG["webserver_address"]
+        self.retrieval_keys = self.CONFIG.get("retrieval_keys", [])  # current key first, see utils/retrieval.py
 
         self.locker_units = []
 
@@ -87,15 +94,21 @@ class LockerBase:
 
         self.session = requests.Session()
 
+        # reports that don't need an answer are sent from a thread of their own, in order, so that units don't wait on the webserver.
+        self.notifications = queue.Queue()
+        threading.Thread(target=self.notification_worker, daemon=True).start()
+
         self.mqtt_client = self.init_mqtt()
         self.mqtt_client.connect(self.CONFIG["mqtt"]["host"])
         self.mqtt_client.loop_start()
 
     def export_config(self):
         return {
+            **self.CONFIG,
             "id": self.id,
             "verification_code": self.verification_code,
-            "webserver_address": self.webserver_address
+            "webserver_address": self.webserver_address,
+            "retrieval_keys": self.retrieval_keys
         }
 
     def save_config(self):
@@ -115,12 +128,12 @@ class LockerBase:
             self.logger.info(f"Broadcasting command {command} to all locker units in the vicinity.")
             self.mqtt_client.publish(topic=f"{command}", payload=None, qos=0)
 
-    def contact_webserver(self, *, activity_type: str, params: dict = {}):
+    def contact_webserver(self, *, activity_type: str, params: dict = {}, session: requests.Session = None):
         """Responsible for contacting the webserver. The activity type is based on the inner class ActivityType."""
         url = f"{self.webserver_address}/api/locker/{self.id}/{activity_type}/"
         params = {"verification_code": self.verification_code, **params}  # v code is needed for every request sent to the webserver.
         self.logger.info(f"Contacting webserver at endpoint /{activity_type}. Data: {json.dumps(params)}")
-        with self.session.post(url, data=params) as page:
+        with (session or self.session).post(url, data=params) as page:
             if page.status_code == 200:
                 self.logger.info(f"Webserver returned status code {page.status_code}.")
                 return page.json()
@@ -128,6 +141,86 @@ class LockerBase:
                 self.logger.error(f"Webserver returned status code {page.status_code}.")
                 return None
 
+    def notify_webserver(self, *, activity_type: str, params: dict = {}):
+        """Queues a report for the webserver and returns immediately. See notification_worker()."""
+        self.notifications.put((activity_type, params))
+
+    def notification_worker(self):
+        """Sends the queued reports one at a time, retrying while the webserver can't be reached."""
+        session = requests.Session()  # the session of the main thread isn't shared across threads.
+        while True:
+            activity_type, params = self.notifications.get()
+            backoff = 1
+            while True:
+                try:
+                    if self.contact_webserver(activity_type=activity_type, params=params, session=session) is None:
+                        self.logger.error(f"Webserver rejected queued report to /{activity_type}, dropping it.")
+                    break
+                except requests.RequestException as e:
+                    self.logger.error(f"Could not reach webserver, retrying in {backoff} seconds. {e}")
+                    sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+
+    def update_retrieval_keys(self, resp: dict):
+        """Stores the retrieval keys handed out by the webserver when they have changed."""
+        if resp and resp.get("retrieval_keys") and resp["retrieval_keys"] != self.retrieval_keys:
+            self.retrieval_keys = resp["retrieval_keys"]
+            self.logger.info("Received new retrieval keys.")
+            self.save_config()
+
+    def change_verification_code(self):
+        """Asks the webserver for a new verification code. The retrieval keys are rotated along with it."""
+        resp = self.contact_webserver(activity_type=LockerBase.ActivityType.CHANGE_V_CODE)
+        if resp and resp["success"]:
+            self.verification_code = resp["verification_code"]
+            self.update_retrieval_keys(resp)
+            self.save_config()
+
+    def allocate_unit(self, tracking_number: str, dims: dict):
+        """
+        Asks the webserver for the best fitting free locker unit, see LockerBase.allocate() of the webserver.
+        Falls back to the first unit that fits when the webserver can't be reached, going by availability refreshed from the webserver if it answers that.
+        """
+        try:
+            resp = self.contact_webserver(activity_type=LockerBase.ActivityType.ALLOCATE, params={"tracking_number": tracking_number, **dims})
+        except requests.RequestException as e:
+            self.logger.error(f"Could not reach webserver for allocation, falling back to first fit. {e}")
+            try:
+                self.sync_unit_availability()
+            except requests.RequestException as e:
+                self.logger.warning(f"Could not refresh the availability of the locker units, going by the last known availability. {e}")
+            return self.first_fit_unit(dims)
+        if resp and resp["success"]:
+            match_units = [locker_unit for locker_unit in self.locker_units if locker_unit.id == resp["unit_id"]]
+            if match_units:
+                self.logger.info(f"Webserver allocated locker unit {resp['unit_id']}.")
+                return match_units[0]
+            self.logger.error(f"Webserver allocated locker unit {resp['unit_id']}, which isn't in range.")
+        return None
+
+    def first_fit_unit(self, dims: dict):
+        """Picks the first available locker unit the parcel fits in, going by the last known availability."""
+        available_lockers = [locker_unit for locker_unit in self.locker_units if locker_unit.is_available]
+        self.logger.info(f"Found {len(available_lockers)} available locker units.")
+        for locker_unit in available_lockers:
+            # do a test fit to see if parcel fits into the unit
+            self.logger.info(f"Testing locker unit {locker_unit.id}.")
+            if Dimtaker.test_fit(dims, locker_unit.dimensions()) is True:
+                # approve on the first successful attempt
+                self.logger.info(f"Found suitable locker unit {locker_unit.id}.")
+                return locker_unit
+        return None
+
+    def sync_unit_availability(self):
+        """Refreshes the availability of every registered locker unit with a single request to the webserver."""
+        if not self.locker_units:
+            return
+        resp = self.contact_webserver(activity_type=LockerBase.ActivityType.AVAILABILITY, params={"unit_id": [locker_unit.id for locker_unit in self.locker_units]})
+        if resp and resp["success"]:
+            availability = {unit["id"]: unit["is_available"] for unit in resp["units"]}
+            for locker_unit in self.locker_units:
+                locker_unit.is_available = availability.get(locker_unit.id, locker_unit.is_available)
+
     def init_mqtt(self):
         """This function is called during the initialization of the LockerBase object to set up the MQTT listener."""
 
@@ -168,6 +261,14 @@ class LockerBase:
 base = LockerBase(jsonIO.load("config/config.json"))
 base.logger.info("Finished reading configuration file.")
 
+# keep the height sensor ranging, so that the distance can be read without measuring from scratch
+base.logger.info("Starting height sensor.")
+try:
+    Dimtaker.start_ranging()
+    base.logger.info("Starting height sensor complete.")
+except Exception as e:
+    base.logger.error(f"Could not start the height sensor, measuring from scratch for every reading instead. {e}")
+
 # calibrate height sensor and full distance
 base.logger.info("Calibrating height sensor.")
 try:
@@ -176,104 +277,123 @@ try:
 except Exception as e:
     base.logger.error(e)
 
-# reports to webserver about online status
-base.contact_webserver(activity_type=LockerBase.ActivityType.ONLINE)
+# keep the camera open and capturing, so that a scan doesn't wait for it to start up
+base.logger.info("Starting camera.")
+try:
+    Imagetaker.start_capture()
+    base.logger.info("Starting camera complete.")
+except Exception as e:
+    base.logger.error(f"Could not start the camera, opening it for every scan instead. {e}")
+
+# reports to webserver about online status, receives the keys to verify retrieval codes with
+base.update_retrieval_keys(base.contact_webserver(activity_type=LockerBase.ActivityType.ONLINE))
 # queries for available locker units
 base.send_mqtt_command(command=LockerBase.UnitCommand.QUERY_REGISTER)
 
 
 while True:
 
-    base.logger.info("Starting new scanning process.")
-    dist = Dimtaker.take_distance()
-    base.logger.info(f"Got distance: {dist:.4f}.")
+    # the estimate of the ranging service is read right away, so wait here until something is on the platform.
+    dist = Dimtaker.take_distance(fresh=False)
     # process starts when closest object is 85% of the full distance
-    if dist < Dimtaker.DISTANCE_FULL*0.85:
-        base.logger.info("Approved, starting image taking process.")
-        img = Imagetaker.take_image(process=True, save=True)
-        base.logger.info("Taken and processed, taking QR info.")
-        data = QRtaker.take_qr(img)
-        if data:
-            base.logger.info(f"Got QR info of {data}, contacting webserver for info.")
-            if data.startswith("withdraw_"):
-                # if starts with "withdraw_" = is a generated withdraw qr code
+    if dist is None or dist >= Dimtaker.DISTANCE_FULL*0.85:
+        sleep(RangingService.INTERVAL)
+        continue
+    base.logger.info(f"Got distance: {dist:.4f}, starting new scanning process.")
+    img = Imagetaker.take_image(process=True, save=True)
+    base.logger.info("Taken and processed, taking QR info.")
+    data = QRtaker.take_qr(img)
+    if data:
+        base.logger.info(f"Got QR info of {data}, contacting webserver for info.")
+        if data.startswith("withdraw_"):
+            # if starts with "withdraw_" = is a generated withdraw qr code
+            scanned_at = time()
+            unit_id = None
+            if base.retrieval_keys:
+                # the code is signed, check it here and tell the webserver afterwards.
+                verified = Retrieval.verify(data, base.retrieval_keys)
+                if verified:
+                    parcel_id, unit_id = verified
+                    base.notify_webserver(activity_type=LockerBase.ActivityType.SCANQRRECIPIENT, params={"qr_data": data, "scanned_at": scanned_at})
+            else:
+                # no keys yet, have the webserver check the code.
                 resp = base.contact_webserver(activity_type=LockerBase.ActivityType.SCANQRRECIPIENT, params={"qr_data": data})
-                if resp:
+                if resp and resp["success"]:
                     unit_id = resp["unit_id"]
-                    # find matching units connected to base
-                    match_units = list(filter(lambda unit: unit.id == unit_id, base.locker_units))
-                    if match_units:
-                        match_unit = match_units[0]
-                        base.logger.info(f"Found matching locker unit {repr(match_unit)}.")
-                        base.send_mqtt_command(locker_unit=match_unit, command=LockerBase.UnitCommand.QUERY_UNLOCK)
-                        base.contact_webserver(
-                            activity_type=LockerBase.ActivityType.WITHDRAW,
-                            params={
-                                "qr_data": data,
-                                "unit_id": match_unit.id,
-                                "complete": False
-                            }
-                        )
-                        # ideally, listen for command from button. listener requires a separate thread (probably) and can't be fit on this main process at the moment. future improvements.
-                        sleep(15)
-                        base.send_mqtt_command(locker_unit=match_unit, command=LockerBase.UnitCommand.QUERY_LOCK)
-                        base.contact_webserver(
-                            activity_type=LockerBase.ActivityType.WITHDRAW,
-                            params={
-                                "qr_data": data,
-                                "unit_id": match_unit.id,
-                                "complete": True
-                            }
-                        )
-                        match_unit.is_available = True
-                        base.logger.info("Withdraw complete.")
-                    else:
-                        base.logger.error("No matching locker units found!")
+            if unit_id:
+                # find matching units connected to base
+                match_units = list(filter(lambda unit: unit.id == unit_id, base.locker_units))
+                if match_units:
+                    match_unit = match_units[0]
+                    base.logger.info(f"Found matching locker unit {repr(match_unit)}.")
+                    base.send_mqtt_command(locker_unit=match_unit, command=LockerBase.UnitCommand.QUERY_UNLOCK)
+                    base.notify_webserver(
+                        activity_type=LockerBase.ActivityType.WITHDRAW,
+                        params={
+                            "qr_data": data,
+                            "unit_id": match_unit.id,
+                            "complete": False,
+                            "scanned_at": scanned_at
+                        }
+                    )
+                    # ideally, listen for command from button. listener requires a separate thread (probably) and can't be fit on this main process at the moment. future improvements.
+                    sleep(15)
+                    base.send_mqtt_command(locker_unit=match_unit, command=LockerBase.UnitCommand.QUERY_LOCK)
+                    base.notify_webserver(
+                        activity_type=LockerBase.ActivityType.WITHDRAW,
+                        params={
+                            "qr_data": data,
+                            "unit_id": match_unit.id,
+                            "complete": True,
+                            "scanned_at": scanned_at
+                        }
+                    )
+                    match_unit.is_available = True
+                    base.logger.info("Withdraw complete.")
+                else:
+                    base.logger.error("No matching locker units found!")
 
-            else:
-                # if not start with "withdraw_" = probably a parcel qr
-                resp = base.contact_webserver(activity_type=LockerBase.ActivityType.SCANQRPARCEL, params={"tracking_number": data})
-                if resp:
-                    # measure dimension
+        else:
+            # if not start with "withdraw_" = probably a parcel qr
+            resp = base.contact_webserver(activity_type=LockerBase.ActivityType.SCANQRPARCEL, params={"tracking_number": data})
+            dims = None
+            if resp:
+                # measure dimension
+                try:
                     dims = Dimtaker.take_dimension_scale(img, full_distance=Dimtaker.DISTANCE_FULL, draw=True)
-                    base.logger.info(f"Obtained dimensions of parcel: {json.dumps(dims)}")
-                    # report to webserver
-                    base.contact_webserver(activity_type=LockerBase.ActivityType.SCANDIM, params={"tracking_number": data})
-                    # find an empty unit
-                    available_lockers = [locker_unit for locker_unit in base.locker_units if locker_unit.is_available]
-                    base.logger.info(f"Found {len(available_lockers)} available locker units.")
-                    for locker_unit in available_lockers:
-                        # do a test fit to see if parcel fits into the unit
-                        base.logger.info(f"Testing locker unit {locker_unit.id}.")
-                        if Dimtaker.test_fit(dims, locker_unit.dimensions()) is True:
-                            # approve on the first successful attempt
-                            approved_unit = locker_unit
-                            base.logger.info(f"Found suitable locker unit {approved_unit.id}.")
-                            break
-                    if approved_unit:
-                        base.send_mqtt_command(locker_unit=approved_unit, command=LockerBase.UnitCommand.QUERY_UNLOCK)
-                        base.contact_webserver(
-                            activity_type=LockerBase.ActivityType.DEPOSIT,
-                            params={
-                                "tracking_number": data,
-                                "unit_id": approved_unit.id,
-                                "complete": False
-                            }
-                        )
-                        # ideally, listen for command from button. listener requires a separate thread (probably) and can't be fit on this main process at the moment. future improvements.
-                        sleep(15)
-                        base.send_mqtt_command(locker_unit=approved_unit, command=LockerBase.UnitCommand.QUERY_LOCK)
-                        base.contact_webserver(
-                            activity_type=LockerBase.ActivityType.DEPOSIT,
-                            params={
-                                "tracking_number": data,
-                                "unit_id": approved_unit.id,
-                                "complete": True
-                            }
-                        )
-                        base.logger.info("Deposit complete.")
-                    else:
-                        base.logger.error("No available locker units found!")
+                except TimeoutError as e:
+                    base.logger.error(f"Could not measure the height of the parcel, it has to be scanned again. {e}")
+            if dims:
+                base.logger.info(f"Obtained dimensions of parcel: {json.dumps(dims)}")
+                # report to webserver
+                base.contact_webserver(activity_type=LockerBase.ActivityType.SCANDIM, params={"tracking_number": data})
+                # find an empty unit, the webserver picks the best fitting one
+                approved_unit = base.allocate_unit(data, dims)
+                if approved_unit:
+                    base.send_mqtt_command(locker_unit=approved_unit, command=LockerBase.UnitCommand.QUERY_UNLOCK)
+                    base.contact_webserver(
+                        activity_type=LockerBase.ActivityType.DEPOSIT,
+                        params={
+                            "tracking_number": data,
+                            "unit_id": approved_unit.id,
+                            "complete": False
+                        }
+                    )
+                    # ideally, listen for command from button. listener requires a separate thread (probably) and can't be fit on this main process at the moment. future improvements.
+                    sleep(15)
+                    base.send_mqtt_command(locker_unit=approved_unit, command=LockerBase.UnitCommand.QUERY_LOCK)
+                    base.contact_webserver(
+                        activity_type=LockerBase.ActivityType.DEPOSIT,
+                        params={
+                            "tracking_number": data,
+                            "unit_id": approved_unit.id,
+                            "complete": True
+                        }
+                    )
+                    approved_unit.is_available = False
+                    base.logger.info("Deposit complete.")
+                else:
+                    base.logger.error("No available locker units found!")
 
     base.logger.info("Process complete, resetting.")
     sleep(2)
@@ -1,15 +1,25 @@
+import os
+import sys
+import tempfile
 import unittest
+from unittest import mock
+import cv2
+import numpy as np
 
-from utils.dimtaker import Dimtaker
+from utils.capture import CaptureService, ReplayBackend
+from utils.dimtaker import Dimtaker, PartialObject
 from utils.imagetaker import Imagetaker
-from utils.qrtaker import QRtaker
+from utils.qrtaker import QREngine, QRResult, QRtaker
+from utils.retrieval import Retrieval
+from utils.ranging import EdgeEchoTimer, PigpioEchoTimer, PollingEchoTimer, RangingService
+from utils.simgpio import SimulatedGPIO, SimulatedPi
 
 
 class LockerBaseTestCase(unittest.TestCase):
     def test_qr(self):
         img = Imagetaker.take_image(process=True, save=True)
         data = QRtaker.take_qr(img)
-        self.assertEqual(data, "")
+        self.assertIsNone(data)
 
     def test_dim(self):
         Dimtaker.DISTANCE_FULL = 279
@@ -27,5 +37,283 @@ class LockerBaseTestCase(unittest.TestCase):
         self.assertIsNotNone(distance_full)
 
 
+class CaptureServiceTestCase(unittest.TestCase):
+    """Runs the capture service on replayed frames, no camera needed."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        # frames of a single shade each, so that a frame can be told apart by any of its pixels.
+        for shade in range(4):
+            cv2.imwrite(os.path.join(self.directory.name, f"{shade}.png"), np.full((48, 64, 3), shade * 50, dtype=np.uint8))
+        self.service = CaptureService(ReplayBackend(self.directory.name, fps=200), width=64, height=48, ring_size=3).start()
+
+    def tearDown(self):
+        self.service.stop()
+        Imagetaker.stop_capture()
+        self.directory.cleanup()
+
+    def test_frames_are_views_of_the_ring(self):
+        with self.service.frame() as frame:
+            self.assertEqual(frame.shape, (48, 64, 3))
+            self.assertFalse(frame.flags.writeable)
+            self.assertTrue(any(np.shares_memory(frame, buffer) for buffer in self.service.buffers))
+            self.assertEqual(len(np.unique(frame)), 1)
+
+    def test_frame_in_use_is_not_overwritten(self):
+        with self.service.frame() as frame:
+            shade = frame[0, 0, 0]
+            count = self.service.frame_count
+            with self.service.frame() as newer:
+                pass
+            self.assertGreater(self.service.frame_count, count)
+            self.assertTrue((frame == shade).all())
+
+    def test_fresh_frame_was_captured_after_the_call(self):
+        with self.service.frame() as frame:
+            count = self.service.frame_count
+        with self.service.frame(fresh=True) as frame:
+            self.assertGreater(self.service.frame_count, count)
+
+    def test_take_image_uses_the_service(self):
+        backend = ReplayBackend(os.path.join(self.directory.name, "1.png"), fps=200)
+        Imagetaker.start_capture(backend)
+        img = Imagetaker.take_image()
+        self.assertEqual(img.shape, (Imagetaker.HEIGHT_PX, Imagetaker.WIDTH_PX, 3))
+        self.assertTrue(img.flags.writeable)
+        self.assertTrue((img == 50).all())
+
+
+class ProcessImageTestCase(unittest.TestCase):
+    def setUp(self):
+        # smoothed noise, so that sharpening has edges to work on.
+        frame = np.random.default_rng(0).integers(0, 256, (Imagetaker.HEIGHT_PX, Imagetaker.WIDTH_PX, 3), dtype=np.uint8)
+        self.frame = cv2.GaussianBlur(frame, (7, 7), 0)
+        self.frame.flags.writeable = False  # like a frame of the capture service
+
+    def test_matches_pil_pipeline(self):
+        img = Imagetaker.process_image(self.frame)
+        expected = Imagetaker.process_image_pil(self.frame)
+        self.assertEqual(img.shape, expected.shape)
+        difference = np.abs(img.astype(np.int16) - expected)
+        # PIL leaves the border out of its smoothing and truncates where OpenCV rounds.
+        self.assertLessEqual(difference[1:-1, 1:-1].max(), 2)
+        self.assertLess(difference.mean(), 1)
+
+    def test_writes_into_out(self):
+        crop, flip = Imagetaker.rotated_crop(self.frame)
+        out = np.empty(crop.shape, dtype=np.uint8)
+        self.assertIs(Imagetaker.process_image(self.frame, out=out), out)
+        self.assertTrue(np.shares_memory(crop, self.frame))
+
+
+class ContourMeasurementTestCase(unittest.TestCase):
+    def setUp(self):
+        # the fiducial, a parcel turned a little and specks that add contours.
+        frame = np.full((1405, 2041, 3), 200, dtype=np.uint8)
+        cv2.rectangle(frame, (40, 40), (140, 140), (30, 30, 30), -1)
+        cv2.fillPoly(frame, [cv2.boxPoints(((1000, 700), (900, 600), 12)).astype(np.int32)], (120, 90, 60))
+        rng = np.random.default_rng(0)
+        for x, y in zip(rng.integers(200, 2030, 100), rng.integers(200, 1395, 100)):
+            cv2.circle(frame, (int(x), int(y)), 3, (80, 80, 80), -1)
+        self.frame = frame
+        self.cnts = Dimtaker.detect_edges(frame)
+
+    def test_areas_match_opencv(self):
+        self.assertTrue(np.allclose(Dimtaker.contour_areas(self.cnts), [cv2.contourArea(c) for c in self.cnts]))
+
+    def test_batched_match_per_contour(self):
+        for po, expected in zip(PartialObject.from_contours(self.cnts), [PartialObject(c) for c in self.cnts]):
+            self.assertTrue(np.array_equal(po.box, expected.box))
+            self.assertEqual(po.pixel_length, expected.pixel_length)
+            self.assertEqual(po.pixel_width, expected.pixel_width)
+
+    def test_finds_fiducial_and_parcel(self):
+        fiducial, parcel = Dimtaker.find_fiducial_and_parcel(self.cnts)
+        self.assertAlmostEqual(fiducial.pixel_length, 103, delta=2)
+        self.assertAlmostEqual(fiducial.actual_width, Dimtaker.REFERENCE_WIDTH)
+        self.assertAlmostEqual(max(parcel.pixel_length, parcel.pixel_width), 900, delta=20)
+
+    def test_pyramid_matches_full_resolution(self):
+        cnts = Dimtaker.detect_edges_pyramid(self.frame)
+        self.assertEqual(len(cnts), 2)
+        for po, expected in zip(Dimtaker.find_fiducial_and_parcel(cnts), Dimtaker.find_fiducial_and_parcel(self.cnts)):
+            self.assertAlmostEqual(po.pixel_length, expected.pixel_length, delta=1)
+            self.assertAlmostEqual(po.pixel_width, expected.pixel_width, delta=1)
+
+
+class QREngineTestCase(unittest.TestCase):
+    DATA = "withdraw_1234_5_4f2a9c1e7b3d8a6f0e5c2b1a"
+
+    def label(self, size: int, x: int, y: int) -> np.ndarray:
+        """A processed frame with a code of DATA size px wide at x, y."""
+        code = cv2.resize(cv2.QRCodeEncoder.create().encode(QREngineTestCase.DATA), (size, size), interpolation=cv2.INTER_NEAREST)
+        frame = np.full((1405, 2041), 180, dtype=np.uint8)
+        frame[y - size // 8:y + size + size // 8, x - size // 8:x + size + size // 8] = 255
+        frame[y:y + size, x:x + size] = code
+        return cv2.cvtColor(cv2.GaussianBlur(frame, (3, 3), 0), cv2.COLOR_GRAY2BGR)
+
+    def test_reads_large_code_downscaled(self):
+        result = QREngine().read(self.label(480, 900, 400))
+        self.assertEqual(result.data, QREngineTestCase.DATA)
+        self.assertEqual(result.stage, "0.25")
+        self.assertGreater(result.confidence, 0.9)
+        # the corners are of the full image, not of the region the code was decoded from.
+        self.assertTrue((result.points.min(axis=0) >= (900, 400)).all() and (result.points.max(axis=0) <= (900 + 480, 400 + 480)).all())
+
+    def test_reads_small_code(self):
+        self.assertEqual(QREngine().read(self.label(200, 300, 1000)).data, QREngineTestCase.DATA)
+
+    def test_no_code(self):
+        frame = np.full((1405, 2041, 3), 180, dtype=np.uint8)
+        result = QREngine().read(frame)
+        self.assertIsNone(result.data)
+        self.assertEqual(result.confidence, 0)
+        self.assertIsNone(QRtaker.take_qr(frame))
+
+    def test_confidence_drops_with_tilt(self):
+        self.assertAlmostEqual(QRResult.squareness(np.array([[0, 0], [10, 0], [10, 10], [0, 10]])), 1)
+        self.assertLess(QRResult.squareness(np.array([[3, 0], [7, 0], [10, 10], [0, 10]])), 0.5)
+
+
+class RetrievalTestCase(unittest.TestCase):
+    KEY, OLD_KEY = "k" * 64, "o" * 64
+    NOW = 1700000000
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.used_path, Retrieval.USED_PATH = Retrieval.USED_PATH, os.path.join(self.directory.name, "used_retrievals.json")
+        Retrieval.used = None
+
+    def tearDown(self):
+        Retrieval.USED_PATH = self.used_path
+        Retrieval.used = None
+        self.directory.cleanup()
+
+    def code(self, parcel_id: int = 1, unit_id: int = 2, expiry: int = NOW + 600, key: str = KEY) -> str:
+        return f"withdraw_{parcel_id}_{unit_id}_{expiry}_{Retrieval.sign(key, parcel_id, unit_id, expiry)}"
+
+    def test_valid_code(self):
+        self.assertEqual(Retrieval.verify(self.code(), [self.KEY], now=self.NOW), (1, 2))
+
+    def test_expired_code(self):
+        self.assertIsNone(Retrieval.verify(self.code(expiry=self.NOW - 1), [self.KEY], now=self.NOW))
+
+    def test_bad_signature(self):
+        code = self.code()
+        self.assertIsNone(Retrieval.verify(code[:-1] + ("0" if code[-1] != "0" else "1"), [self.KEY], now=self.NOW))
+        self.assertIsNone(Retrieval.verify(self.code(key="x" * 64), [self.KEY], now=self.NOW))
+        self.assertIsNone(Retrieval.verify("withdraw_1_2", [self.KEY], now=self.NOW))
+
+    def test_key_from_before_rotation(self):
+        # the webserver keeps the key from before the last rotation, see LockerBase.retrieval_keys() of the webserver.
+        self.assertEqual(Retrieval.verify(self.code(key=self.OLD_KEY), [self.KEY, self.OLD_KEY], now=self.NOW), (1, 2))
+        self.assertIsNone(Retrieval.verify(self.code(parcel_id=3, key=self.OLD_KEY), [self.KEY], now=self.NOW))
+
+    def test_second_code_of_a_used_parcel(self):
+        self.assertEqual(Retrieval.verify(self.code(), [self.KEY], now=self.NOW), (1, 2))
+        # a code the recipient had made before, or after, with an expiry and signature of its own.
+        self.assertIsNone(Retrieval.verify(self.code(expiry=self.NOW + 900), [self.KEY], now=self.NOW + 10))
+        Retrieval.used = None  # the base restarts
+        self.assertIsNone(Retrieval.verify(self.code(expiry=self.NOW + 300), [self.KEY], now=self.NOW + 20))
+        # another parcel put into the unit since opens it.
+        self.assertEqual(Retrieval.verify(self.code(parcel_id=4), [self.KEY], now=self.NOW + 30), (4, 2))
+        # and the parcel is let go once no code made before it was withdrawn can still be valid.
+        later = self.NOW + Retrieval.CODE_TTL + 1
+        self.assertEqual(Retrieval.verify(self.code(expiry=later + 600), [self.KEY], now=later), (1, 2))
+
+
+class RangingServiceTestCase(unittest.TestCase):
+    """Runs the ranging service on a simulated height sensor, no Pi needed. The timestamps of pigpio don't depend on how busy the machine running the tests is."""
+
+    def setUp(self):
+        self.gpio = SimulatedGPIO(Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, distance=300, noise=0.5, outlier=0.1)
+        timer = PigpioEchoTimer(SimulatedPi(self.gpio))
+        self.service = RangingService(self.gpio, Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, timer=timer, interval=0.005).start()
+
+    def tearDown(self):
+        self.service.stop()
+        Dimtaker.stop_ranging()
+
+    def test_estimate_leaves_out_outliers(self):
+        self.service.wait_for_stable()
+        self.assertAlmostEqual(self.service.distance(), 300, delta=5)
+
+    def test_stable_readings_are_taken_after_the_call(self):
+        self.assertAlmostEqual(self.service.wait_for_stable(), 300, delta=5)
+        self.gpio.distance = 200
+        self.assertAlmostEqual(self.service.wait_for_stable(), 200, delta=5)
+
+    def test_no_echo_times_out(self):
+        self.gpio.dropout = 1
+        with self.assertRaises(TimeoutError):
+            self.service.wait_for_stable(timeout=0.2)
+
+    def test_gpio_is_set_up_once(self):
+        self.service.wait_for_stable()
+        self.assertEqual(self.gpio.mode, SimulatedGPIO.BCM)
+        # cleanup() would have reset the count of triggers.
+        self.assertGreaterEqual(self.gpio.trigger_count, self.service.sequence)
+
+    def test_timers_agree(self):
+        for make_timer in (lambda gpio: PollingEchoTimer(), lambda gpio: EdgeEchoTimer(), lambda gpio: PigpioEchoTimer(SimulatedPi(gpio))):
+            gpio = SimulatedGPIO(Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, distance=300, noise=0.5)
+            timer = make_timer(gpio)
+            with self.subTest(timer=type(timer).__name__):
+                service = RangingService(gpio, Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, timer=timer, interval=0.005).start()
+                try:
+                    # polling and callbacks are late by however long they were kept from running.
+                    self.assertAlmostEqual(service.wait_for_stable(tolerance=20, timeout=5), 300, delta=20)
+                finally:
+                    service.stop()
+
+    def test_edge_timer_times_out(self):
+        gpio = SimulatedGPIO(Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, dropout=1)
+        timer = EdgeEchoTimer()
+        timer.open(gpio, Dimtaker.DISTANCE_ECHO_PIN)
+        timer.arm()
+        gpio.output(Dimtaker.DISTANCE_TRIG_PIN, True)
+        gpio.output(Dimtaker.DISTANCE_TRIG_PIN, False)
+        self.assertIsNone(timer.wait(RangingService.ECHO_TIMEOUT))
+        timer.close()
+
+    def test_edge_timer_ignores_stale_falling_edge(self):
+        gpio = SimulatedGPIO(Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, dropout=1)
+        timer = EdgeEchoTimer()
+        timer.open(gpio, Dimtaker.DISTANCE_ECHO_PIN)
+        timer.arm()
+        # the falling edge of an echo that came back after its trigger timed out, called back once the pin is low again.
+        timer.edge(Dimtaker.DISTANCE_ECHO_PIN)
+        self.assertIsNone(timer.rise)
+        timer.close()
+
+    def test_default_timer_without_pigpio(self):
+        with mock.patch.dict(sys.modules, {"pigpio": None}):
+            self.assertIsInstance(RangingService.default_timer(), PollingEchoTimer)
+
+    def test_pigpio_ticks_wrap_around(self):
+        self.assertAlmostEqual(PigpioEchoTimer().duration(0xFFFFFFF0, 0x10), 0.000032)
+
+    def test_take_distance_uses_the_service(self):
+        gpio = SimulatedGPIO(Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, distance=250)
+        Dimtaker.start_ranging(gpio, PigpioEchoTimer(SimulatedPi(gpio)))
+        self.assertAlmostEqual(Dimtaker.take_distance(), 250, delta=5)
+        self.assertAlmostEqual(Dimtaker.take_distance(fresh=False), 250, delta=5)
+
+    def test_take_distance_falls_back_to_the_estimate(self):
+        gpio = SimulatedGPIO(Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, distance=250, noise=30)
+        Dimtaker.start_ranging(gpio, PigpioEchoTimer(SimulatedPi(gpio)))
+        attempts, Dimtaker.DISTANCE_ATTEMPTS = Dimtaker.DISTANCE_ATTEMPTS, 1
+        try:
+            # readings this noisy never settle within 5 mm of each other.
+            self.assertAlmostEqual(Dimtaker.take_distance(), 250, delta=30)
+            Dimtaker.stop_ranging()
+            gpio = SimulatedGPIO(Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, dropout=1)
+            Dimtaker.start_ranging(gpio, PigpioEchoTimer(SimulatedPi(gpio)))
+            with self.assertRaises(TimeoutError):
+                Dimtaker.take_distance()
+        finally:
+            Dimtaker.DISTANCE_ATTEMPTS = attempts
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,195 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from time import monotonic, sleep
+import cv2
+import numpy as np
+from utils.construct import construct_logger
+
+capture_logger = construct_logger(file_path="logs/capture.log")
+console_log_handler = logging.StreamHandler()
+console_log_handler.setLevel(logging.INFO)
+console_log_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+capture_logger.addHandler(console_log_handler)
+
+
+class PiCameraBackend:
+    """The camera module of the Raspberry Pi. picamera is only imported when the camera is opened, so the rest of the base can run on other machines."""
+
+    def __init__(self, use_video_port: bool = True, warmup: float = 2):
+        # the video port skips the mode switch of a still capture, at the cost of some denoising.
+        self.use_video_port = use_video_port
+        self.warmup = warmup  # seconds for the gain and white balance to settle after the camera is opened
+        self.camera = None
+
+    def open(self, width: int, height: int):
+        from picamera import PiCamera
+        self.camera = PiCamera()
+        self.camera.resolution = (width, height)
+        sleep(self.warmup)
+
+    def capture_into(self, buffer: np.ndarray):
+        """Writes the next frame into the buffer. Returns when its exposure began, or None for when this was called."""
+        # the width and height are multiples of 32 and 16, so picamera writes the frame into the array without padding.
+        self.camera.capture(buffer, "bgr", use_video_port=self.use_video_port)
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+
+
+class ReplayBackend:
+    """
+    Plays back images (a file or a directory of them) or a video in a loop, at fps frames per second, for running and testing the base without a camera.
+    open_delay stands in for the warm-up of a real sensor.
+    """
+
+    IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+    def __init__(self, source: str, fps: float = 30, open_delay: float = 0):
+        self.source = source
+        self.fps = fps
+        self.open_delay = open_delay
+        self.frames = []
+        self.video = None
+        self.position = 0
+        self.next_frame_at = 0
+
+    def open(self, width: int, height: int):
+        self.size = (width, height)
+        if os.path.isdir(self.source):
+            paths = sorted(os.path.join(self.source, f) for f in os.listdir(self.source) if f.lower().endswith(ReplayBackend.IMAGE_EXTENSIONS))
+            self.frames = [self.fit(cv2.imread(path)) for path in paths]
+        elif self.source.lower().endswith(ReplayBackend.IMAGE_EXTENSIONS):
+            self.frames = [self.fit(cv2.imread(self.source))]
+        else:
+            self.video = cv2.VideoCapture(self.source)
+            if not self.video.isOpened():
+                raise IOError(f"Cannot open video {self.source}.")
+        if self.video is None and not self.frames:
+            raise IOError(f"No images found at {self.source}.")
+        sleep(self.open_delay)
+        self.next_frame_at = monotonic()
+
+    def fit(self, frame: np.ndarray) -> np.ndarray:
+        if frame is None:
+            raise IOError(f"Cannot read an image from {self.source}.")
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size)
+        return frame
+
+    def capture_into(self, buffer: np.ndarray):
+        if self.fps:
+            # paced like a sensor, a frame is only ready once its exposure would have ended.
+            self.next_frame_at = max(self.next_frame_at + 1 / self.fps, monotonic())
+            sleep(max(self.next_frame_at - monotonic(), 0))
+        exposed = monotonic()
+        if self.video is not None:
+            ok, frame = self.video.read()
+            if not ok:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = self.video.read()
+                if not ok:
+                    raise IOError(f"Cannot read a frame from {self.source}.")
+            np.copyto(buffer, self.fit(frame))
+        else:
+            np.copyto(buffer, self.frames[self.position])
+            self.position = (self.position + 1) % len(self.frames)
+        return exposed
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+
+
+class CaptureService:
+    """
+    Keeps the camera open and captures continuously, from a thread of its own, into a ring of preallocated frame buffers.
+    frame() hands out the latest frame as a read-only view of its buffer, without copying it. The buffer isn't written to again until the view is handed back,
+    so every frame that is still in use takes up one buffer of the ring, and the camera needs one more to write the next frame into.
+    """
+
+    def __init__(self, backend, width: int, height: int, ring_size: int = 3):
+        assert ring_size >= 2, "The ring needs a buffer to hand out and one to capture into."
+        self.backend = backend
+        self.buffers = [np.empty((height, width, 3), dtype=np.uint8) for i in range(ring_size)]
+        self.leases = [0] * ring_size
+        self.started_at = [0.0] * ring_size  # when the capture of the frame in each buffer began
+        self.latest = None
+        self.frame_count = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        capture_logger.info("Starting capture service.")
+        h, w, _ = self.buffers[0].shape
+        self.backend.open(w, h)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        capture_logger.info("Starting capture service complete.")
+        return self
+
+    def stop(self):
+        capture_logger.info("Stopping capture service.")
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.backend.close()
+        capture_logger.info("Stopping capture service complete.")
+
+    def next_buffer(self):
+        """The buffer to capture into next: the oldest one that is neither the latest frame nor handed out. Waits while there is none. Called with the condition held."""
+        while self.running:
+            free = [i for i in range(len(self.buffers)) if i != self.latest and not self.leases[i]]
+            if free:
+                return min(free, key=lambda i: self.started_at[i])
+            self.condition.wait()
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                i = self.next_buffer()
+                if i is None:
+                    return
+            started = monotonic()
+            try:
+                exposed = self.backend.capture_into(self.buffers[i])
+            except Exception as e:
+                capture_logger.error(f"Capture failed: {e}")
+                sleep(0.1)
+                continue
+            with self.condition:
+                self.started_at[i] = exposed or started
+                self.latest = i
+                self.frame_count += 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def frame(self, fresh: bool = True, timeout: float = 5):
+        """
+        Yields the latest frame, valid until the block is left. With fresh, waits for a frame whose capture began after the call,
+        so that it shows what is in front of the camera now and not a moment ago.
+        """
+        requested = monotonic()
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.latest is not None and (not fresh or self.started_at[self.latest] >= requested), timeout):
+                raise TimeoutError("No frame was captured in time.")
+            i = self.latest
+            self.leases[i] += 1
+        try:
+            view = self.buffers[i].view()
+            view.flags.writeable = False
+            yield view
+        finally:
+            with self.condition:
+                self.leases[i] -= 1
+                self.condition.notify_all()
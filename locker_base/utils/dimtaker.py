@@ -6,9 +6,9 @@ import numpy as np
 import imutils
 import cv2
 from PIL import Image, ImageEnhance
-import RPi.GPIO as GPIO
 from time import time, sleep
 from .imagetaker import Imagetaker
+from .ranging import RangingService
 from statistics import median
 import logging
 
@@ -18,6 +18,12 @@ console_log_handler.setLevel(logging.INFO)
 console_log_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
 dim_logger.addHandler(console_log_handler)
 
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # not on the Pi. the height sensor can be simulated with the ranging service, see Dimtaker.start_ranging().
+    GPIO = None
+
 
 class PartialObject:
     """
@@ -52,6 +58,47 @@ class PartialObject:
         self.actual_length = None
         self.actual_width = None
 
+    @classmethod
+    def from_contours(cls, contours: list, contour_areas: np.ndarray = None) -> list:
+        """
+        Partial objects of the contours, the same as PartialObject(contour) for each, but with the geometry of all their boxes worked out at once in arrays.
+        contour_areas can be passed in when they are known already, see Dimtaker.contour_areas().
+        """
+        if contour_areas is None:
+            contour_areas = Dimtaker.contour_areas(contours)
+        box_points = cv2.cv.BoxPoints if imutils.is_cv2() else cv2.boxPoints
+        boxes = PartialObject.order_boxes(np.array([box_points(cv2.minAreaRect(c)) for c in contours], dtype="int"))
+        # in float32 like the boxes, as PartialObject(contour) works it out.
+        top_left, top_right, bottom_right, bottom_left = (boxes[:, i] for i in range(4))
+        pixel_lengths = np.linalg.norm((top_left + top_right) * 0.5 - (bottom_left + bottom_right) * 0.5, axis=1)
+        pixel_widths = np.linalg.norm((top_left + bottom_left) * 0.5 - (top_right + bottom_right) * 0.5, axis=1)
+
+        partial_objects = []
+        for contour_area, box, pixel_length, pixel_width in zip(contour_areas, boxes, pixel_lengths, pixel_widths):
+            po = cls.__new__(cls)
+            po.contour_area = float(contour_area)
+            po.box = box
+            po.box_tuple = tuple(box)
+            po.pixel_length = float(pixel_length)
+            po.pixel_width = float(pixel_width)
+            po.actual_length = None
+            po.actual_width = None
+            partial_objects.append(po)
+        return partial_objects
+
+    @staticmethod
+    def order_boxes(boxes: np.ndarray) -> np.ndarray:
+        """perspective.order_points() for a stack of boxes of 4 points each: top left, top right, bottom right and bottom left."""
+        n = np.arange(len(boxes))[:, np.newaxis]
+        by_x = boxes[n, np.argsort(boxes[:, :, 0], axis=1)]
+        left, right = by_x[:, :2], by_x[:, 2:]
+        left = left[n, np.argsort(left[:, :, 1], axis=1)]
+        top_left, bottom_left = left[:, 0], left[:, 1]
+        # of the right-most points, the one further from the top left is the bottom right.
+        from_top_left = np.linalg.norm(right - top_left[:, np.newaxis], axis=2)
+        bottom_right, top_right = np.moveaxis(right[n, np.argsort(from_top_left, axis=1)[:, ::-1]], 1, 0)
+        return np.stack((top_left, top_right, bottom_right, bottom_left), axis=1).astype("float32")
+
     @staticmethod
     def midpoint(point_A, point_B):
         """Calculates the midpoint between two points."""
@@ -87,9 +134,15 @@ class Dimtaker:
     FILTER_RATIO = 1/4
     REFERENCE_WIDTH = 24  # mm
 
+    EDGE_SCALE = 1/4  # of the image that the contours are picked out of, see detect_edges_pyramid()
+    EDGE_MARGIN = 16  # px around a contour picked out of the downscaled image, for tracing it at full resolution
+
     DISTANCE_FULL = None  # mm
     DISTANCE_TRIG_PIN = 4
     DISTANCE_ECHO_PIN = 18
+    DISTANCE_ATTEMPTS = 3  # of waiting for stable readings from the ranging service, before taking what it has
+
+    ranging = None  # the ranging service, once started. see start_ranging().
 
     @classmethod
     def from_path(cls, file_path, process=False):
@@ -103,14 +156,48 @@ class Dimtaker:
     @staticmethod
     def detect_edges(image: np.ndarray):
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (7, 7), 0)
+        cnts = Dimtaker.find_contours(gray)
+        (cnts, _) = contours.sort_contours(cnts)
+        return cnts
+
+    @staticmethod
+    def detect_edges_pyramid(image: np.ndarray, scale: float = None):
+        """
+        The contours of the fiducial and the parcel, in that order, for find_fiducial_and_parcel().
+        They are picked out of the contours of a copy of the image downscaled by scale, and then traced at full resolution within just the region around each.
+        Falls back to detect_edges() when the downscaled copy doesn't have two contours.
+        """
+        scale = scale or Dimtaker.EDGE_SCALE
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # downscaling has smoothed most of what the blur is for already.
+        cnts = Dimtaker.find_contours(small, blur=(3, 3))
+        if len(cnts) < 2:
+            return Dimtaker.detect_edges(image)
+        (cnts, _) = contours.sort_contours(cnts)
+        areas = Dimtaker.contour_areas(cnts)
+        h, w = gray.shape
+        refined = []
+        for c in (cnts[0], cnts[1 + int(np.argmax(areas[1:]))]):
+            x, y, cw, ch = cv2.boundingRect(c)
+            x0, y0 = max(int(x / scale) - Dimtaker.EDGE_MARGIN, 0), max(int(y / scale) - Dimtaker.EDGE_MARGIN, 0)
+            x1, y1 = min(int((x + cw) / scale) + Dimtaker.EDGE_MARGIN, w), min(int((y + ch) / scale) + Dimtaker.EDGE_MARGIN, h)
+            region_cnts = Dimtaker.find_contours(gray[y0:y1, x0:x1], offset=(x0, y0))
+            if not region_cnts:
+                return Dimtaker.detect_edges(image)
+            refined.append(region_cnts[int(np.argmax(Dimtaker.contour_areas(region_cnts)))])
+        return refined
+
+    @staticmethod
+    def find_contours(gray: np.ndarray, blur: tuple = (7, 7), offset: tuple = (0, 0)) -> list:
+        """The outer contours of the edges in a grayscale image, offset by offset when the image is a region of a larger one."""
+        gray = cv2.GaussianBlur(gray, blur, 0)
         edged = cv2.Canny(gray, 25, 50)
         edged = cv2.dilate(edged, None, iterations=2)
         edged = cv2.erode(edged, None, iterations=1)
-        cnts = cv2.findContours(edged.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cnts = imutils.grab_contours(cnts)
-        (cnts, _) = contours.sort_contours(cnts)
-        return cnts
+        # the edges aren't needed afterwards, so findContours() can have them without a copy, even where it changes them (before OpenCV 3.2).
+        cnts = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        return list(imutils.grab_contours(cnts))
 
     @classmethod
     def init_height_sensor(cls):
@@ -122,10 +209,42 @@ class Dimtaker:
             cls.DISTANCE_FULL = cls.take_distance()
 
     @staticmethod
-    def take_distance() -> float:
+    def start_ranging(gpio=None, timer=None) -> RangingService:
+        """
+        Keeps the height sensor ranging from now on. take_distance() then reads the rolling estimate of the service instead of measuring from scratch.
+        The echo is timed with pigpio when its daemon is running, and by polling otherwise, unless another timer is given, see utils/ranging.py.
+        """
+        Dimtaker.ranging = RangingService(gpio, Dimtaker.DISTANCE_TRIG_PIN, Dimtaker.DISTANCE_ECHO_PIN, timer=timer).start()
+        return Dimtaker.ranging
+
+    @staticmethod
+    def stop_ranging():
+        if Dimtaker.ranging is not None:
+            Dimtaker.ranging.stop()
+            Dimtaker.ranging = None
+
+    @staticmethod
+    def take_distance(fresh: bool = True) -> float:
         """
         Just takes the distance between the sensor and the closest object. Calculate height of object separately.
+        With the ranging service running, returns its estimate right away (None while it has none), or with fresh waits for readings taken after the call that agree with each other.
+        When they don't settle after DISTANCE_ATTEMPTS waits, the filtered median of the readings so far is taken instead, like the median of every reading used to be.
+        Raises TimeoutError only when the sensor didn't give a single reading.
         """
+        if Dimtaker.ranging is not None:
+            if not fresh:
+                return Dimtaker.ranging.distance()
+            for i in range(1, Dimtaker.DISTANCE_ATTEMPTS + 1):
+                try:
+                    return Dimtaker.ranging.wait_for_stable()
+                except TimeoutError as e:
+                    dim_logger.warning(f"{e} Attempt {i} of {Dimtaker.DISTANCE_ATTEMPTS}.")
+            distance = Dimtaker.ranging.distance()
+            if distance is None:
+                raise TimeoutError("No readings of the height sensor.")
+            dim_logger.warning(f"Readings of the height sensor didn't settle, taking their filtered median of {distance}.")
+            return distance
+
         def init_and_measure(init: bool = True):
             if init:
                 GPIO.setwarnings(False)
@@ -167,18 +286,38 @@ class Dimtaker:
         dim_logger.info(f"Measuring distance complete, got median of {m}")
         return m
 
+    @staticmethod
+    def contour_areas(cnts: list) -> np.ndarray:
+        """The area of every contour, like cv2.contourArea() of each, from the shoelace formula over the points of all of them at once."""
+        counts = np.array([len(c) for c in cnts])
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        points = np.concatenate(cnts).reshape(-1, 2).astype(np.float64)
+        # the point after the last one of a contour is its first.
+        following = np.arange(1, len(points) + 1)
+        following[starts + counts - 1] = starts
+        x, y = points[:, 0], points[:, 1]
+        return np.abs(np.add.reduceat(x * y[following] - x[following] * y, starts)) / 2
+
+    @staticmethod
+    def find_fiducial_and_parcel(cnts: list):
+        """
+        The partial objects of the fiducial and the parcel among the contours, sorted from left to right like detect_edges() returns them, or as detect_edges_pyramid() returns them.
+        Only these two of what are often hundreds of contours are measured, the rest are told apart by their areas alone.
+        """
+        areas = Dimtaker.contour_areas(cnts)
+        # assumes the partial object on the top left corner is always going to be the fiducial.
+        # uses a "greedy" filter to get the largest object in the partial object list, ignoring any other stuff such as reflections. if the camera is properly calibrated, this approach shouldn't cause any problems.
+        parcel_index = 1 + int(np.argmax(areas[1:]))
+        fiducial, parcel = PartialObject.from_contours([cnts[0], cnts[parcel_index]], areas[[0, parcel_index]])
+        fiducial.actual_length = Dimtaker.REFERENCE_WIDTH
+        fiducial.actual_width = Dimtaker.REFERENCE_WIDTH
+        return fiducial, parcel
+
     @staticmethod
     def take_dimension_scale(img, full_distance=300, height_override: int = None, draw=False):
         """New algorithm that takes depth-of-view into consideration."""
         dim_logger.info("Taking dimensions of the scanning platform.")
-        cnts = Dimtaker.detect_edges(img)
-        po_list = [PartialObject(c) for c in cnts]
-        # assumes the partial object on the top left corner is always going to be the fiducial.
-        fiducial = po_list.pop(0)
-        fiducial.actual_length = 24
-        fiducial.actual_width = 24
-        # uses a "greedy" filter to get the largest object in the partial object list, ignoring any other stuff such as reflections. if the camera is properly calibrated, this approach shouldn't cause any problems.
-        parcel = sorted(po_list, key=lambda po: po.contour_area, reverse=True)[0]
+        fiducial, parcel = Dimtaker.find_fiducial_and_parcel(Dimtaker.detect_edges_pyramid(img))
         height = Dimtaker.take_distance() if not height_override else height_override
 
         parcel.actual_length = parcel.scale_to_distance(
@@ -208,12 +347,7 @@ class Dimtaker:
     @staticmethod
     def take_dimension_ratio(img, full_distance=300, draw=False):
         """Uses the original algorithm."""
-        cnts = Dimtaker.detect_edges(img)
-        po_list = [PartialObject(c) for c in cnts]
-        fiducial = po_list.pop(0)
-        fiducial.actual_length = 24
-        fiducial.actual_width = 24
-        parcel = sorted(po_list, key=lambda po: po.contour_area, reverse=True)[0]
+        fiducial, parcel = Dimtaker.find_fiducial_and_parcel(Dimtaker.detect_edges_pyramid(img))
         parcel.actual_length = parcel.scale_to_reference(parcel.pixel_length, fiducial.pixel_length, fiducial.actual_length)
         parcel.actual_width = parcel.scale_to_reference(parcel.pixel_width, fiducial.pixel_width, fiducial.actual_width)
         if draw:
@@ -1,6 +1,6 @@
 import logging
 from utils.construct import construct_logger
-from picamera import PiCamera
+from utils.capture import CaptureService, PiCameraBackend
 import numpy as np
 import cv2
 from imutils import resize, rotate
@@ -20,17 +20,49 @@ class Imagetaker:
 
     PROCESS_ROTATION_ANGLE = 180
     PROCESS_CROP_COORDINATES = (3, 35, 2044, 1440)  # left, top, right, bottom. is a rect, so no need for x, y for every point.
+    PROCESS_SHARPNESS = 1.5
+    PROCESS_BRIGHTNESS = 1.5
+    # ImageEnhance.Sharpness blends the image with its ImageFilter.SMOOTH, and Brightness with black. both are linear, so they make up a single kernel.
+    PROCESS_KERNEL = PROCESS_BRIGHTNESS * (
+        PROCESS_SHARPNESS * np.array([[0, 0, 0], [0, 1, 0], [0, 0, 0]]) + (1 - PROCESS_SHARPNESS) * np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]]) / 13
+    )
+
+    service = None  # the capture service, once started. see start_capture().
+
+    @staticmethod
+    def start_capture(backend=None, ring_size: int = 3) -> CaptureService:
+        """Keeps the camera open from now on. take_image() then takes the latest frame instead of opening the camera for every scan."""
+        Imagetaker.service = CaptureService(backend or PiCameraBackend(), Imagetaker.WIDTH_PX, Imagetaker.HEIGHT_PX, ring_size=ring_size).start()
+        return Imagetaker.service
+
+    @staticmethod
+    def stop_capture():
+        if Imagetaker.service is not None:
+            Imagetaker.service.stop()
+            Imagetaker.service = None
+
+    @staticmethod
+    def capture_once(backend) -> np.ndarray:
+        """Opens the camera, takes a single frame and closes it again. What every scan did before the capture service."""
+        backend.open(Imagetaker.WIDTH_PX, Imagetaker.HEIGHT_PX)
+        try:
+            img = np.empty((Imagetaker.HEIGHT_PX, Imagetaker.WIDTH_PX, 3), dtype=np.uint8)
+            backend.capture_into(img)
+        finally:
+            backend.close()
+        return img
 
     @staticmethod
     def take_image(process: bool = False, save: bool = False) -> np.ndarray:
         image_logger.info("Taking image.")
-        camera = PiCamera()
-        camera.resolution = (Imagetaker.WIDTH_PX, Imagetaker.HEIGHT_PX)
-        img = np.empty((Imagetaker.HEIGHT_PX, Imagetaker.WIDTH_PX, 3), dtype=np.uint8)
-        camera.capture(img, "bgr")
-        camera.close()
-        if process:
-            img = Imagetaker.process_image(img)
+        if Imagetaker.service is not None:
+            with Imagetaker.service.frame() as frame:
+                # processing makes a new image out of the frame anyway, an unprocessed frame has to be copied out of the ring.
+                img = Imagetaker.process_image(frame) if process else frame.copy()
+        else:
+            img = Imagetaker.capture_once(PiCameraBackend(use_video_port=False, warmup=0))
+            if process:
+                img = Imagetaker.process_image(img)
         if save:
             assert Imagetaker.save_image(img, "from_camera.jpg"), "An error occured while saving the image."
         image_logger.info("Taking image complete.")
@@ -71,15 +103,55 @@ class Imagetaker:
         return np.asarray(img)
 
     @staticmethod
-    def process_image(orig_image: np.ndarray) -> np.ndarray:
+    def process_image(orig_image: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Rotates, crops and enhances the image, like process_image_pil() but without its copies of the full frame.
+        The crop is taken as a view of the frame before it is rotated, a rotation of 180 degrees is a flip of that view into out,
+        and sharpening and brightening are one filter, applied to out in place. out is a new array unless one of the size of the crop is supplied.
+        """
         image_logger.info("Processing image.")
+        crop = Imagetaker.rotated_crop(orig_image)
+        if crop is None:
+            return Imagetaker.process_image_pil(orig_image)
+        roi, flip = crop
+        if out is None:
+            out = np.empty(roi.shape, dtype=np.uint8)
+        if flip:
+            cv2.flip(roi, -1, dst=out)
+        else:
+            np.copyto(out, roi)
+        cv2.filter2D(out, -1, Imagetaker.PROCESS_KERNEL, dst=out, borderType=cv2.BORDER_REPLICATE)
+        image_logger.info("Processing image complete.")
+        return out
+
+    @staticmethod
+    def rotated_crop(image: np.ndarray):
+        """
+        The part of the image that ends up in the crop once it is rotated, as a view, and whether it has to be flipped. None for angles other than 0 and 180 degrees.
+        imutils rotates about (w // 2, h // 2), which for an even width or height is half a pixel off the middle, so the crop is shifted by a pixel to match.
+        """
+        left, top, right, bottom = Imagetaker.PROCESS_CROP_COORDINATES
+        angle = Imagetaker.PROCESS_ROTATION_ANGLE % 360
+        if angle == 0:
+            return image[top:bottom, left:right], False
+        if angle != 180:
+            return None
+        h, w = image.shape[:2]
+        cx, cy = w // 2, h // 2
+        # a pixel at x of the rotated image comes from 2 * cx - x of the original.
+        x0, x1, y0, y1 = 2 * cx - right + 1, 2 * cx - left + 1, 2 * cy - bottom + 1, 2 * cy - top + 1
+        if x0 < 0 or y0 < 0 or x1 > w or y1 > h:
+            return None
+        return image[y0:y1, x0:x1], True
+
+    @staticmethod
+    def process_image_pil(orig_image: np.ndarray) -> np.ndarray:
+        """The original pipeline through PIL, for angles process_image() can't flip, and to check process_image() against."""
         # rotate, crop, and enhance image. all parameters are subject to change depending on my requirements.
         processed_image = imutils.rotate(orig_image, angle=Imagetaker.PROCESS_ROTATION_ANGLE)
         processed_image = Imagetaker.__convert_from_cv2_to_image(processed_image)
         processed_image = processed_image.crop(Imagetaker.PROCESS_CROP_COORDINATES)
-        processed_image = ImageEnhance.Sharpness(processed_image).enhance(1.5)  # i honestly have no idea if this has a big enough effect.
+        processed_image = ImageEnhance.Sharpness(processed_image).enhance(Imagetaker.PROCESS_SHARPNESS)  # i honestly have no idea if this has a big enough effect.
         # process back to numpy array
-        processed_image = ImageEnhance.Brightness(processed_image).enhance(1.5)
-        img_numpy = Imagetaker.__convert_from_image_to_cv2(processed_image)
-        image_logger.info("Processing image complete.")
-        return img_numpy
+        processed_image = ImageEnhance.Brightness(processed_image).enhance(Imagetaker.PROCESS_BRIGHTNESS)
+        return Imagetaker.__convert_from_image_to_cv2(processed_image)
@@ -0,0 +1,270 @@
+import logging
+import threading
+from collections import deque
+from statistics import median
+from time import monotonic, perf_counter, sleep
+from utils.construct import construct_logger
+
+ranging_logger = construct_logger(file_path="logs/ranging.log")
+console_log_handler = logging.StreamHandler()
+console_log_handler.setLevel(logging.INFO)
+console_log_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+ranging_logger.addHandler(console_log_handler)
+
+
+class PollingEchoTimer:
+    """Times the echo by reading the echo pin over and over, what Dimtaker.take_distance() does. Keeps a core busy while it waits, and is late by however long it was kept from running."""
+
+    def open(self, gpio, echo_pin: int):
+        self.gpio = gpio
+        self.echo_pin = echo_pin
+
+    def arm(self):
+        pass
+
+    def wait(self, timeout: float):
+        """The length of the echo in seconds, or None when it didn't rise and fall within timeout."""
+        deadline = perf_counter() + timeout
+        rise = perf_counter()
+        while not self.gpio.input(self.echo_pin):
+            rise = perf_counter()
+            if rise > deadline:
+                return None
+        fall = rise
+        while self.gpio.input(self.echo_pin):
+            fall = perf_counter()
+            if fall > deadline:
+                return None
+        return fall - rise
+
+    def close(self):
+        pass
+
+
+class EdgeTimer:
+    """Keeps the first rising and the following falling edge of the echo after arm(). Edges left over from an earlier trigger are ignored."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.rise = self.fall = None
+
+    def arm(self):
+        with self.lock:
+            self.rise = self.fall = None
+            self.done.clear()
+
+    def edge_at(self, level: int, at):
+        with self.lock:
+            if level and self.rise is None:
+                self.rise = at
+            elif not level and self.rise is not None and self.fall is None:
+                self.fall = at
+                self.done.set()
+
+    def wait(self, timeout: float):
+        """The length of the echo in seconds, or None when it didn't rise and fall within timeout."""
+        if not self.done.wait(timeout):
+            return None
+        with self.lock:
+            return self.duration(self.rise, self.fall)
+
+    def duration(self, rise, fall) -> float:
+        return fall - rise
+
+
+class EdgeEchoTimer(EdgeTimer):
+    """
+    Times the echo from interrupts on both of its edges, waiting without using the CPU.
+    RPi.GPIO calls back from a thread of its own, and the edge is timed when the callback runs. That is later than the edge by however long the thread took to be scheduled,
+    which under load makes its readings spread out more than those of polling, and an echo is lost when a callback runs after the pin changed again. Not the default, see RangingService.default_timer().
+    """
+
+    def open(self, gpio, echo_pin: int):
+        self.gpio = gpio
+        self.echo_pin = echo_pin
+        gpio.add_event_detect(echo_pin, gpio.BOTH, callback=self.edge)
+
+    def edge(self, channel: int):
+        at = perf_counter()
+        # RPi.GPIO doesn't say which edge it was, so it is told by the level of the pin. a callback that runs after the pin changed again is taken for the other edge,
+        # which loses the echo rather than timing it wrong: a falling edge left over from an earlier echo can't be taken for the rise.
+        self.edge_at(self.gpio.input(channel), at)
+
+    def close(self):
+        self.gpio.remove_event_detect(self.echo_pin)
+
+
+class PigpioEchoTimer(EdgeTimer):
+    """
+    Times the echo with the timestamps of pigpio, whose daemon samples the pins every few microseconds and stamps every change,
+    so that the time of an edge doesn't depend on when its callback runs. Needs the pigpio daemon running, pi is a connected pigpio.pi(), made on open() if left out.
+    """
+    EITHER_EDGE = 2  # pigpio.EITHER_EDGE
+
+    def __init__(self, pi=None):
+        super().__init__()
+        self.pi = pi
+        self.owns_pi = pi is None
+        self.callback = None
+
+    def open(self, gpio, echo_pin: int):
+        if self.pi is None:
+            import pigpio
+            self.pi = pigpio.pi()
+        if not self.pi.connected:
+            raise IOError("Cannot connect to the pigpio daemon.")
+        self.callback = self.pi.callback(echo_pin, PigpioEchoTimer.EITHER_EDGE, self.edge)
+
+    def edge(self, pin: int, level: int, tick: int):
+        if level < 2:  # 2 is a watchdog timeout, not an edge
+            self.edge_at(level, tick)
+
+    def duration(self, rise: int, fall: int) -> float:
+        # ticks are microseconds, wrapping around after 32 bits.
+        return ((fall - rise) & 0xFFFFFFFF) / 1000000
+
+    def close(self):
+        if self.callback is not None:
+            self.callback.cancel()
+            self.callback = None
+        if self.owns_pi and self.pi is not None:
+            self.pi.stop()
+            self.pi = None
+
+
+class RangingService:
+    """
+    Keeps ranging with the ultrasonic height sensor (an HC-SR04) from a thread of its own, setting up the GPIO pins once.
+    Every reading goes into a rolling window. distance() filters the window with its median absolute deviation and returns the median of what is left, right away,
+    and wait_for_stable() waits for readings taken after the call that agree with each other.
+    gpio is RPi.GPIO, or anything with the same calls such as SimulatedGPIO. RPi.GPIO is only imported when the service starts, so the rest of the base can run on other machines.
+    timer times the echo, see PigpioEchoTimer, PollingEchoTimer and EdgeEchoTimer. default_timer() picks one when it is left out.
+    """
+
+    INTERVAL = 0.06  # s, the sensor needs 60 ms from one trigger to the next for the echoes of the last one to die down
+    ECHO_TIMEOUT = 0.03  # s from the trigger to the end of the echo, longer than the echo of anything in range takes
+    MIN_DISTANCE, MAX_DISTANCE = 20, 4000  # mm, the range of the sensor
+    MM_PER_SECOND = 171500  # half the speed of sound, the echo travels there and back
+    OUTLIER_MADS = 3  # readings further than this many (scaled) median absolute deviations from the median are left out
+    MAD_FLOOR = 1  # mm, so that a window of nearly equal readings doesn't throw out every reading that differs by a hair
+
+    def __init__(self, gpio, trig_pin: int, echo_pin: int, timer=None, window: int = 15, interval: float = INTERVAL):
+        self.gpio = gpio
+        self.timer = timer or RangingService.default_timer()
+        self.trig_pin = trig_pin
+        self.echo_pin = echo_pin
+        self.interval = interval
+        self.readings = deque(maxlen=window)  # (sequence number, distance in mm or None for no echo)
+        self.sequence = 0
+        self.estimate = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    @staticmethod
+    def default_timer():
+        """Times the echo with the timestamps of pigpio when its daemon is running, and by polling otherwise."""
+        try:
+            import pigpio
+        except ImportError:
+            ranging_logger.info("pigpio isn't installed, timing the echo by polling.")
+            return PollingEchoTimer()
+        pi = pigpio.pi()
+        connected = pi.connected
+        pi.stop()
+        if not connected:
+            ranging_logger.info("The pigpio daemon isn't running, timing the echo by polling.")
+            return PollingEchoTimer()
+        return PigpioEchoTimer()
+
+    def open(self):
+        """Sets up the pins and the echo timer, for measure()."""
+        if self.gpio is None:
+            import RPi.GPIO
+            self.gpio = RPi.GPIO
+        self.gpio.setwarnings(False)
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setup(self.trig_pin, self.gpio.OUT)
+        self.gpio.setup(self.echo_pin, self.gpio.IN)
+        self.gpio.output(self.trig_pin, False)
+        self.timer.open(self.gpio, self.echo_pin)
+        sleep(self.interval)  # lets the sensor settle with the trigger low
+
+    def close(self):
+        self.timer.close()
+        self.gpio.cleanup()
+
+    def start(self):
+        ranging_logger.info("Starting ranging service.")
+        self.open()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        ranging_logger.info("Starting ranging service complete.")
+        return self
+
+    def stop(self):
+        ranging_logger.info("Stopping ranging service.")
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.close()
+        ranging_logger.info("Stopping ranging service complete.")
+
+    def measure(self):
+        """Triggers the sensor and times the echo. Returns the distance in mm, or None when there was no echo or it was out of range."""
+        self.timer.arm()
+        self.gpio.output(self.trig_pin, True)
+        sleep(0.00001)
+        self.gpio.output(self.trig_pin, False)
+        duration = self.timer.wait(RangingService.ECHO_TIMEOUT)
+        if duration is None:
+            return None
+        distance = duration * RangingService.MM_PER_SECOND
+        return round(distance, 4) if RangingService.MIN_DISTANCE <= distance <= RangingService.MAX_DISTANCE else None
+
+    def run(self):
+        next_at = monotonic()
+        while self.running:
+            distance = self.measure()
+            with self.condition:
+                self.sequence += 1
+                self.readings.append((self.sequence, distance))
+                self.estimate = RangingService.filtered_median([d for i, d in self.readings if d is not None])
+                self.condition.notify_all()
+            next_at = max(next_at + self.interval, monotonic())
+            sleep(max(next_at - monotonic(), 0))
+
+    @staticmethod
+    def filtered_median(distances: list):
+        """The median of the distances that are within OUTLIER_MADS median absolute deviations of their median. None for no distances."""
+        if not distances:
+            return None
+        m = median(distances)
+        # 1.4826 scales the deviation to the standard deviation of normally distributed readings.
+        spread = max(1.4826 * median(abs(d - m) for d in distances), RangingService.MAD_FLOOR)
+        return median(d for d in distances if abs(d - m) <= RangingService.OUTLIER_MADS * spread)
+
+    def distance(self):
+        """The filtered distance over the rolling window, in mm. None while there are no readings with an echo."""
+        with self.condition:
+            return self.estimate
+
+    def wait_for_stable(self, count: int = 5, tolerance: float = 5, timeout: float = 2) -> float:
+        """
+        Waits until the last count readings taken after the call had an echo and are within tolerance (mm) of their median, and returns that median.
+        Something that was moved onto the platform a moment ago has to be still before it is measured.
+        """
+        def stable():
+            fresh = [d for i, d in list(self.readings)[-count:] if i > called_at]
+            return len(fresh) == count and None not in fresh and max(abs(d - median(fresh)) for d in fresh) <= tolerance
+
+        with self.condition:
+            called_at = self.sequence
+            if not self.condition.wait_for(lambda: not self.running or stable(), timeout) or not self.running:
+                raise TimeoutError(f"No {count} stable readings of the height sensor in time.")
+            return median(d for i, d in list(self.readings)[-count:])
@@ -0,0 +1,77 @@
+import hmac
+import logging
+import time
+from utils.construct import construct_logger
+from utils.jsonIO import jsonIO
+
+retrieval_logger = construct_logger(file_path="logs/retrieval.log")
+console_log_handler = logging.StreamHandler()
+console_log_handler.setLevel(logging.INFO)
+console_log_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+retrieval_logger.addHandler(console_log_handler)
+
+
+class Retrieval:
+    """
+    Checks the retrieval codes generated by the webserver (Parcel.make_retrieval_code) without contacting it.
+    A code looks like withdraw_<parcel id>_<unit id>_<expiry>_<signature>, signed with a key shared between the webserver and this base.
+    """
+    PREFIX = "withdraw"
+    SIGNATURE_LENGTH = 32  # follows the webserver configuration.
+    CODE_TTL = 15 * 60  # s a code is valid for, follows Parcel.RETRIEVAL_CODE_TTL of the webserver.
+
+    # the parcels and units that a code has already opened, as <parcel id>_<unit id>, each with the time until which their codes are turned down.
+    # the webserver hands out a new code, with a signature of its own, every time the parcel is looked at, so any code of the parcel that was made before it was withdrawn
+    # is turned down until it would have expired. kept in a file of its own, so that a restart of the base doesn't forget them.
+    USED_PATH = "config/used_retrievals.json"
+    used = None  # loaded on first use, see load_used()
+
+    @staticmethod
+    def sign(key: str, parcel_id: int, unit_id: int, expiry: int) -> str:
+        message = f"{Retrieval.PREFIX}_{parcel_id}_{unit_id}_{expiry}".encode()
+        return hmac.new(key.encode(), message, "sha256").hexdigest()[:Retrieval.SIGNATURE_LENGTH]
+
+    @staticmethod
+    def verify(qr_data: str, keys: list, now: float = None):
+        """Returns (parcel id, unit id) if the code is signed with one of the keys, hasn't expired and hasn't been used yet, None otherwise."""
+        now = time.time() if now is None else now
+        try:
+            prefix, parcel_id, unit_id, expiry, signature = qr_data.lower().split("_")
+            parcel_id, unit_id, expiry = int(parcel_id), int(unit_id), int(expiry)
+        except ValueError:
+            retrieval_logger.warning(f"Malformed retrieval code {qr_data}.")
+            return None
+        if prefix != Retrieval.PREFIX:
+            return None
+        if expiry < now:
+            retrieval_logger.warning(f"Retrieval code of parcel {parcel_id} expired at {expiry}.")
+            return None
+        if not any(hmac.compare_digest(Retrieval.sign(key, parcel_id, unit_id, expiry), signature) for key in keys):
+            retrieval_logger.warning(f"Retrieval code of parcel {parcel_id} has an invalid signature.")
+            return None
+        used = {key: until for key, until in Retrieval.load_used().items() if until >= now}
+        if f"{parcel_id}_{unit_id}" in used:
+            retrieval_logger.warning(f"A retrieval code of parcel {parcel_id} has already opened locker unit {unit_id}.")
+            return None
+        # a code made up to the moment it is used expires CODE_TTL later at most.
+        used[f"{parcel_id}_{unit_id}"] = max(expiry, now + Retrieval.CODE_TTL)
+        Retrieval.used = used
+        Retrieval.save_used()
+        retrieval_logger.info(f"Accepted retrieval code of parcel {parcel_id} for locker unit {unit_id}.")
+        return parcel_id, unit_id
+
+    @staticmethod
+    def load_used() -> dict:
+        if Retrieval.used is None:
+            Retrieval.used = jsonIO.load(Retrieval.USED_PATH) if jsonIO.is_valid(Retrieval.USED_PATH) else {}
+        return Retrieval.used
+
+    @staticmethod
+    def save_used():
+        try:
+            saved = jsonIO.save(Retrieval.USED_PATH, Retrieval.used)
+        except OSError as e:
+            retrieval_logger.error(e)
+            saved = False
+        if not saved:
+            retrieval_logger.error(f"Could not save the used retrieval codes to {Retrieval.USED_PATH}, they are only kept until the base restarts.")
@@ -0,0 +1,130 @@
+import heapq
+import random
+import threading
+from time import perf_counter
+
+
+class SimulatedGPIO:
+    """
+    Stands in for RPi.GPIO off the Pi: the calls the base makes, with an HC-SR04 ultrasonic sensor wired to the trigger and echo pins.
+    The echo goes high shortly after the trigger pulse ends and stays high for as long as the sound takes to travel to distance (mm) and back.
+    noise is the standard deviation of every reading in mm, a share of dropout readings never echo and a share of outlier readings bounce off something else.
+    Edges of the echo are called back from a thread of their own, like RPi.GPIO does, as soon as it gets to run after the pin changed.
+    """
+    BCM = "BCM"
+    OUT, IN = 0, 1
+    LOW, HIGH = 0, 1
+    RISING, FALLING, BOTH = 31, 32, 33
+
+    SPEED_OF_SOUND = 343000  # mm/s
+    ECHO_DELAY = 0.0005  # s between the end of the trigger pulse and the echo going high, while the sensor sends its burst
+
+    def __init__(self, trig_pin: int, echo_pin: int, distance: float = 300, noise: float = 0.0, dropout: float = 0.0, outlier: float = 0.0, seed: int = 0):
+        self.trig_pin = trig_pin
+        self.echo_pin = echo_pin
+        self.distance = distance
+        self.noise = noise
+        self.dropout = dropout
+        self.outlier = outlier
+        self.rng = random.Random(seed)
+        self.lock = threading.Condition()
+        self.dispatcher = None
+        self.cleanup()
+
+    def setwarnings(self, flag: bool):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin: int, direction: int):
+        self.directions[pin] = direction
+
+    def cleanup(self):
+        with self.lock:
+            self.mode = None
+            self.directions = {}
+            self.levels = {}
+            self.echo = None  # (rises at, falls at) of the echo pulse, perf_counter() seconds
+            self.trigger_count = 0
+            self.listeners = {}  # pin: [(edge, function called with the level and the time of the edge)]
+            self.edges = []  # heap of (time, pin, level) of the edges still to be called back
+
+    def add_event_detect(self, pin: int, edge: int, callback=None, bouncetime: int = None):
+        self.listen(pin, edge, lambda level, at: callback(pin))
+
+    def remove_event_detect(self, pin: int):
+        with self.lock:
+            self.listeners.pop(pin, None)
+
+    def listen(self, pin: int, edge: int, function):
+        with self.lock:
+            self.listeners.setdefault(pin, []).append((edge, function))
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+                self.dispatcher.start()
+
+    def dispatch(self):
+        while True:
+            with self.lock:
+                while not self.edges or self.edges[0][0] > perf_counter():
+                    self.lock.wait(self.edges[0][0] - perf_counter() if self.edges else None)
+                at, pin, level = heapq.heappop(self.edges)
+                listeners = list(self.listeners.get(pin, []))
+            for edge, function in listeners:
+                if edge == SimulatedGPIO.BOTH or edge == (SimulatedGPIO.RISING if level else SimulatedGPIO.FALLING):
+                    function(level, at)
+
+    def output(self, pin: int, value):
+        with self.lock:
+            was = self.levels.get(pin, SimulatedGPIO.LOW)
+            self.levels[pin] = SimulatedGPIO.HIGH if value else SimulatedGPIO.LOW
+            if pin == self.trig_pin and was and not value:
+                self.trigger_count += 1
+                self.echo = self.next_echo(perf_counter())
+                if self.echo and self.echo_pin in self.listeners:
+                    heapq.heappush(self.edges, (self.echo[0], self.echo_pin, SimulatedGPIO.HIGH))
+                    heapq.heappush(self.edges, (self.echo[1], self.echo_pin, SimulatedGPIO.LOW))
+                    self.lock.notify()
+
+    def next_echo(self, triggered_at: float):
+        if self.rng.random() < self.dropout:
+            return None
+        distance = self.rng.uniform(20, 4000) if self.rng.random() < self.outlier else self.rng.gauss(self.distance, self.noise)
+        rises_at = triggered_at + SimulatedGPIO.ECHO_DELAY
+        return rises_at, rises_at + 2 * max(distance, 0) / SimulatedGPIO.SPEED_OF_SOUND
+
+    def input(self, pin: int) -> int:
+        if pin != self.echo_pin:
+            return self.levels.get(pin, SimulatedGPIO.LOW)
+        echo = self.echo
+        return SimulatedGPIO.HIGH if echo and echo[0] <= perf_counter() < echo[1] else SimulatedGPIO.LOW
+
+
+class SimulatedPi:
+    """
+    Stands in for a pigpio.pi() connected to the pins of a SimulatedGPIO.
+    Edges are called back with the time the pin changed, like pigpio, which samples the pins in its daemon and stamps every change, however late the callback runs.
+    """
+
+    def __init__(self, gpio: SimulatedGPIO):
+        self.gpio = gpio
+        self.connected = True
+
+    def callback(self, pin: int, edge: int, function):
+        # pigpio numbers its edges RISING_EDGE, FALLING_EDGE, EITHER_EDGE = 0, 1, 2. ticks are microseconds, wrapping around after 32 bits.
+        rpi_edge = (SimulatedGPIO.RISING, SimulatedGPIO.FALLING, SimulatedGPIO.BOTH)[edge]
+        self.gpio.listen(pin, rpi_edge, lambda level, at: function(pin, level, int(at * 1000000) & 0xFFFFFFFF))
+        return SimulatedCallback(self.gpio, pin)
+
+    def stop(self):
+        self.connected = False
+
+
+class SimulatedCallback:
+    def __init__(self, gpio: SimulatedGPIO, pin: int):
+        self.gpio = gpio
+        self.pin = pin
+
+    def cancel(self):
+        self.gpio.remove_event_detect(self.pin)
@@ -1,9 +1,11 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 urlpatterns = [
     # locker queries
-    path("locker/<int:locker_id>/<str:activity_type>/", views.locker_add_activity),
+    path("locker/<int:locker_id>/units/availability/", views.locker_units_availability),
+    path("locker/<int:locker_id>/<str:activity_type>/", views.locker_add_activity_async if settings.ASYNC_API else views.locker_add_activity),
     # parcel queries
 ]
@@ -1,11 +1,14 @@
 from django.http.request import HttpRequest
-from django.http.response import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponseNotModified
+from django.http.response import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseNotFound, HttpResponseNotModified
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 from central.models import *
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from django.db import close_old_connections
+from asgiref.sync import sync_to_async
 import logging
+import math
 
 # Create your views here.
 
@@ -16,16 +19,44 @@ def locker_add_activity(request, locker_id: int, activity_type: str):
     """
     Concentrated endpoint for the locker base to query the webserver.
     """
+    return handle_locker_activity(request, locker_id, activity_type)
+
+
+async def locker_add_activity_async(request, locker_id: int, activity_type: str):
+    """
+    Same endpoint as locker_add_activity, served without tying up the worker while the activity is recorded. The default under ASGI, see parlock/asgi.py.
+    Django 3.2 doesn't have an async ORM yet, so the handler runs in a thread of its own instead of the single thread that sync views share.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    return await sync_to_async(_handle_in_worker, thread_sensitive=False)(request, locker_id, activity_type)
+
+
+# the decorators of Django 3.2 wrap views in sync functions, which would hide that the view is a coroutine function.
+locker_add_activity_async.csrf_exempt = True
+
+
+def _handle_in_worker(request, locker_id: int, activity_type: str):
+    # each worker thread keeps its own database connection, which the request_started and request_finished signals don't look after.
+    close_old_connections()
     try:
-        lb = get_object_or_404(LockerBase, pk=locker_id)
-        if LockerBase.verify(request.POST["verification_code"]) != lb:
+        return handle_locker_activity(request, locker_id, activity_type)
+    finally:
+        close_old_connections()
+
+
+def handle_locker_activity(request, locker_id: int, activity_type: str):
+    try:
+        lb = LockerBase.authenticate(locker_id, request.POST["verification_code"])
+        if lb is None:
             return HttpResponseBadRequest()
         else:
             activity_type = activity_type.lower()
             if activity_type == "online":
                 # report to webserver that the locker base is online.
                 if lb.add_activity(activity_type=LockerActivity.ActivityType.ONLINE, locker_unit=None):
-                    return JsonResponse({"success": True})
+                    # the base verifies retrieval codes with these while it is offline.
+                    return JsonResponse({"success": True, "retrieval_keys": lb.retrieval_keys()})
                 else:
                     return HttpResponseNotModified()
             elif activity_type == "offline":
@@ -38,21 +69,17 @@ def locker_add_activity(request, locker_id: int, activity_type: str):
                 # reports locker units connected to webserver.
                 lu = get_object_or_404(LockerUnit, pk=request.POST["unit_id"])
                 if lb.add_activity(activity_type=LockerActivity.ActivityType.REGISTER, locker_unit=lu):
-
-                    return JsonResponse({
-                        "success": True,
-                        "length": lu.length,
-                        "width": lu.width,
-                        "height": lu.height,
-                        "is_available": lu.is_available
-                    })
+                    if lu.locker_base_id != lb.id:
+                        lu.locker_base = lb
+                        lu.save(update_fields=["locker_base"])
+                    return JsonResponse({"success": True, **lu.availability()})
                 else:
                     return HttpResponseNotModified()
             elif activity_type == "change":
                 # requests for a change in verification code.
                 la = lb.change_v_code()
                 if isinstance(la, LockerActivity):
-                    return JsonResponse({"success": True, "verification_code": lb.verification_code})
+                    return JsonResponse({"success": True, "verification_code": lb.verification_code, "retrieval_keys": lb.retrieval_keys()})
                 else:
                     return HttpResponseNotModified()
             elif activity_type == "parcel":
@@ -71,6 +98,15 @@ def locker_add_activity(request, locker_id: int, activity_type: str):
                     return JsonResponse({"success": True})
                 else:
                     return HttpResponseForbidden()
+            elif activity_type == "allocate":
+                # asks the webserver for the best fitting free locker unit for the parcel that was just measured.
+                parcel = get_object_or_404(Parcel, tracking_number=request.POST["tracking_number"], destination_locker=lb)
+                if parcel.is_complete():
+                    return HttpResponseForbidden()
+                lu = lb.allocate(*dimensions(request), parcel=parcel)
+                if lu is None:
+                    return JsonResponse({"success": False})
+                return JsonResponse({"success": True, "unit_id": lu.id, "size_class": lu.size_class})
             elif activity_type == "deposit":
                 # is a set of two
                 # UNLOCK - DEPOSIT_REQ if complete=false
@@ -100,9 +136,11 @@ def locker_add_activity(request, locker_id: int, activity_type: str):
 
             elif activity_type == "withdraw":
                 # see above, set of two
-                parcel = Parcel.verify_retrieval_code(qr_data=request.POST["qr_data"])
+                parcel = Parcel.verify_retrieval_code(qr_data=request.POST["qr_data"], scanned_at=scanned_at(request))
                 lu = get_object_or_404(LockerUnit, pk=request.POST["unit_id"])
-                if "complete" in request.POST:
+                if not isinstance(parcel, Parcel):
+                    return JsonResponse({"success": False})
+                elif "complete" in request.POST:
                     is_complete = eval(request.POST["complete"])
                     if isinstance(is_complete, bool) and is_complete:
                         pa = parcel.add_activity(
@@ -125,7 +163,7 @@ def locker_add_activity(request, locker_id: int, activity_type: str):
 
             elif activity_type == "withdraw-qr":
                 # when the recipient scans qr code
-                p = Parcel.verify_retrieval_code(qr_data=request.POST["qr_data"])
+                p = Parcel.verify_retrieval_code(qr_data=request.POST["qr_data"], scanned_at=scanned_at(request))
                 if p is None:
                     return HttpResponseNotFound()
                 elif p is False:
@@ -145,5 +183,43 @@ def locker_add_activity(request, locker_id: int, activity_type: str):
     except ObjectDoesNotExist as e:
         logging.error(e)
         return HttpResponseBadRequest()
-    except KeyError:
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+
+
+def dimensions(request):
+    """The length, width and height of a parcel as measured by the locker base. Raises ValueError unless every one is a finite number above 0."""
+    dims = [float(request.POST[key]) for key in ("length", "width", "height")]
+    if not all(math.isfinite(d) and d > 0 for d in dims):
+        raise ValueError(f"Invalid parcel dimensions {dims}.")
+    return dims
+
+
+def scanned_at(request):
+    """When the locker base accepted the retrieval code, for codes that are reported after the base verified them by itself."""
+    try:
+        return float(request.POST["scanned_at"])
+    except (KeyError, ValueError):
+        return None
+
+
+@require_POST
+@csrf_exempt
+def locker_units_availability(request, locker_id: int):
+    """
+    Bulk availability of the locker units registered with the locker base. Specific units can be requested with repeated unit_id parameters.
+    """
+    try:
+        lb = LockerBase.authenticate(locker_id, request.POST["verification_code"])
+        if lb is None:
+            return HttpResponseBadRequest()
+        units = LockerUnit.objects.filter(locker_base=lb)
+        unit_ids = request.POST.getlist("unit_id")
+        if unit_ids:
+            units = units.filter(pk__in=unit_ids)
+        return JsonResponse({"success": True, "units": [lu.availability() for lu in units.order_by("id")]})
+    except ObjectDoesNotExist as e:
+        logging.error(e)
+        return HttpResponseBadRequest()
+    except (KeyError, ValueError):
         return HttpResponseBadRequest()
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class CentralConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'central'
+
+    def ready(self):
+        from .search import install_search_indexes
+        from .metrics import install_query_counter
+        from .sqlite import install_begin_immediate
+        post_migrate.connect(install_search_indexes, sender=self)
+        connection_created.connect(install_query_counter)
+        connection_created.connect(install_begin_immediate)
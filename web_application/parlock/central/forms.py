@@ -1,4 +1,5 @@
 from django.db.models import fields
+from django import forms
 from django.forms import ModelForm
 from django.contrib.auth.forms import UserCreationForm
 from .models import Parcel, User
@@ -15,6 +16,14 @@ class ParcelForm(ModelForm):
         self.fields['tracking_number'].widget.attrs.update({'class': 'form-control m-2'})
 
 
+class ParcelImportForm(forms.Form):
+    manifest = forms.FileField(help_text="CSV with a header row, or JSON lines (.jsonl), with tracking_number, recipient and destination_locker.")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['manifest'].widget.attrs.update({'class': 'form-control m-2'})
+
+
 class UserRegistrationForm(UserCreationForm):
     class Meta:
         model = User
@@ -0,0 +1,91 @@
+"""
+In-memory nearest-neighbour index over the coordinates of the locker bases.
+Coordinates are projected onto the unit sphere, so a 3-d KD-tree on straight-line (chord) distance orders bases the same way as great-circle distance does, without any GIS extension on the database.
+"""
+from django.core.cache import cache
+from math import asin, cos, radians, sin
+import heapq
+import threading
+import uuid
+
+EARTH_RADIUS_KM = 6371.0088
+VERSION_CACHE_KEY = "lockerbase:geo:version"
+
+
+def to_unit_vector(latitude: float, longitude: float) -> tuple:
+    lat, lon = radians(float(latitude)), radians(float(longitude))
+    return (cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat))
+
+
+def chord_to_km(chord: float) -> float:
+    return 2 * EARTH_RADIUS_KM * asin(min(chord / 2, 1.0))
+
+
+class LockerIndex:
+    """A static KD-tree over (id, latitude, longitude) points. Rebuilt as a whole whenever the coordinates change."""
+
+    def __init__(self, points):
+        self.size = 0
+        self.root = self._build([(to_unit_vector(lat, lon), _id) for _id, lat, lon in points], depth=0)
+
+    def _build(self, items, depth):
+        # node: (point, id, axis, left, right)
+        if not items:
+            return None
+        axis = depth % 3
+        items.sort(key=lambda item: item[0][axis])
+        mid = len(items) // 2
+        self.size += 1
+        return (items[mid][0], items[mid][1], axis, self._build(items[:mid], depth + 1), self._build(items[mid + 1:], depth + 1))
+
+    def nearest(self, latitude: float, longitude: float, k: int = 3, predicate=None) -> list:
+        """Returns up to k (distance in km, id) pairs, closest first. Ids rejected by the predicate are skipped without ending the search."""
+        target = to_unit_vector(latitude, longitude)
+        heap = []  # max-heap of the best k so far, as (-squared distance, id)
+
+        def visit(node):
+            if node is None:
+                return
+            point, _id, axis, left, right = node
+            d2 = sum((p - t) ** 2 for p, t in zip(point, target))
+            if len(heap) < k or d2 < -heap[0][0]:
+                if predicate is None or predicate(_id):
+                    heapq.heappush(heap, (-d2, _id))
+                    if len(heap) > k:
+                        heapq.heappop(heap)
+            diff = target[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            # only cross the splitting plane if a closer point could be on the other side.
+            if len(heap) < k or diff ** 2 < -heap[0][0]:
+                visit(far)
+
+        visit(self.root)
+        return [(chord_to_km((-neg_d2) ** 0.5), _id) for neg_d2, _id in sorted(heap, reverse=True)]
+
+
+_lock = threading.Lock()
+_index = None
+_index_version = None
+
+
+def invalidate():
+    """Tells every process that its index is out of date. Called after locker base coordinates change."""
+    cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+
+def get_index() -> LockerIndex:
+    """Returns the index of this process, rebuilding it if the coordinates changed since it was built."""
+    global _index, _index_version
+    from .models import LockerBase
+
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(VERSION_CACHE_KEY, version, None)
+        version = cache.get(VERSION_CACHE_KEY, version)
+    with _lock:
+        if _index is None or _index_version != version:
+            points = LockerBase.objects.filter(latitude__isnull=False, longitude__isnull=False).values_list("id", "latitude", "longitude")
+            _index, _index_version = LockerIndex(points), version
+        return _index
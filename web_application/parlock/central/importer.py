@@ -0,0 +1,151 @@
+"""
+Bulk pre-registration of parcels from carrier manifests, as CSV with a header row or as JSON lines.
+Every row needs a tracking_number, a recipient (username or email) and a destination_locker (id or name).
+Rows are read one at a time and written in batches, so memory stays bounded whatever the size of the manifest.
+"""
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+from .models import LockerBase, Parcel, ParcelActivity, User
+import csv
+import io
+import json
+
+FIELDS = ("tracking_number", "recipient", "destination_locker")
+TRACKING_NUMBER_LENGTH = Parcel._meta.get_field("tracking_number").max_length
+
+
+class ImportResult:
+    MAX_ERRORS = 1000
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.errors = []  # (line number, message), only the first MAX_ERRORS are kept
+        self.error_count = 0
+
+    def add_error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < ImportResult.MAX_ERRORS:
+            self.errors.append((line, message))
+
+
+def read_rows(stream, fmt: str):
+    """Yields (line number, row) from a binary stream of CSV or JSON lines. Rows that can't be parsed are yielded as an error message instead of a dict."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_num, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                row = f"Invalid JSON: {e}"
+            yield line_num, row if isinstance(row, (dict, str)) else "Expected a JSON object."
+
+
+def format_of(filename: str) -> str:
+    return "jsonl" if filename.lower().endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+
+def import_parcels(rows, batch_size: int = 1000, on_error=None) -> ImportResult:
+    """Registers the parcels of the rows. on_error(line, message) is called for every row that is rejected, in addition to collecting them in the result."""
+    result = ImportResult()
+    lockers = {}  # destination_locker value -> id, across batches
+
+    def flush(batch):
+        errors = []
+        result.created += _import_batch(batch, lockers, reject=lambda line, message: errors.append((line, message)))
+        for line, message in sorted(errors):
+            result.add_error(line, message)
+            if on_error:
+                on_error(line, message)
+
+    batch = []
+    for line, row in rows:
+        result.rows += 1
+        batch.append((line, row))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return result
+
+
+def _import_batch(batch, lockers: dict, reject) -> int:
+    """Validates and writes one batch, calling reject(line, message) for the rows that can't be registered. Returns the number of parcels created."""
+    valid = []
+    seen = set()
+    for line, row in batch:
+        if isinstance(row, str):
+            reject(line, row)
+            continue
+        values = {field: str(row.get(field) or "").strip() for field in FIELDS}
+        missing = [field for field in FIELDS if not values[field]]
+        if missing:
+            reject(line, f"Missing {', '.join(missing)}.")
+        elif len(values["tracking_number"]) > TRACKING_NUMBER_LENGTH:
+            reject(line, f"Tracking number is longer than {TRACKING_NUMBER_LENGTH} characters.")
+        elif values["tracking_number"] in seen:
+            reject(line, f"Tracking number {values['tracking_number']} appears more than once in this batch.")
+        else:
+            seen.add(values["tracking_number"])
+            valid.append((line, values))
+    if not valid:
+        return 0
+
+    # one query per kind of lookup for the whole batch.
+    existing = set(Parcel.objects.filter(tracking_number__in=seen).values_list("tracking_number", flat=True))
+    names = {values["recipient"] for line, values in valid}
+    recipients = {}
+    for _id, username, email in User.objects.filter(Q(username__in=names) | Q(email__in=names)).values_list("id", "username", "email"):
+        recipients[username] = recipients[email] = _id
+    unknown = {values["destination_locker"] for line, values in valid} - lockers.keys()
+    if unknown:
+        ids = [int(v) for v in unknown if v.isdigit()]
+        for _id, name in LockerBase.objects.filter(Q(pk__in=ids) | Q(name__in=unknown)).values_list("id", "name"):
+            lockers[name] = lockers[str(_id)] = _id
+
+    parcels = []
+    lines = {}
+    now = timezone.now()
+    for line, values in valid:
+        if values["tracking_number"] in existing:
+            reject(line, f"Tracking number {values['tracking_number']} is already registered.")
+        elif values["recipient"] not in recipients:
+            reject(line, f"No user with username or email {values['recipient']}.")
+        elif values["destination_locker"] not in lockers:
+            reject(line, f"No locker base with id or name {values['destination_locker']}.")
+        else:
+            lines[values["tracking_number"]] = line
+            parcels.append(Parcel(
+                recipient_id=recipients[values["recipient"]],
+                destination_locker_id=lockers[values["destination_locker"]],
+                tracking_number=values["tracking_number"],
+                status=ParcelActivity.ActivityType.REGISTER,
+                status_datetime=now
+            ))
+    if not parcels:
+        return 0
+
+    with transaction.atomic():
+        # a parcel registered by someone else since the check above is skipped here, and reported below.
+        Parcel.objects.bulk_create(parcels, ignore_conflicts=True)
+        created = dict(
+            Parcel.objects.filter(tracking_number__in=lines.keys(), status_datetime=now, last_activity__isnull=True).values_list("tracking_number", "id")
+        )
+        ParcelActivity.objects.bulk_create(
+            ParcelActivity(parcel_id=_id, type=ParcelActivity.ActivityType.REGISTER) for _id in created.values()
+        )
+        Parcel.objects.filter(pk__in=created.values()).update(
+            last_activity=Subquery(ParcelActivity.objects.filter(parcel=OuterRef("pk")).values("pk")[:1])
+        )
+    for tracking_number, line in lines.items():
+        if tracking_number not in created:
+            reject(line, f"Tracking number {tracking_number} is already registered.")
+    return len(created)
@@ -0,0 +1,46 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from central.models import ActivityArchive, LockerActivity, Parcel, ParcelActivity, RollupWatermark
+
+
+class Command(BaseCommand):
+    help = "Moves the activities of parcels that were withdrawn or cancelled, and locker activities not associated with any parcel, out of the activity logs and into the compressed archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=90, help="Only archive activity that is older than this many days.")
+        parser.add_argument("--batch-size", type=int, default=500, help="Number of parcels (or locker activities x 10) moved per transaction.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        batch_size = options["batch_size"]
+        # activities the rollups haven't seen yet stay in the logs, or refresh_rollups would never count them.
+        marks = dict(RollupWatermark.objects.values_list("name", "last_id"))
+
+        completed = Parcel.objects.filter(
+            Exists(ParcelActivity.objects.filter(parcel=OuterRef("pk"))),  # skips parcels that are already archived
+            ~Exists(ParcelActivity.objects.filter(
+                parcel=OuterRef("pk"), id__gt=marks.get("parcel_activity", 0),
+                type__in=(ParcelActivity.ActivityType.DEPOSIT, ParcelActivity.ActivityType.WITHDRAW)
+            )),
+            status__in=(ParcelActivity.ActivityType.WITHDRAW, ParcelActivity.ActivityType.CANCEL),
+            status_datetime__lt=cutoff
+        ).order_by("pk").values_list("pk", flat=True)
+        parcels = pa_count = 0
+        while True:
+            ids = list(completed[:batch_size])
+            if not ids:
+                break
+            pa_count += ActivityArchive.archive_parcels(ids)
+            parcels += len(ids)
+        self.stdout.write(f"Archived {pa_count} parcel activities of {parcels} parcels.")
+
+        unassociated = LockerActivity.objects.filter(parcelactivity__isnull=True, datetime__lt=cutoff, id__lte=marks.get("locker_activity", 0)).order_by("pk").values_list("pk", flat=True)
+        la_count = 0
+        while True:
+            ids = list(unassociated[:batch_size * 10])
+            if not ids:
+                break
+            la_count += ActivityArchive.archive_locker_activities(ids)
+        self.stdout.write(self.style.SUCCESS(f"Archived {la_count} locker activities."))
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from collections import Counter
+from django.db.models import Count, Exists, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from central.models import ActivityArchive, LockerActivity, LockerUnit, Parcel, ParcelActivity
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the materialized status columns of every parcel, and the occupancy and capacity index of every locker unit, from the activity logs. "
+        "Parcels whose activities have been archived keep the state they were archived with, and the deposits in the archive still count towards the units."
+    )
+
+    def handle(self, *args, **options):
+        latest = ParcelActivity.objects.filter(parcel=OuterRef("pk")).order_by("-datetime", "-id")
+        latest_deposit = latest.filter(type=ParcelActivity.ActivityType.DEPOSIT)
+        with transaction.atomic():
+            # the latest activity of an archived parcel is only in the archive, see ActivityArchive.archive_parcels().
+            updated = Parcel.objects.filter(Exists(ParcelActivity.objects.filter(parcel=OuterRef("pk")))).update(
+                status=Subquery(latest.values("type")[:1]),
+                status_datetime=Subquery(latest.values("datetime")[:1]),
+                last_activity=Subquery(latest.values("pk")[:1]),
+                current_locker_unit=Subquery(latest_deposit.values("associated_locker_activity__locker_unit")[:1])
+            )
+            # only parcels that are sitting in a locker unit keep their unit.
+            Parcel.objects.exclude(status__in=ParcelActivity.WITHDRAWABLE_STATUSES).update(current_locker_unit=None)
+
+            occupant = Parcel.objects.filter(current_locker_unit=OuterRef("pk"))
+            deposited_at = ParcelActivity.objects.filter(
+                type=ParcelActivity.ActivityType.DEPOSIT,
+                associated_locker_activity__locker_unit=OuterRef("pk"),
+                parcel__current_locker_unit=OuterRef("pk")
+            ).order_by("-datetime")
+            last_register = LockerActivity.objects.filter(locker_unit=OuterRef("pk"), type=LockerActivity.ActivityType.REGISTER).order_by("-datetime")
+            deposits = ParcelActivity.objects.filter(
+                type=ParcelActivity.ActivityType.DEPOSIT, associated_locker_activity__locker_unit=OuterRef("pk")
+            ).order_by().values("associated_locker_activity__locker_unit").annotate(n=Count("pk")).values("n")
+            units = LockerUnit.objects.update(
+                occupying_parcel=Subquery(occupant.values("pk")[:1]),
+                occupied_since=Subquery(deposited_at.values("datetime")[:1]),
+                # registrations that aren't associated with a parcel may have been archived.
+                locker_base=Coalesce(Subquery(last_register.values("locker_base")[:1]), F("locker_base")),
+                deposit_count=Coalesce(Subquery(deposits[:1]), 0)
+            )
+            archived_deposits = Counter()
+            for archive in ActivityArchive.objects.filter(parcel__isnull=False).only("data").iterator():
+                for record in archive.unpack():
+                    if record["type"] == ParcelActivity.ActivityType.DEPOSIT and record["locker_activity"]:
+                        archived_deposits[record["locker_activity"]["locker_unit"]] += 1
+            for unit_id, count in archived_deposits.items():
+                LockerUnit.objects.filter(pk=unit_id).update(deposit_count=F("deposit_count") + count)
+            # the capacity index of the allocator, see LockerUnit.save().
+            locker_units = list(LockerUnit.objects.only("length", "width", "height"))
+            for lu in locker_units:
+                lu.volume = float(lu.length) * float(lu.width) * float(lu.height)
+                lu.size_class = LockerUnit.size_class_of(lu.volume)
+            LockerUnit.objects.bulk_update(locker_units, ["volume", "size_class"], batch_size=1000)
+        self.stdout.write(self.style.SUCCESS(f"Backfilled status of {updated} parcels and occupancy of {units} locker units."))
@@ -0,0 +1,90 @@
+import statistics
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+from django.core.management.base import BaseCommand, CommandError
+from central.models import LockerBase
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends the locker API requests of many simulated locker bases at once to running servers and reports their throughput. "
+        "To compare WSGI and ASGI, start the project under both (e.g. `gunicorn parlock.wsgi` and `uvicorn parlock.asgi:application`) "
+        "against the same database and pass one --server for each."
+    )
+    BASE_NAME = "Parlock @ Benchmark {}"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--server", action="append", required=True, metavar="LABEL=URL", help="A server to benchmark, e.g. asgi=http://127.0.0.1:8001. Can be repeated.")
+        parser.add_argument("--bases", type=int, default=50, help="Number of simulated locker bases sending requests concurrently.")
+        parser.add_argument("--requests", type=int, default=20, help="Number of requests sent one after another by each locker base.")
+        parser.add_argument("--keep", action="store_true", help="Keep the simulated locker bases and their activities afterwards.")
+
+    def handle(self, *args, **options):
+        servers = []
+        for server in options["server"]:
+            label, sep, url = server.partition("=")
+            if not sep:
+                raise CommandError(f"Expected LABEL=URL, got {server}.")
+            servers.append((label, url.rstrip("/")))
+        bases = self.create_bases(options["bases"])
+        try:
+            self.stdout.write(f"{len(bases)} locker bases x {options['requests']} requests")
+            self.stdout.write(f"{'server':<10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>10}")
+            for label, url in servers:
+                elapsed, latencies, errors = self.run(url, bases, options["requests"])
+                latencies.sort()
+                q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else (latencies or [0]) * 99
+                self.stdout.write(
+                    f"{label:<10}{len(latencies) / elapsed:>10.1f}{q[49] * 1000:>10.1f}{q[94] * 1000:>10.1f}{q[98] * 1000:>10.1f}{errors:>10}"
+                )
+        finally:
+            if not options["keep"]:
+                LockerBase.objects.filter(pk__in=[lb.pk for lb in bases]).delete()
+
+    def create_bases(self, count: int):
+        bases = []
+        for i in range(count):
+            lb, created = LockerBase.objects.get_or_create(
+                name=self.BASE_NAME.format(i),
+                defaults={
+                    "street_address": f"{i} Jalan Benchmark", "city": "Subang Jaya", "state": LockerBase.State.SGR, "zip_code": "47500",
+                    "verification_code": f"bench{i:07d}"
+                }
+            )
+            bases.append(lb)
+        return bases
+
+    def run(self, url: str, bases, requests: int):
+        """Sends the requests of every locker base from a thread of its own. Each base alternates between reporting itself online and offline."""
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+        start = threading.Barrier(len(bases) + 1)
+
+        def simulate(lb):
+            nonlocal errors
+            data = urlencode({"verification_code": lb.verification_code}).encode()
+            start.wait()
+            for i in range(requests):
+                activity_type = "offline" if i % 2 else "online"
+                sent = time.perf_counter()
+                try:
+                    with urlopen(f"{url}/api/locker/{lb.id}/{activity_type}/", data=data, timeout=30) as resp:
+                        resp.read()
+                    with lock:
+                        latencies.append(time.perf_counter() - sent)
+                except (HTTPError, URLError, OSError):
+                    with lock:
+                        errors += 1
+
+        threads = [threading.Thread(target=simulate, args=(lb,)) for lb in bases]
+        for t in threads:
+            t.start()
+        start.wait()
+        began = time.perf_counter()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - began, latencies, errors
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from central.importer import format_of, import_parcels, read_rows
+
+
+class Command(BaseCommand):
+    help = "Pre-registers the parcels of a carrier manifest, CSV with a header row or JSON lines, with columns tracking_number, recipient and destination_locker."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The manifest file.")
+        parser.add_argument("--format", choices=("csv", "jsonl"), help="Guessed from the file extension if left out.")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of rows validated and written together.")
+
+    def handle(self, *args, **options):
+        def on_error(line, message):
+            self.stderr.write(f"line {line}: {message}")
+
+        try:
+            with open(options["path"], "rb") as f:
+                result = import_parcels(read_rows(f, options["format"] or format_of(options["path"])), batch_size=options["batch_size"], on_error=on_error)
+        except OSError as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f"Registered {result.created} of {result.rows} parcels, {result.error_count} rows rejected."))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from central.models import ActivityRollup
+
+
+class Command(BaseCommand):
+    help = "Folds the activities recorded since the last run into the hourly and daily rollups read by the operations dashboard. Meant to be run every few minutes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000, help="Number of activities folded per transaction.")
+
+    def handle(self, *args, **options):
+        processed = ActivityRollup.refresh(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {processed} activities."))
@@ -0,0 +1,90 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from central.models import LockerBase, LockerUnit, Parcel, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulates parcels arriving at and leaving a locker base and compares the best-fit allocator with first fit. "
+        "Reports the share of parcels that found no unit and the allocation latency. Runs in a transaction that is rolled back."
+    )
+    # (length, width, height) in mm and share of the units of a base, a mix of shallow to tall units of the same footprint.
+    UNIT_TYPES = (
+        ((450, 350, 120), 0.40),
+        ((450, 350, 250), 0.30),
+        ((450, 350, 400), 0.20),
+        ((600, 450, 600), 0.10),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--units", type=int, default=40, help="Number of locker units of the simulated base.")
+        parser.add_argument("--steps", type=int, default=2000, help="Number of arrivals and departures simulated.")
+        parser.add_argument("--occupancy", type=float, default=0.8, help="Share of the units that are occupied on average.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        results = {}
+        for policy in ("first-fit", "best-fit"):
+            with transaction.atomic():
+                results[policy] = self.simulate(policy, options)
+                transaction.set_rollback(True)
+        self.stdout.write(f"{options['units']} units, {options['steps']} steps, {options['occupancy']:.0%} target occupancy")
+        self.stdout.write(f"{'policy':<10}{'parcels':>9}{'rejected':>10}{'p50 ms':>9}{'p99 ms':>9}")
+        for policy, (parcels, rejected, latencies) in results.items():
+            q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else (latencies or [0]) * 99
+            self.stdout.write(f"{policy:<10}{parcels:>9}{rejected / max(parcels, 1):>10.1%}{q[49] * 1000:>9.2f}{q[98] * 1000:>9.2f}")
+
+    @staticmethod
+    def parcel_size(rng: random.Random):
+        """Courier parcels: most are small boxes and envelopes, with a long tail of large boxes."""
+        length = min(rng.lognormvariate(5.5, 0.4), 700)  # median of about 245 mm
+        width = length * rng.uniform(0.5, 0.9)
+        height = min(width * rng.uniform(0.1, 0.8), 650)
+        return length, width, height
+
+    def simulate(self, policy: str, options):
+        rng = random.Random(options["seed"])
+        sizes = random.Random(options["seed"] + 1)  # separate, so that both policies see the same parcels in the same order
+        user = User.objects.create_user("simulate_allocation", "simulate_allocation@example.com")
+        lb = LockerBase.objects.create(
+            name="Parlock @ Simulation", street_address="1 Jalan Simulasi", city="Subang Jaya", state=LockerBase.State.SGR, zip_code="47500",
+            verification_code=LockerBase.generate_new_v_code()
+        )
+        dims = rng.choices([d for d, share in self.UNIT_TYPES], weights=[share for d, share in self.UNIT_TYPES], k=options["units"])
+        for length, width, height in dims:
+            LockerUnit(length=length, width=width, height=height, locker_base=lb).save()
+        placeholder = Parcel.objects.create(recipient=user, destination_locker=lb, tracking_number="SIMULATION")
+
+        occupied = []
+        parcels = rejected = 0
+        latencies = []
+        for step in range(options["steps"]):
+            # arrivals outnumber departures while the base is emptier than the target.
+            if occupied and rng.random() < len(occupied) / (options["units"] * options["occupancy"]) / 2:
+                lu = occupied.pop(rng.randrange(len(occupied)))
+                LockerUnit.objects.filter(pk=lu.pk).update(occupying_parcel=None, occupied_since=None)
+                continue
+            parcels += 1
+            size = self.parcel_size(sizes)
+            started = time.perf_counter()
+            lu = lb.allocate(*size) if policy == "best-fit" else self.first_fit(lb, size)
+            latencies.append(time.perf_counter() - started)
+            if lu is None:
+                rejected += 1
+                continue
+            # stands in for the DEPOSIT activity, see Parcel.apply_activity().
+            LockerUnit.objects.filter(pk=lu.pk).update(occupying_parcel=placeholder, deposit_count=F("deposit_count") + 1, reserved_for=None, reserved_until=None)
+            occupied.append(lu)
+        return parcels, rejected, latencies
+
+    @staticmethod
+    def first_fit(lb: LockerBase, size):
+        """What the locker base used to do: the first free unit by id that the parcel fits in."""
+        for lu in LockerUnit.objects.filter(locker_base=lb, occupying_parcel__isnull=True).order_by("id"):
+            if lu.fits(*size):
+                return lu
+        return None
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from simulator import clear_fleet, run_fleet, seed_fleet
+from simulator.server import local_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds locker bases with units and parcels, then runs a virtual locker base for each at once, going through the requests a real base sends for every parcel. "
+        "Reports the latency and throughput of each activity type. Without --server the project is served from this process, "
+        "so `PARLOCK_DB=sqlite python manage.py migrate --run-syncdb` followed by `PARLOCK_DB=sqlite python manage.py simulate_fleet` works offline. "
+        "A --server has to use the same database as this command."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--server", help="URL of a running server, e.g. http://127.0.0.1:8000. Served from this process if left out.")
+        parser.add_argument("--bases", type=int, default=20, help="Number of virtual locker bases sending requests concurrently.")
+        parser.add_argument("--units", type=int, default=12, help="Number of locker units of each base.")
+        parser.add_argument("--parcels", type=int, default=20, help="Number of parcels delivered to and collected from each base.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--keep", action="store_true", help="Keep the seeded locker bases and their activities afterwards.")
+
+    def handle(self, *args, **options):
+        specs = seed_fleet(options["bases"], options["units"], options["parcels"], seed=options["seed"])
+        try:
+            if options["server"]:
+                elapsed, stats = run_fleet(options["server"].rstrip("/"), specs, seed=options["seed"])
+            else:
+                with local_server() as url:
+                    elapsed, stats = run_fleet(url, specs, seed=options["seed"])
+        finally:
+            if not options["keep"]:
+                clear_fleet()
+        self.report(options, elapsed, stats)
+
+    def report(self, options, elapsed: float, stats: dict):
+        self.stdout.write(
+            f"{options['bases']} locker bases x {options['parcels']} parcels, {options['units']} units each, "
+            f"on {settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1]}, {elapsed:.1f} s"
+        )
+        self.stdout.write(f"{'activity':<16}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'rejected':>10}{'errors':>10}")
+        total = rejected = errors = 0
+        for activity_type, s in stats.items():
+            summary = s.latency.summary(scale=1000)
+            total += summary["count"]
+            rejected += s.rejected
+            errors += s.errors
+            self.stdout.write(
+                f"{activity_type:<16}{summary['count']:>10}{summary['count'] / elapsed:>10.1f}"
+                f"{summary['p50']:>10.1f}{summary['p99']:>10.1f}{summary['max']:>10.1f}{s.rejected:>10}{s.errors:>10}"
+            )
+        self.stdout.write(f"{'total':<16}{total:>10}{total / elapsed:>10.1f}{'':>30}{rejected:>10}{errors:>10}")
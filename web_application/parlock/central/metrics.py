@@ -0,0 +1,200 @@
+"""
+Per-view request metrics kept in memory: database query count, total SQL time and wall time, each in a histogram with bounded relative error.
+Queries are counted through an execute wrapper installed on every database connection as it is created. The request being measured is held in a context variable, so queries run by async views in worker threads are counted as well.
+Every process keeps its own histograms, see the metrics view.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import asyncio
+import threading
+import time
+
+
+class Histogram:
+    """
+    An HDR-style histogram of non-negative integers. Values below 2 ** SUB_BUCKET_BITS are counted exactly, larger ones in buckets that are at most 1 / 2 ** (SUB_BUCKET_BITS - 1) of their value wide.
+    Memory grows with the number of distinct buckets used, i.e. with the logarithm of the largest value.
+    """
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def bucket_of(value: int) -> int:
+        shift = value.bit_length() - Histogram.SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        half = 1 << (Histogram.SUB_BUCKET_BITS - 1)
+        return (1 << Histogram.SUB_BUCKET_BITS) + (shift - 1) * half + (value >> shift) - half
+
+    @staticmethod
+    def highest_equivalent(bucket: int) -> int:
+        """The largest value counted in the bucket."""
+        size = 1 << Histogram.SUB_BUCKET_BITS
+        if bucket < size:
+            return bucket
+        half = size >> 1
+        shift = (bucket - size) // half + 1
+        top = (bucket - size) % half + half
+        return ((top + 1) << shift) - 1
+
+    def record(self, value: int):
+        value = max(int(value), 0)
+        bucket = Histogram.bucket_of(value)
+        with self.lock:
+            self.counts[bucket] = self.counts.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p: float) -> int:
+        with self.lock:
+            if not self.count:
+                return 0
+            rank = max(1, round(p / 100 * self.count))
+            seen = 0
+            for bucket in sorted(self.counts):
+                seen += self.counts[bucket]
+                if seen >= rank:
+                    return min(Histogram.highest_equivalent(bucket), self.max)
+            return self.max
+
+    def summary(self, scale: float = 1) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count / scale if self.count else 0,
+            "p50": self.percentile(50) / scale,
+            "p90": self.percentile(90) / scale,
+            "p99": self.percentile(99) / scale,
+            "max": (self.max or 0) / scale,
+        }
+
+
+class RequestSample:
+    """The measurements of a single request."""
+
+    def __init__(self):
+        self.view = None
+        self.queries = 0
+        self.sql_ns = 0
+        self.wall_ns = 0
+
+    def __repr__(self) -> str:
+        return f"RequestSample(view={self.view}, queries={self.queries}, sql_ms={self.sql_ns / 1e6:.2f}, wall_ms={self.wall_ns / 1e6:.2f})"
+
+
+class Registry:
+    """Histograms of query count, SQL time and wall time (both in microseconds) per view."""
+
+    def __init__(self):
+        self.views = {}
+        self.lock = threading.Lock()
+        self.listeners = []
+
+    def record(self, sample: RequestSample):
+        with self.lock:
+            histograms = self.views.setdefault(sample.view, {"queries": Histogram(), "sql_us": Histogram(), "wall_us": Histogram()})
+            listeners = list(self.listeners)
+        histograms["queries"].record(sample.queries)
+        histograms["sql_us"].record(sample.sql_ns // 1000)
+        histograms["wall_us"].record(sample.wall_ns // 1000)
+        for listener in listeners:
+            listener.append(sample)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            views = dict(self.views)
+        return {
+            view: {"queries": h["queries"].summary(), "sql_ms": h["sql_us"].summary(scale=1000), "wall_ms": h["wall_us"].summary(scale=1000)}
+            for view, h in sorted(views.items(), key=lambda item: -item[1]["wall_us"].total)
+        }
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+
+    @contextmanager
+    def capture(self):
+        """Collects the samples of the requests finished within the block, for tests."""
+        samples = []
+        with self.lock:
+            self.listeners.append(samples)
+        try:
+            yield samples
+        finally:
+            with self.lock:
+                self.listeners.remove(samples)
+
+
+registry = Registry()
+_current = ContextVar("parlock_request_sample", default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    sample = _current.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter_ns()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.queries += 1
+        sample.sql_ns += time.perf_counter_ns() - started
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """connection_created handler, see CentralConfig.ready()."""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def view_name(request) -> str:
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "<unresolved>"
+    return match.view_name or match._func_path
+
+
+class MetricsMiddleware:
+    """Measures every request and records it in the registry under the name of the view that handled it. Works for both sync and async views."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django that __call__ returns a coroutine, like MiddlewareMixin does.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        sample = RequestSample()
+        token = _current.set(sample)
+        started = time.perf_counter_ns()
+        try:
+            return self.get_response(request)
+        finally:
+            self.finish(request, sample, started, token)
+
+    async def __acall__(self, request):
+        sample = RequestSample()
+        token = _current.set(sample)
+        started = time.perf_counter_ns()
+        try:
+            return await self.get_response(request)
+        finally:
+            self.finish(request, sample, started, token)
+
+    def finish(self, request, sample: RequestSample, started: int, token):
+        sample.wall_ns = time.perf_counter_ns() - started
+        _current.reset(token)
+        sample.view = view_name(request)
+        registry.record(sample)
@@ -1,9 +1,21 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField, TrigramSimilarity
+from django.core.cache import cache, caches
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import models
+from django.db import DatabaseError, connections, models, router, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from .search import has_trigram
+from . import geo
 from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser
 )
+import hmac
+import json
+import math
+from collections import Counter
+import re
+import zlib
 import secrets
 import string
 import logging
@@ -59,9 +71,18 @@ class User(AbstractBaseUser):
         return self.is_admin
 
     def parcels(self):
-        p_list = [parcel for parcel in Parcel.objects.filter(recipient=self)]
-        p_list.sort(key=lambda p: p.last_seen_activity().datetime, reverse=True)
-        return p_list
+        return Parcel.objects.filter(recipient=self).select_related("destination_locker").order_by("-status_datetime")
+
+    def in_progress_parcels(self):
+        return Parcel.objects.filter(~Q(status__in=Parcel.COMPLETE_STATUSES), recipient=self)
+
+    def completed_parcels(self):
+        return Parcel.objects.filter(recipient=self, status__in=Parcel.COMPLETE_STATUSES)
+
+    def most_used_locker(self):
+        """The locker base the user has had the most parcels sent to, counted by the database."""
+        top = Parcel.objects.filter(recipient=self).values("destination_locker").annotate(n=Count("id")).order_by("-n", "destination_locker")[:1]
+        return LockerBase.objects.filter(pk__in=top.values("destination_locker")).first()
 
 
 class LockerUnit(models.Model):
@@ -69,6 +90,24 @@ class LockerUnit(models.Model):
     length = models.DecimalField(max_digits=6, decimal_places=3)
     width = models.DecimalField(max_digits=6, decimal_places=3)
     height = models.DecimalField(max_digits=6, decimal_places=3)
+    locker_base = models.ForeignKey("LockerBase", null=True, on_delete=models.SET_NULL, related_name="locker_units")  # the base the unit last registered with
+    # occupancy projection, kept up to date by deposit and withdraw activities. see Parcel.apply_activity().
+    occupying_parcel = models.ForeignKey("Parcel", null=True, on_delete=models.SET_NULL, related_name="+")
+    occupied_since = models.DateTimeField(null=True)
+    # capacity index used by LockerBase.allocate(). volume and size class are derived from the dimensions on save.
+    volume = models.FloatField(null=True, editable=False)
+    size_class = models.PositiveSmallIntegerField(null=True, editable=False)
+    deposit_count = models.PositiveIntegerField(default=0, editable=False)  # for wear levelling
+    reserved_for = models.ForeignKey("Parcel", null=True, on_delete=models.SET_NULL, related_name="+")  # allocated, but not deposited into yet
+    reserved_until = models.DateTimeField(null=True)
+
+    CLEARANCE = 0.85  # share of each dimension of the unit a parcel may take up, follows Dimtaker.test_fit() of the locker base
+    RESERVATION_TIMEOUT = timedelta(minutes=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["locker_base", "size_class", "deposit_count"], condition=Q(occupying_parcel__isnull=True), name="lu_free_capacity_idx"),
+        ]
 
     def __repr__(self):
         return f"LockerUnit(id={self.id}, length={self.length}, width={self.width}, height={self.height})"
@@ -78,20 +117,35 @@ class LockerUnit(models.Model):
 
     @property
     def is_available(self):
-        la = LockerActivity.objects.filter(locker_unit=self).latest("datetime")
-        if not la:
-            return None
-        else:
-            # when is a locker unit considered available? there are no parcels inside it.
-            # how to check if there are no parcels inside it?
-            # 1. when the last parcel activity is not LOCK
-            # 2. when the last parcel activity is LOCK, but the associating parcel activity is WITHDRAW.
-            if la.type != LockerActivity.ActivityType.LOCK:
-                return True
-            elif la.associated_parcel_activity().type == ParcelActivity.ActivityType.WITHDRAW:
-                return True
-            else:
-                return False
+        # when is a locker unit considered available? there are no parcels inside it.
+        # a parcel occupies the unit from its DEPOSIT until its WITHDRAW (or CANCEL).
+        return self.occupying_parcel_id is None
+
+    @staticmethod
+    def size_class_of(volume: float) -> int:
+        """Units are grouped in classes of doubling volume. Units of the same class are interchangeable enough to spread the wear between them."""
+        return max(math.ceil(math.log2(volume)), 0) if volume > 0 else 0
+
+    def fits(self, length: float, width: float, height: float) -> bool:
+        """Can a parcel of these dimensions fit in any orientation? Sorting both sets of dimensions covers every orientation at once."""
+        usable = sorted(float(d) * LockerUnit.CLEARANCE for d in (self.length, self.width, self.height))
+        return all(p < u for p, u in zip(sorted((length, width, height)), usable))
+
+    def save(self, *args, **kwargs):
+        self.volume = float(self.length) * float(self.width) * float(self.height)
+        self.size_class = LockerUnit.size_class_of(self.volume)
+        if kwargs.get("update_fields") is not None and {"length", "width", "height"} & set(kwargs["update_fields"]):
+            kwargs["update_fields"] = {*kwargs["update_fields"], "volume", "size_class"}
+        super().save(*args, **kwargs)
+
+    def availability(self) -> dict:
+        return {
+            "id": self.id,
+            "length": self.length,
+            "width": self.width,
+            "height": self.height,
+            "is_available": self.is_available
+        }
 
 
 class LockerBase(models.Model):
@@ -119,6 +173,21 @@ class LockerBase(models.Model):
     state = models.CharField(choices=State.choices, null=False, max_length=64)
     zip_code = models.CharField(unique=False, null=False, max_length=5)
     verification_code = models.CharField(unique=True, null=False, max_length=12)
+    # keys the retrieval codes of parcels bound for this base are signed with, shared with the base so that it can verify them offline. rotated with the verification code.
+    retrieval_key = models.CharField(max_length=64, blank=True, default="")
+    previous_retrieval_key = models.CharField(max_length=64, blank=True, default="")
+    latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    search_vector = SearchVectorField(null=True, editable=False)  # PostgreSQL only, refreshed on save. the GIN indexes live in search.py.
+
+    SEARCH_FIELDS = ("name", "street_address", "city", "state", "zip_code")
+    # the simple configuration doesn't stem, so prefixes of names and streets still match as they are typed.
+    SEARCH_VECTOR = (
+        SearchVector("name", weight="A", config="simple")
+        + SearchVector("street_address", weight="B", config="simple")
+        + SearchVector("city", "state", "zip_code", weight="C", config="simple")
+    )
+    AUTH_CACHE_TIMEOUT = 300  # seconds an identity is kept in the shared cache. the per-process cache has its own, much shorter, timeout.
 
     def __str__(self):
         return self.name
@@ -130,13 +199,139 @@ class LockerBase(models.Model):
     def address(self):
         return f"{self.street_address}, {self.zip_code} {self.city}, {self.State(self.state).label}"
 
-    def nearby(self):
-        return [lb for lb in LockerBase.objects.filter(zip_code=self.zip_code)[:3]]
+    def nearby(self, k: int = 3):
+        """Other locker bases closest to this one that still have a free locker unit. Falls back to bases sharing the zip code if this base has no coordinates."""
+        if self.latitude is None or self.longitude is None:
+            return [lb for lb in LockerBase.objects.filter(zip_code=self.zip_code).exclude(pk=self.pk)[:k]]
+        return LockerBase.nearest(self.latitude, self.longitude, k=k, exclude=self.pk)
+
+    @staticmethod
+    def nearest(latitude: float, longitude: float, k: int = 3, free_capacity: bool = True, exclude: int = None):
+        """
+        The k locker bases closest to the coordinates, closest first, each with a distance attribute in km.
+        With free_capacity, bases without an unoccupied locker unit are skipped. Candidates are taken from the in-memory index in growing batches, and each batch is checked for capacity with a single query.
+        """
+        index = geo.get_index()
+        batch = k * 4
+        while True:
+            candidates = [(d, _id) for d, _id in index.nearest(latitude, longitude, k=batch) if _id != exclude]
+            ids = [_id for d, _id in candidates]
+            if free_capacity:
+                free = set(LockerUnit.objects.filter(locker_base__in=ids, occupying_parcel__isnull=True).values_list("locker_base", flat=True).distinct())
+                candidates = [(d, _id) for d, _id in candidates if _id in free]
+            if len(candidates) >= k or batch >= index.size:
+                break
+            batch *= 4
+        candidates = candidates[:k]
+        bases = LockerBase.objects.in_bulk([_id for d, _id in candidates])
+        results = []
+        for d, _id in candidates:
+            if _id in bases:
+                bases[_id].distance = round(d, 2)
+                results.append(bases[_id])
+        return results
 
     @staticmethod
     def verify(v_code: str):
         return LockerBase.objects.get(verification_code=v_code)
 
+    @staticmethod
+    def auth_cache_key(locker_id: int) -> str:
+        return f"lockerbase:auth:{locker_id}"
+
+    @staticmethod
+    def authenticate(locker_id: int, v_code: str):
+        """
+        Returns the locker base if the verification code belongs to it, None otherwise.
+        The identity is looked up in the per-process cache, then the shared cache, and only then the database. Entries are dropped whenever the locker base is saved or deleted,
+        but that only reaches the per-process cache of the process that saved it, so a code that doesn't match a cached entry is checked again further down, up to the database.
+        """
+        def matches(lb):
+            return lb is not None and hmac.compare_digest(lb.verification_code.encode(), v_code.encode())
+
+        key = LockerBase.auth_cache_key(locker_id)
+        lb = caches["local"].get(key)
+        if matches(lb):
+            return lb
+        caches["local"].delete(key)
+        lb = cache.get(key)
+        if not matches(lb):
+            try:
+                lb = LockerBase.objects.get(pk=locker_id)
+            except LockerBase.DoesNotExist:
+                return None
+            cache.set(key, lb, LockerBase.AUTH_CACHE_TIMEOUT)
+            if not matches(lb):
+                return None
+        caches["local"].set(key, lb)
+        return lb
+
+    @staticmethod
+    def invalidate_auth_cache(locker_id: int):
+        key = LockerBase.auth_cache_key(locker_id)
+        caches["local"].delete(key)
+        cache.delete(key)
+
+    @staticmethod
+    def search(keyword: str, limit: int = None):
+        """Ranked search over the stored search vector. Every word is matched as a prefix, and names are also matched by trigram similarity where pg_trgm is installed."""
+        words = [w for w in re.split(r"\W+", keyword) if w]
+        if not words:
+            return LockerBase.objects.none()
+        query = SearchQuery(" & ".join(f"{w}:*" for w in words), search_type="raw", config="simple")
+        rank = SearchRank(F("search_vector"), query)
+        condition = Q(search_vector=query)
+        if has_trigram():
+            rank = rank + TrigramSimilarity("name", keyword)
+            condition = condition | Q(name__trigram_similar=keyword)
+        results = LockerBase.objects.filter(condition).annotate(rank=rank).order_by("-rank", "name")
+        return results[:limit] if limit else results
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and not self.retrieval_key:
+            self.retrieval_key = LockerBase.generate_retrieval_key()
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if connections[self._state.db].vendor == "postgresql" and (update_fields is None or set(update_fields) & set(LockerBase.SEARCH_FIELDS)):
+            LockerBase.objects.using(self._state.db).filter(pk=self.pk).update(search_vector=LockerBase.SEARCH_VECTOR)
+        if update_fields is None or {"latitude", "longitude"} & set(update_fields):
+            transaction.on_commit(geo.invalidate)
+        # invalidating after commit stops a concurrent request from caching the old row again.
+        pk = self.pk
+        transaction.on_commit(lambda: LockerBase.invalidate_auth_cache(pk))
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: LockerBase.invalidate_auth_cache(pk))
+        transaction.on_commit(geo.invalidate)
+        return result
+
+    def allocate(self, length: float, width: float, height: float, parcel=None):
+        """
+        Reserves the best fitting free locker unit of the base for a parcel of these dimensions and returns it, or None if no unit fits.
+        The smallest size class that fits wins, and within a class the least used unit, so that large units stay free for large parcels and the wear is spread out.
+        A unit stays reserved for the parcel for RESERVATION_TIMEOUT, or until the parcel is deposited.
+        """
+        now = timezone.now()
+        required = length * width * height / LockerUnit.CLEARANCE ** 3
+        with transaction.atomic():
+            if parcel is not None:
+                # a base asking again for the same parcel gets a new unit, the old one is given back.
+                LockerUnit.objects.filter(reserved_for=parcel).update(reserved_for=None, reserved_until=None)
+            candidates = (
+                LockerUnit.objects.filter(locker_base=self, occupying_parcel__isnull=True, size_class__gte=LockerUnit.size_class_of(required), volume__gte=required)
+                .filter(Q(reserved_until__isnull=True) | Q(reserved_until__lt=now))
+                .order_by("size_class", "deposit_count", "volume", "id")
+                .select_for_update(skip_locked=True)
+            )
+            for lu in candidates.iterator(chunk_size=32):
+                if lu.fits(length, width, height):
+                    lu.reserved_for, lu.reserved_until = parcel, now + LockerUnit.RESERVATION_TIMEOUT
+                    lu.save(update_fields=["reserved_for", "reserved_until"])
+                    return lu
+        return None
+
     def add_activity(self, *, activity_type: int, locker_unit: LockerUnit = None):
         la = LockerActivity(locker_base=self, locker_unit=locker_unit, type=activity_type)
         la.save()
@@ -148,11 +343,28 @@ class LockerBase(models.Model):
         v_code = ''.join(secrets.choice(a_list) for i in range(12))
         return v_code
 
+    @staticmethod
+    def generate_retrieval_key():
+        return secrets.token_hex(32)
+
+    def retrieval_keys(self) -> list:
+        """The keys retrieval codes are accepted with, current key first. Generates the first key of a base that was created before keys were."""
+        if not self.retrieval_key:
+            # only the first of two concurrent requests gets to set the key, the other one reads it back.
+            if LockerBase.objects.filter(pk=self.pk, retrieval_key="").update(retrieval_key=LockerBase.generate_retrieval_key()):
+                pk = self.pk
+                transaction.on_commit(lambda: LockerBase.invalidate_auth_cache(pk))
+            self.retrieval_key = LockerBase.objects.values_list("retrieval_key", flat=True).get(pk=self.pk)
+        return [key for key in (self.retrieval_key, self.previous_retrieval_key) if key]
+
     def change_v_code(self):
         new_v_code = LockerBase.generate_new_v_code()
         if new_v_code != self.verification_code:
             self.verification_code = new_v_code
-            self.save()
+            # codes signed with the old key stay valid until they expire.
+            self.previous_retrieval_key = self.retrieval_key
+            self.retrieval_key = LockerBase.generate_retrieval_key()
+            self.save(update_fields=["verification_code", "retrieval_key", "previous_retrieval_key"])  # also drops the cached identity of the old code
             la = self.add_activity(activity_type=LockerActivity.ActivityType.CHANGE_V_CODE, locker_unit=None)
             return la
         else:
@@ -180,10 +392,17 @@ class LockerActivity(models.Model):
         CHANGE_V_CODE = 9, "CHANGE_V_CODE"  # changing the verification code of the locker base.
 
     locker_base = models.ForeignKey(LockerBase, null=False, on_delete=models.CASCADE)
-    locker_unit = models.ForeignKey(LockerUnit, null=True, on_delete=models.CASCADE)  # important! not every activity has to involve a locker unit!
+    locker_unit = models.ForeignKey(LockerUnit, null=True, on_delete=models.CASCADE, db_index=False)  # important! not every activity has to involve a locker unit!
     type = models.PositiveSmallIntegerField(choices=ActivityType.choices, null=False)
     datetime = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # the log is append-only and read as "latest by locker unit" and "global latest", the composite index covers the locker unit foreign key as well.
+        indexes = [
+            models.Index(fields=["locker_unit", "-datetime"], name="la_unit_datetime_idx"),
+            models.Index(fields=["-datetime"], name="la_datetime_idx"),
+        ]
+
     def __repr__(self) -> str:
         return f"LockerActivity(id={self.id}, locker_base={self.locker_base.name}, locker_unit={self.locker_unit}, type={LockerActivity.ActivityType(self.type).label})"
 
@@ -191,101 +410,235 @@ class LockerActivity(models.Model):
         return self.ActivityType(self.type).label
 
     def associated_parcel_activity(self):
-        return ParcelActivity.objects.get(associated_locker_activity=self)
+        # goes through the reverse relation so that a prefetch_related("parcelactivity_set") is used when there is one.
+        pa_list = list(self.parcelactivity_set.all())
+        if not pa_list:
+            raise ParcelActivity.DoesNotExist(f"No parcel activity is associated with {repr(self)}.")
+        return pa_list[0]
 
     def associated_parcel(self):
         return self.associated_parcel_activity().parcel
 
 
+class ParcelActivityType(models.IntegerChoices):
+    """The types of ParcelActivity, defined ahead of Parcel so that its indexes can name them. Read them as ParcelActivity.ActivityType."""
+
+    REGISTER = 1, "REGISTER"  # when the parcel is registered into the system
+    QUERY = 2, "QUERY"  # associated with SCANQRPARCEL
+    CHECKIN = 3, "CHECKIN"  # associated with SCANDIM
+    DEPOSITREQ = 4, "DEPOSITREQ"  # associated with UNLOCK
+    DEPOSIT = 5, "DEPOSIT"  # associated with LOCK
+    WITHDRAWAPP = 6, "WITHDRAWAPP"  # added when user clicks on the option to generate qr code, only type that uses qr_data
+    WITHDRAWQR = 7, "WITHDRAWQR"  # associated with SCANQRRECIPIENT
+    WITHDRAWREQ = 8, "WITHDRAWREQ"  # associated with UNLOCK
+    WITHDRAW = 9, "WITHDRAW"  # associated with LOCK
+    CANCEL = 10, "CANCEL"  # a label that shows the parcel as not being able to arrive, tracking number is *not* released
+
+
+# the statuses a parcel ends in.
+COMPLETE_STATUSES = (ParcelActivityType.WITHDRAW, ParcelActivityType.CANCEL)
+
+
 class Parcel(models.Model):
     """A parcel item to be registered within the system. Is dimension."""
     recipient = models.ForeignKey(User, on_delete=models.CASCADE)
     destination_locker = models.ForeignKey(LockerBase, on_delete=models.CASCADE)
     tracking_number = models.CharField(null=False, unique=True, max_length=32)  # value to be verified with qr
+    # materialized state of the latest parcel activity, kept in step by ParcelActivity.save() so that listing parcels doesn't need to go through the activity log.
+    status = models.PositiveSmallIntegerField(null=True)
+    status_datetime = models.DateTimeField(null=True)
+    # NULL once the activities of the parcel are archived, see ActivityArchive.archive_parcels(). status and status_datetime are kept, last_seen_activity() reads the archive.
+    last_activity = models.ForeignKey("ParcelActivity", null=True, on_delete=models.SET_NULL, related_name="+")
+    current_locker_unit = models.ForeignKey(LockerUnit, null=True, on_delete=models.SET_NULL, related_name="+")  # where the parcel currently sits, if deposited
+
+    COMPLETE_STATUSES = COMPLETE_STATUSES
+
+    class Meta:
+        # one index per tab of the parcel list, each read in keyset order. see Parcel.page().
+        indexes = [
+            models.Index(fields=["recipient", "-status_datetime", "-id"], condition=~Q(status__in=COMPLETE_STATUSES), name="parcel_recipient_open_idx"),
+            models.Index(fields=["recipient", "-status_datetime", "-id"], condition=Q(status__in=COMPLETE_STATUSES), name="parcel_recipient_done_idx"),
+        ]
+
+    EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    RETRIEVAL_CODE_TTL = 15 * 60  # seconds
+    MAX_OFFLINE_SKEW = 6 * 60 * 60  # seconds a locker base may report a code it accepted while offline after the fact
+    RETRIEVAL_SIGNATURE_LENGTH = 32  # hex digits of the HMAC-SHA256 kept in the code, short enough for a small QR code
 
     def __repr__(self) -> str:
         return f"Parcel(recipient={self.recipient.username}, destination_locker={self.destination_locker.name}, tracking_number={self.tracking_number})"
 
     def last_seen_activity(self):
-        return ParcelActivity.objects.filter(parcel=self).latest("datetime")
+        """The latest activity of the parcel, from the archive when its activities have been moved there. Raises ParcelActivity.DoesNotExist for a parcel without any."""
+        try:
+            return ParcelActivity.objects.filter(parcel=self).latest("datetime", "id")
+        except ParcelActivity.DoesNotExist:
+            archived = self.activities()
+            if not archived:
+                raise
+            return max(archived, key=lambda pa: (pa.datetime, pa.id))
 
     def activities(self):
-        return [pa for pa in ParcelActivity.objects.filter(parcel=self).order_by("-datetime")]
+        """The full history of the parcel, latest first, including activities that have been moved to the archive."""
+        pa_list = [pa for pa in ParcelActivity.objects.filter(parcel=self).select_related("associated_locker_activity__locker_base").order_by("-datetime")]
+        archived = ActivityArchive.objects.filter(parcel=self)
+        if archived:
+            pa_list.extend(pa for archive in archived for pa in archive.parcel_activities())
+            pa_list.sort(key=lambda pa: pa.datetime, reverse=True)
+        return pa_list
+
+    def get_status_str(self):
+        return ParcelActivity.ActivityType(self.status).label if self.status else None
 
     def can_be_withdrawn(self) -> bool:
-        return 5 <= self.last_seen_activity().type < 9
+        return self.status in ParcelActivity.WITHDRAWABLE_STATUSES
 
     def is_complete(self) -> bool:
-        return self.last_seen_activity().type in (9, 10)
+        return self.status is not None and not ParcelActivity.TRANSITIONS[self.status]
+
+    def can_transition_to(self, activity_type: int) -> bool:
+        """Can the activity follow the latest one of the parcel? Checked against the materialized status, see ParcelActivity.TRANSITIONS."""
+        return activity_type in ParcelActivity.TRANSITIONS.get(self.status, ())
+
+    def keyset_cursor(self) -> str:
+        """Position of the parcel in the (status_datetime, id) order of the parcel list, as microseconds since the epoch and id."""
+        return f"{(self.status_datetime - Parcel.EPOCH) // timedelta(microseconds=1)}.{self.id}"
+
+    @staticmethod
+    def page(queryset, after: str = None, limit: int = 20):
+        """
+        The parcels of the queryset that come after the cursor in (status_datetime, id) order, latest first, and the cursor of the next page (None on the last page).
+        Reads the same number of rows wherever the page is, unlike an offset.
+        """
+        parcels = list(Parcel.page_queryset(queryset, after).select_related("destination_locker")[:limit + 1])
+        return parcels[:limit], parcels[limit - 1].keyset_cursor() if len(parcels) > limit else None
+
+    @staticmethod
+    def page_queryset(queryset, after: str = None):
+        queryset = queryset.exclude(status_datetime__isnull=True).order_by("-status_datetime", "-id")
+        if after:
+            try:
+                us, _id = (int(v) for v in after.split("."))
+            except ValueError:
+                raise ValidationError("Invalid cursor.")
+            ts = Parcel.EPOCH + timedelta(microseconds=us)
+            # the outer condition is the one the index is scanned by, the inner one only has to skip the ties.
+            queryset = queryset.filter(Q(status_datetime__lte=ts), Q(status_datetime__lt=ts) | Q(id__lt=_id))
+        return queryset
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "tracking_number": self.tracking_number,
+            "status": self.status,
+            "status_str": self.get_status_str(),
+            "status_datetime": self.status_datetime,
+            "can_be_withdrawn": self.can_be_withdrawn(),
+            "destination_locker": {"id": self.destination_locker.id, "name": self.destination_locker.name, "address": self.destination_locker.address},
+        }
 
     def make_retrieval_code(self) -> str:
-        assert self.can_be_withdrawn(), "Cannot be withdrawn!"
-        ts = self.last_seen_activity().datetime.timestamp()
-        return f"withdraw_{self.last_seen_activity().id}_{int(ts)}"
+        """
+        A retrieval code of the form withdraw_<parcel id>_<unit id>_<expiry>_<signature>, signed with the key of the destination locker.
+        The locker base can check it without asking the webserver. See verify_retrieval_code() and utils/retrieval.py of the locker base.
+        """
+        assert self.can_be_withdrawn() and self.current_locker_unit_id, "Cannot be withdrawn!"
+        expiry = int(timezone.now().timestamp()) + Parcel.RETRIEVAL_CODE_TTL
+        key = self.destination_locker.retrieval_keys()[0]
+        return f"withdraw_{self.id}_{self.current_locker_unit_id}_{expiry}_{Parcel.sign_retrieval_code(key, self.id, self.current_locker_unit_id, expiry)}"
+
+    @staticmethod
+    def sign_retrieval_code(key: str, parcel_id: int, unit_id: int, expiry: int) -> str:
+        message = f"withdraw_{parcel_id}_{unit_id}_{expiry}".encode()
+        return hmac.new(key.encode(), message, "sha256").hexdigest()[:Parcel.RETRIEVAL_SIGNATURE_LENGTH]
+
+    def apply_activity(self, pa):
+        """Moves the materialized state of the parcel and the occupancy of its locker unit forward to the supplied parcel activity. Expected to be called within the transaction that inserted it."""
+        self.status = pa.type
+        self.status_datetime = pa.datetime
+        self.last_activity = pa
+        if pa.type == ParcelActivity.ActivityType.DEPOSIT and pa.associated_locker_activity:
+            self.current_locker_unit_id = pa.associated_locker_activity.locker_unit_id
+            LockerUnit.objects.filter(pk=self.current_locker_unit_id).update(
+                occupying_parcel=self, occupied_since=pa.datetime, deposit_count=F("deposit_count") + 1, reserved_for=None, reserved_until=None
+            )
+        elif pa.type in Parcel.COMPLETE_STATUSES:
+            self.current_locker_unit_id = None
+            LockerUnit.objects.filter(occupying_parcel=self).update(occupying_parcel=None, occupied_since=None)
+        Parcel.objects.filter(pk=self.pk).update(
+            status=self.status,
+            status_datetime=self.status_datetime,
+            last_activity=pa,
+            current_locker_unit_id=self.current_locker_unit_id
+        )
 
     @staticmethod
-    def verify_retrieval_code(qr_data: str) -> bool:
-        prefix, pa_id, ts = qr_data.lower().split("_", 3)
+    def verify_retrieval_code(qr_data: str, scanned_at: float = None):
+        """
+        Returns the parcel if the retrieval code is signed with a key of its destination locker, hasn't expired and the parcel is still in the unit it names.
+        None if the code is malformed or the parcel doesn't exist, False otherwise. scanned_at lets a locker base report a code it accepted while offline,
+        and is only taken for the time the code was checked at when it lies within MAX_OFFLINE_SKEW before now. Otherwise the code is checked against now.
+        """
         try:
-            pa = ParcelActivity.objects.get(pk=pa_id)
+            prefix, parcel_id, unit_id, expiry, signature = qr_data.lower().split("_")
+            parcel_id, unit_id, expiry = int(parcel_id), int(unit_id), int(expiry)
+        except ValueError:
+            return None
+        if prefix != "withdraw":
+            return None
+        try:
+            parcel = Parcel.objects.select_related("destination_locker").get(pk=parcel_id)
         except ObjectDoesNotExist:
             return None
-        tx = datetime.utcnow()
-        tx1 = datetime.utcfromtimestamp(int(ts))
-        duration = (tx - tx1).total_seconds() // 60
-        # check if the duration has been too long since the generation of the qr code
-        if prefix == "withdraw" and pa is not None and duration < 15:
-            return pa.parcel
-        else:
+        now = timezone.now().timestamp()
+        checked_at = scanned_at if scanned_at is not None and now - Parcel.MAX_OFFLINE_SKEW <= scanned_at <= now else now
+        if expiry < checked_at:
             return False
+        if not any(hmac.compare_digest(Parcel.sign_retrieval_code(key, parcel_id, unit_id, expiry), signature) for key in parcel.destination_locker.retrieval_keys()):
+            return False
+        if not parcel.can_be_withdrawn() or parcel.current_locker_unit_id != unit_id:
+            return False
+        return parcel
 
     def add_activity(self, *, locker_base: LockerBase, activity_type: int, locker_unit: LockerUnit = None):
-        if locker_base == self.destination_locker:
-            try:
-                if activity_type == ParcelActivity.ActivityType.QUERY:
-                    # query is associated with scanqrparcel
-                    la = locker_base.add_activity(activity_type=LockerActivity.ActivityType.SCANQRPARCEL, locker_unit=None)
-
-                elif activity_type == ParcelActivity.ActivityType.CHECKIN:
-                    # query is associated with scanqrparcel
-                    la = locker_base.add_activity(activity_type=LockerActivity.ActivityType.SCANDIM, locker_unit=None)
-
-                elif activity_type == ParcelActivity.ActivityType.DEPOSITREQ:
-                    # depositreq is when the locker unit unlocks
-                    la = locker_base.add_activity(activity_type=LockerActivity.ActivityType.UNLOCK, locker_unit=locker_unit)
-
-                elif activity_type == ParcelActivity.ActivityType.DEPOSIT:
-                    # deposit is when the locker unit locks
-                    la = locker_base.add_activity(activity_type=LockerActivity.ActivityType.LOCK, locker_unit=locker_unit)
-
-                elif activity_type == ParcelActivity.ActivityType.WITHDRAWREQ:
-                    # when the qr is verified and the unit is unlocked
-                    la = locker_base.add_activity(activity_type=LockerActivity.ActivityType.UNLOCK, locker_unit=locker_unit)
-
-                elif activity_type == ParcelActivity.ActivityType.WITHDRAW:
-                    # when the locker unit is locked
-                    la = locker_base.add_activity(activity_type=LockerActivity.ActivityType.LOCK, locker_unit=locker_unit)
-
-                elif activity_type == ParcelActivity.ActivityType.WITHDRAWQR:
-                    # when the user scans the qr code with the scanner
-                    la = locker_base.add_activity(activity_type=LockerActivity.ActivityType.SCANQRRECIPIENT, locker_unit=None)
-
-                if la:
-                    la.save()
-
-                # if there is a locker activity involved, create object based on the locker activity
-                pa = ParcelActivity(parcel=self, type=activity_type)
-                pa.associated_locker_activity = la if la else None
-                pa.save()
-                return pa
-            except:
+        if locker_base is not None and locker_base.pk == self.destination_locker_id:
+            if activity_type not in ParcelActivity.LOCKER_ACTIVITY_TYPES:
                 return False
+            la_type, involves_unit = ParcelActivity.LOCKER_ACTIVITY_TYPES[activity_type]
+            la = LockerActivity(locker_base=locker_base, locker_unit=locker_unit if involves_unit else None, type=la_type)
+            return self.record_activity(activity_type=activity_type, locker_activity=la)
         else:
             if activity_type == ParcelActivity.ActivityType.WITHDRAWAPP:
                 # when the user presses on the withdraw button
-                pa = ParcelActivity(parcel=self, type=activity_type, associated_locker_activity=None)
-                pa.save()
+                return self.record_activity(activity_type=activity_type)
+            return False
+
+    def record_activity(self, *, activity_type: int, locker_activity: LockerActivity = None):
+        """
+        Records a parcel activity, along with the locker activity behind it, in a single transaction.
+        The parcel row is locked first, so that concurrent scans of the same parcel from locker bases are applied one after another.
+        Activities that can't follow the latest one are turned down before anything is written: against the status the parcel was read with,
+        without a query, and once more against the status read under the lock in case another request has moved the parcel on since.
+        """
+        if not self.can_transition_to(activity_type):
+            logging.warning(f"Parcel {self.id} can't go from {self.get_status_str()} to {ParcelActivity.ActivityType(activity_type).label}.")
+            return False
+        try:
+            with transaction.atomic():
+                status = Parcel.objects.select_for_update().filter(pk=self.pk).values_list("status", flat=True).get()
+                if status != self.status:
+                    self.status = status
+                    if not self.can_transition_to(activity_type):
+                        logging.warning(f"Parcel {self.id} has moved on to {self.get_status_str()}, can't go to {ParcelActivity.ActivityType(activity_type).label}.")
+                        return False
+                pa = ParcelActivity(parcel=self, type=activity_type)
+                if locker_activity is None:
+                    pa.save()
+                else:
+                    pa.save_with_locker_activity(locker_activity)
                 return pa
+        except DatabaseError as e:
+            logging.error(e)
             return False
 
     def __str__(self):
@@ -293,9 +646,7 @@ class Parcel(models.Model):
 
     def get_deposited_unit(self):
         # where is this parcel?
-        pa = ParcelActivity.objects.filter(parcel=self, type=ParcelActivity.ActivityType.DEPOSIT).latest("datetime")
-        if pa:
-            return pa.associated_locker_activity.locker_unit
+        return self.current_locker_unit
 
 
 class ParcelActivity(models.Model):
@@ -319,20 +670,9 @@ class ParcelActivity(models.Model):
 
     """
 
-    class ActivityType(models.IntegerChoices):
+    ActivityType = ParcelActivityType
 
-        REGISTER = 1, "REGISTER"  # when the parcel is registered into the system
-        QUERY = 2, "QUERY"  # associated with SCANQRPARCEL
-        CHECKIN = 3, "CHECKIN"  # associated with SCANDIM
-        DEPOSITREQ = 4, "DEPOSITREQ"  # associated with UNLOCK
-        DEPOSIT = 5, "DEPOSIT"  # associated with LOCK
-        WITHDRAWAPP = 6, "WITHDRAWAPP"  # added when user clicks on the option to generate qr code, only type that uses qr_data
-        WITHDRAWQR = 7, "WITHDRAWQR"  # associated with SCANQRRECIPIENT
-        WITHDRAWREQ = 8, "WITHDRAWREQ"  # associated with UNLOCK
-        WITHDRAW = 9, "WITHDRAW"  # associated with LOCK
-        CANCEL = 10, "CANCEL"  # a label that shows the parcel as not being able to arrive, tracking number is *not* released
-
-    parcel = models.ForeignKey(Parcel, on_delete=models.CASCADE)
+    parcel = models.ForeignKey(Parcel, on_delete=models.CASCADE, db_index=False)
     type = models.PositiveSmallIntegerField(choices=ActivityType.choices, null=False)
     datetime = models.DateTimeField(auto_now_add=True)
     # image = models.ImageField() # still hesitating about adding this one, it doesn't actually add real value, just ease of tracing back to troubleshoot. maybe in future versions.
@@ -341,8 +681,317 @@ class ParcelActivity(models.Model):
 
     associated_locker_activity = models.ForeignKey(LockerActivity, null=True, on_delete=models.CASCADE)
 
+    # the locker activity recorded alongside each parcel activity reported by a locker base, and whether it involves a locker unit.
+    LOCKER_ACTIVITY_TYPES = {
+        ActivityType.QUERY: (LockerActivity.ActivityType.SCANQRPARCEL, False),
+        ActivityType.CHECKIN: (LockerActivity.ActivityType.SCANDIM, False),
+        ActivityType.DEPOSITREQ: (LockerActivity.ActivityType.UNLOCK, True),  # depositreq is when the locker unit unlocks
+        ActivityType.DEPOSIT: (LockerActivity.ActivityType.LOCK, True),  # deposit is when the locker unit locks
+        ActivityType.WITHDRAWQR: (LockerActivity.ActivityType.SCANQRRECIPIENT, False),  # when the user scans the qr code with the scanner
+        ActivityType.WITHDRAWREQ: (LockerActivity.ActivityType.UNLOCK, True),  # when the qr is verified and the unit is unlocked
+        ActivityType.WITHDRAW: (LockerActivity.ActivityType.LOCK, True),  # when the locker unit is locked
+    }
+    # the lifecycle of a parcel: the activities that may follow the latest one, None being a parcel without any. WITHDRAW and CANCEL end it.
+    # repeated scans are fine, a base may retry when it didn't get an answer.
+    TRANSITIONS = {
+        None: {ActivityType.REGISTER},
+        ActivityType.REGISTER: {ActivityType.QUERY, ActivityType.CANCEL},
+        ActivityType.QUERY: {ActivityType.QUERY, ActivityType.CHECKIN, ActivityType.CANCEL},
+        # the courier scans the parcel again when it didn't fit the unit it was measured for.
+        ActivityType.CHECKIN: {ActivityType.QUERY, ActivityType.CHECKIN, ActivityType.DEPOSITREQ, ActivityType.CANCEL},
+        ActivityType.DEPOSITREQ: {ActivityType.DEPOSITREQ, ActivityType.DEPOSIT, ActivityType.CANCEL},
+        # straight to WITHDRAWQR when the recipient kept a code from earlier, or the base checked the code while it was offline.
+        ActivityType.DEPOSIT: {ActivityType.WITHDRAWAPP, ActivityType.WITHDRAWQR, ActivityType.CANCEL},
+        ActivityType.WITHDRAWAPP: {ActivityType.WITHDRAWAPP, ActivityType.WITHDRAWQR, ActivityType.CANCEL},
+        ActivityType.WITHDRAWQR: {ActivityType.WITHDRAWAPP, ActivityType.WITHDRAWQR, ActivityType.WITHDRAWREQ, ActivityType.CANCEL},
+        ActivityType.WITHDRAWREQ: {ActivityType.WITHDRAWREQ, ActivityType.WITHDRAW, ActivityType.CANCEL},
+        ActivityType.WITHDRAW: set(),
+        ActivityType.CANCEL: set(),
+    }
+    # the parcel sits in its locker unit and a retrieval code opens it.
+    WITHDRAWABLE_STATUSES = {ActivityType.DEPOSIT, ActivityType.WITHDRAWAPP, ActivityType.WITHDRAWQR, ActivityType.WITHDRAWREQ}
+
+    class Meta:
+        # read as "latest by parcel", "latest by type for parcel" and "global latest", the composite indexes cover the parcel foreign key as well.
+        indexes = [
+            models.Index(fields=["parcel", "-datetime"], name="pa_parcel_datetime_idx"),
+            models.Index(fields=["parcel", "type", "-datetime"], name="pa_parcel_type_datetime_idx"),
+            models.Index(fields=["-datetime"], name="pa_datetime_idx"),
+        ]
+
     def get_type_str(self):
         return self.ActivityType(self.type).label
 
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        with transaction.atomic(using=kwargs.get("using"), savepoint=False):
+            super().save(*args, **kwargs)
+            if is_new:
+                self.parcel.apply_activity(self)
+
+    def save_with_locker_activity(self, la: LockerActivity):
+        """Inserts a new parcel activity together with its associated locker activity. On PostgreSQL both rows are written by a single statement."""
+        using = router.db_for_write(ParcelActivity, instance=self)
+        connection = connections[using]
+        if connection.vendor != "postgresql":
+            with transaction.atomic(using=using, savepoint=False):
+                la.save(using=using)
+                self.associated_locker_activity = la
+                self.save(using=using)
+            return
+
+        la_table, pa_table = connection.ops.quote_name(LockerActivity._meta.db_table), connection.ops.quote_name(ParcelActivity._meta.db_table)
+        la.datetime = self.datetime = timezone.now()
+        with transaction.atomic(using=using, savepoint=False):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"WITH la AS (INSERT INTO {la_table} (locker_base_id, locker_unit_id, type, datetime) VALUES (%s, %s, %s, %s) RETURNING id) "
+                    f"INSERT INTO {pa_table} (parcel_id, type, datetime, associated_locker_activity_id) SELECT %s, %s, %s, la.id FROM la "
+                    f"RETURNING id, associated_locker_activity_id",
+                    [la.locker_base_id, la.locker_unit_id, la.type, la.datetime, self.parcel_id, self.type, self.datetime]
+                )
+                self.pk, la.pk = cursor.fetchone()
+            for obj in (la, self):
+                obj._state.adding = False
+                obj._state.db = using
+            self.associated_locker_activity = la
+            self.parcel.apply_activity(self)
+
     def __str__(self):
         return str(self.id)
+
+
+class ActivityArchive(models.Model):
+    """
+    Activity history moved out of the hot activity tables, stored as zlib-compressed JSON. Should include the following:
+        - the full history of a parcel that has been withdrawn or cancelled, along with the locker activities associated with it
+        - a month of the activities of a locker base that aren't associated with any parcel (online, register, change of verification code...)
+
+    month is the first day of the month the archived activities ended in. Archives are only ever added or dropped a whole month at a time, so the table can be partitioned on it.
+    """
+    parcel = models.ForeignKey(Parcel, null=True, on_delete=models.CASCADE, related_name="+")
+    locker_base = models.ForeignKey(LockerBase, null=True, on_delete=models.CASCADE, related_name="+", db_index=False)
+    month = models.DateField()
+    activity_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["locker_base", "month"], name="archive_base_month_idx"),
+            models.Index(fields=["month"], name="archive_month_idx"),
+        ]
+
+    def __repr__(self) -> str:
+        return f"ActivityArchive(id={self.id}, parcel={self.parcel_id}, locker_base={self.locker_base_id}, month={self.month}, activity_count={self.activity_count})"
+
+    @staticmethod
+    def pack(records: list) -> bytes:
+        return zlib.compress(json.dumps(records, separators=(",", ":")).encode("utf-8"))
+
+    def unpack(self) -> list:
+        return json.loads(zlib.decompress(self.data))
+
+    @staticmethod
+    def locker_activity_record(la: LockerActivity) -> dict:
+        return {"id": la.id, "locker_base": la.locker_base_id, "locker_unit": la.locker_unit_id, "type": la.type, "datetime": la.datetime.isoformat()}
+
+    @staticmethod
+    def to_locker_activity(record: dict) -> LockerActivity:
+        return LockerActivity(
+            id=record["id"], locker_base_id=record["locker_base"], locker_unit_id=record["locker_unit"], type=record["type"], datetime=datetime.fromisoformat(record["datetime"])
+        )
+
+    def parcel_activities(self) -> list:
+        """Rebuilds the archived parcel activities as unsaved ParcelActivity objects, so that they can be shown like the ones that are still in the activity log."""
+        pa_list = []
+        for record in self.unpack():
+            pa = ParcelActivity(id=record["id"], parcel_id=self.parcel_id, type=record["type"], datetime=datetime.fromisoformat(record["datetime"]))
+            if record["locker_activity"]:
+                pa.associated_locker_activity = ActivityArchive.to_locker_activity(record["locker_activity"])
+            pa_list.append(pa)
+        bases = LockerBase.objects.in_bulk({pa.associated_locker_activity.locker_base_id for pa in pa_list if pa.associated_locker_activity})
+        for pa in pa_list:
+            if pa.associated_locker_activity:
+                pa.associated_locker_activity.locker_base = bases.get(pa.associated_locker_activity.locker_base_id)
+        return pa_list
+
+    @staticmethod
+    def archive_parcels(parcel_ids: list) -> int:
+        """Moves the activities of the supplied (completed) parcels into the archive, one archive row per parcel. Returns the number of parcel activities moved."""
+        with transaction.atomic():
+            pa_list = list(ParcelActivity.objects.filter(parcel__in=parcel_ids).select_related("associated_locker_activity").order_by("parcel", "datetime"))
+            histories = {}
+            for pa in pa_list:
+                la = pa.associated_locker_activity
+                histories.setdefault(pa.parcel_id, []).append({
+                    "id": pa.id,
+                    "type": pa.type,
+                    "datetime": pa.datetime.isoformat(),
+                    "locker_activity": ActivityArchive.locker_activity_record(la) if la else None
+                })
+            ActivityArchive.objects.bulk_create(
+                ActivityArchive(
+                    parcel_id=parcel_id,
+                    month=datetime.fromisoformat(records[-1]["datetime"]).date().replace(day=1),
+                    activity_count=len(records),
+                    data=ActivityArchive.pack(records)
+                )
+                for parcel_id, records in histories.items()
+            )
+            # parcel activities go along with their locker activities.
+            LockerActivity.objects.filter(pk__in=[pa.associated_locker_activity_id for pa in pa_list if pa.associated_locker_activity_id]).delete()
+            ParcelActivity.objects.filter(pk__in=[pa.pk for pa in pa_list]).delete()
+            return len(pa_list)
+
+    @staticmethod
+    def archive_locker_activities(la_ids: list) -> int:
+        """Moves locker activities that aren't associated with a parcel into the archive, one archive row per locker base and month."""
+        with transaction.atomic():
+            la_list = list(LockerActivity.objects.filter(pk__in=la_ids).order_by("datetime"))
+            months = {}
+            for la in la_list:
+                months.setdefault((la.locker_base_id, la.datetime.date().replace(day=1)), []).append(ActivityArchive.locker_activity_record(la))
+            ActivityArchive.objects.bulk_create(
+                ActivityArchive(locker_base_id=locker_base_id, month=month, activity_count=len(records), data=ActivityArchive.pack(records))
+                for (locker_base_id, month), records in months.items()
+            )
+            LockerActivity.objects.filter(pk__in=[la.pk for la in la_list]).delete()
+            return len(la_list)
+
+
+class ActivityRollup(models.Model):
+    """
+    Operational counters of a locker base over an hour or a day, refreshed incrementally from the activity logs by ActivityRollup.refresh().
+    Dwell time is counted when a parcel is withdrawn. Occupied time is spread over every period the parcel spent in its unit, also once it is withdrawn.
+    """
+
+    class Period(models.TextChoices):
+        HOUR = "H", "Hour"
+        DAY = "D", "Day"
+
+    PERIOD_SECONDS = {Period.HOUR: 3600, Period.DAY: 86400}
+    SCAN_TYPES = (LockerActivity.ActivityType.SCANQRPARCEL, LockerActivity.ActivityType.SCANQRRECIPIENT, LockerActivity.ActivityType.SCANDIM)
+    LAG = timedelta(minutes=1)  # rows younger than this are left for the next refresh, in case a transaction with a lower id hasn't committed yet.
+
+    locker_base = models.ForeignKey(LockerBase, on_delete=models.CASCADE, db_index=False)
+    period = models.CharField(choices=Period.choices, max_length=1)
+    period_start = models.DateTimeField()
+    deposits = models.PositiveIntegerField(default=0)
+    withdrawals = models.PositiveIntegerField(default=0)
+    scans = models.PositiveIntegerField(default=0)
+    dwell_seconds = models.FloatField(default=0)  # total time the parcels withdrawn in the period spent in their units
+    occupied_seconds = models.FloatField(default=0)  # total unit-seconds of the period that units were occupied
+    unit_count = models.PositiveIntegerField(default=0)  # units registered with the base when the period was last refreshed
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["locker_base", "period", "period_start"], name="rollup_base_period_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["period", "-period_start"], name="rollup_period_start_idx"),
+        ]
+
+    def __repr__(self) -> str:
+        return f"ActivityRollup(locker_base={self.locker_base_id}, period={self.period}, period_start={self.period_start}, deposits={self.deposits}, withdrawals={self.withdrawals}, scans={self.scans})"
+
+    @property
+    def average_dwell_hours(self):
+        return self.dwell_seconds / self.withdrawals / 3600 if self.withdrawals else None
+
+    @property
+    def utilization(self):
+        capacity = self.unit_count * ActivityRollup.PERIOD_SECONDS[self.period]
+        return min(self.occupied_seconds / capacity, 1.0) if capacity else None
+
+    @staticmethod
+    def period_starts(dt):
+        """The start of the hour and of the day (in the local timezone) that the datetime falls in."""
+        local = timezone.localtime(dt)
+        hour = local.replace(minute=0, second=0, microsecond=0)
+        return {ActivityRollup.Period.HOUR: hour, ActivityRollup.Period.DAY: hour.replace(hour=0)}
+
+    @staticmethod
+    def spread(start, end):
+        """Splits the interval into (period, period start, seconds) pieces for every hour and day it overlaps."""
+        for period, length in ((ActivityRollup.Period.HOUR, timedelta(hours=1)), (ActivityRollup.Period.DAY, timedelta(days=1))):
+            bucket = ActivityRollup.period_starts(start)[period]
+            while bucket < end:
+                next_bucket = timezone.localtime(bucket + length)
+                if period == ActivityRollup.Period.DAY:
+                    next_bucket = ActivityRollup.period_starts(next_bucket)[period]
+                yield period, bucket, (min(end, next_bucket) - max(start, bucket)).total_seconds()
+                bucket = next_bucket
+
+    @staticmethod
+    def refresh(batch_size: int = 5000) -> int:
+        """Folds activities above the watermarks into the rollups, one batch per transaction. Returns the number of activities processed."""
+        processed = 0
+        while True:
+            with transaction.atomic():
+                count = ActivityRollup._refresh_batch(batch_size)
+            processed += count
+            if count < batch_size:
+                return processed
+
+    @staticmethod
+    def _refresh_batch(batch_size: int) -> int:
+        horizon = timezone.now() - ActivityRollup.LAG
+        pa_mark, _ = RollupWatermark.objects.select_for_update().get_or_create(name="parcel_activity")
+        la_mark, _ = RollupWatermark.objects.select_for_update().get_or_create(name="locker_activity")
+        deltas = {}
+
+        def add(locker_base_id, period, period_start, **counts):
+            deltas.setdefault((locker_base_id, period, period_start), Counter()).update(counts)
+
+        pa_list = list(
+            ParcelActivity.objects.filter(
+                id__gt=pa_mark.last_id, type__in=(ParcelActivity.ActivityType.DEPOSIT, ParcelActivity.ActivityType.WITHDRAW)
+            ).select_related("associated_locker_activity").order_by("id")[:batch_size]
+        )
+        pa_list = pa_list[:next((i for i, pa in enumerate(pa_list) if pa.datetime >= horizon), len(pa_list))]
+        if pa_list:
+            pa_mark.last_id = pa_list[-1].id
+        pa_count = len(pa_list)
+        pa_list = [pa for pa in pa_list if pa.associated_locker_activity]
+        withdrawn = [pa for pa in pa_list if pa.type == ParcelActivity.ActivityType.WITHDRAW]
+        deposited_at = dict(
+            ParcelActivity.objects.filter(parcel__in=[pa.parcel_id for pa in withdrawn], type=ParcelActivity.ActivityType.DEPOSIT)
+            .values("parcel").annotate(latest=models.Max("datetime")).values_list("parcel", "latest")
+        )
+        for pa in pa_list:
+            locker_base_id = pa.associated_locker_activity.locker_base_id
+            for period, period_start in ActivityRollup.period_starts(pa.datetime).items():
+                if pa.type == ParcelActivity.ActivityType.DEPOSIT:
+                    add(locker_base_id, period, period_start, deposits=1)
+                else:
+                    dwell = (pa.datetime - deposited_at[pa.parcel_id]).total_seconds() if pa.parcel_id in deposited_at else 0
+                    add(locker_base_id, period, period_start, withdrawals=1, dwell_seconds=dwell)
+            if pa.type == ParcelActivity.ActivityType.WITHDRAW and pa.parcel_id in deposited_at:
+                for period, period_start, seconds in ActivityRollup.spread(deposited_at[pa.parcel_id], pa.datetime):
+                    add(locker_base_id, period, period_start, occupied_seconds=seconds)
+
+        la_list = list(LockerActivity.objects.filter(id__gt=la_mark.last_id).order_by("id").values("id", "locker_base", "type", "datetime")[:batch_size])
+        la_list = la_list[:next((i for i, la in enumerate(la_list) if la["datetime"] >= horizon), len(la_list))]
+        for la in la_list:
+            if la["type"] in ActivityRollup.SCAN_TYPES:
+                for period, period_start in ActivityRollup.period_starts(la["datetime"]).items():
+                    add(la["locker_base"], period, period_start, scans=1)
+        if la_list:
+            la_mark.last_id = la_list[-1]["id"]
+
+        unit_counts = dict(LockerUnit.objects.filter(locker_base__in={key[0] for key in deltas}).values("locker_base").annotate(n=Count("id")).values_list("locker_base", "n"))
+        for (locker_base_id, period, period_start), counts in deltas.items():
+            rollup, _ = ActivityRollup.objects.select_for_update().get_or_create(locker_base_id=locker_base_id, period=period, period_start=period_start)
+            for field, value in counts.items():
+                setattr(rollup, field, F(field) + value)
+            rollup.unit_count = unit_counts.get(locker_base_id, 0)
+            rollup.save()
+        pa_mark.save()
+        la_mark.save()
+        return max(pa_count, len(la_list))
+
+
+class RollupWatermark(models.Model):
+    """The id of the last activity of each activity log that has been folded into the rollups."""
+    name = models.CharField(primary_key=True, max_length=32)
+    last_id = models.BigIntegerField(default=0)
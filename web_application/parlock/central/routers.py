@@ -0,0 +1,107 @@
+"""
+Sends the reads of read-only views to a replica of the database, when settings.DATABASES has one under the replica alias.
+Only views marked with @replica_read are served from it. Everything else reads from the primary, the locker API in particular,
+which has to see the activities it has just recorded.
+A client that has written something reads from the primary for REPLICA_PIN_SECONDS afterwards, so that it doesn't miss its own writes while the replica catches up.
+"""
+from contextvars import ContextVar
+from django.conf import settings
+import asyncio
+import time
+
+PRIMARY = "default"
+REPLICA = "replica"
+PIN_COOKIE = "parlock_primary_until"
+
+
+class RoutingState:
+    """Where the reads of the current request go."""
+
+    def __init__(self, pinned: bool):
+        self.pinned = pinned  # the client wrote a moment ago
+        self.replica = False  # the view may read from the replica
+        self.wrote = False  # the request has written, later reads go to the primary
+
+
+_state = ContextVar("parlock_routing_state", default=None)
+
+
+def replica_read(view):
+    """Marks a view that only reads, so that it can be served from the replica. Goes above the other decorators of the view."""
+    view.replica_read = True
+    return view
+
+
+def use_replica() -> bool:
+    state = _state.get()
+    return state is not None and state.replica and not state.wrote and not state.pinned
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return REPLICA if use_replica() and REPLICA in settings.DATABASES else PRIMARY
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica gets its tables through replication.
+        return db != REPLICA
+
+
+class ReplicaMiddleware:
+    """Keeps the RoutingState of each request, and pins the client to the primary after it has written. Goes before the session middleware, whose writes count too."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django that __call__ returns a coroutine, like MiddlewareMixin does.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        state = RoutingState(ReplicaMiddleware.is_pinned(request))
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return ReplicaMiddleware.pin(response, state)
+
+    async def __acall__(self, request):
+        state = RoutingState(ReplicaMiddleware.is_pinned(request))
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return ReplicaMiddleware.pin(response, state)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _state.get()
+        if state is not None and getattr(view_func, "replica_read", False):
+            state.replica = True
+
+    @staticmethod
+    def is_pinned(request) -> bool:
+        try:
+            return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    @staticmethod
+    def pin(response, state: RoutingState):
+        if state.wrote and REPLICA in settings.DATABASES:
+            seconds = settings.REPLICA_PIN_SECONDS
+            response.set_cookie(PIN_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True, samesite="Lax")
+        return response
@@ -0,0 +1,47 @@
+"""
+Database objects behind locker search that are specific to PostgreSQL.
+Migrations aren't kept in this repository, so these are created after every migrate instead.
+"""
+from django.db import connections
+import logging
+
+SEARCH_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS lockerbase_search_idx ON central_lockerbase USING gin (search_vector)",
+]
+TRIGRAM_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS lockerbase_name_trgm_idx ON central_lockerbase USING gin (name gin_trgm_ops)",
+]
+
+_trigram_available = {}
+
+
+def has_trigram(using: str = "default") -> bool:
+    """Is the pg_trgm extension installed on the database? Checked once per process."""
+    if using not in _trigram_available:
+        connection = connections[using]
+        if connection.vendor != "postgresql":
+            _trigram_available[using] = False
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+                _trigram_available[using] = cursor.fetchone() is not None
+    return _trigram_available[using]
+
+
+def install_search_indexes(sender, using="default", **kwargs):
+    """post_migrate handler. Creates the GIN indexes used by LockerBase.search() and fills in search vectors that are missing."""
+    from .models import LockerBase
+
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is not None:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        else:
+            logging.warning("pg_trgm is not available, locker search will not match by trigram similarity.")
+        _trigram_available.pop(using, None)
+        for statement in SEARCH_INDEXES + (TRIGRAM_INDEXES if has_trigram(using) else []):
+            cursor.execute(statement)
+    LockerBase.objects.using(using).filter(search_vector__isnull=True).update(search_vector=LockerBase.SEARCH_VECTOR)
@@ -0,0 +1,18 @@
+"""
+Makes SQLite behave under concurrent writers, for running the project on the SQLite branch of settings.py.
+select_for_update() is a no-op on SQLite, so a transaction that reads before it writes only asks for the write lock at its first write.
+When two of them do that at once, SQLite fails one right away with "database is locked" instead of waiting for the timeout.
+Taking the write lock when the transaction begins makes them wait their turn.
+"""
+
+
+def begin_immediate(execute, sql, params, many, context):
+    if sql == "BEGIN":
+        sql = "BEGIN IMMEDIATE"
+    return execute(sql, params, many, context)
+
+
+def install_begin_immediate(sender, connection, **kwargs):
+    """connection_created handler, see CentralConfig.ready()."""
+    if connection.vendor == "sqlite" and begin_immediate not in connection.execute_wrappers:
+        connection.execute_wrappers.append(begin_immediate)
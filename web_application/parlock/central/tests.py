@@ -1,3 +1,819 @@
-from django.test import TestCase
+import asyncio
+import json
+from contextlib import contextmanager
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, models
+from django.conf import settings
+from django.http import JsonResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, modify_settings, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from unittest import skipUnless
+from api import views as api_views
+from simulator import clear_fleet, run_fleet, seed_fleet
+from simulator.server import local_server
+from . import geo
+from .metrics import Histogram, registry
+from .routers import PIN_COOKIE, ReplicaMiddleware, ReplicaRouter, replica_read, use_replica
+from .models import ActivityArchive, ActivityRollup, LockerActivity, LockerBase, LockerUnit, Parcel, ParcelActivity, User
 
-# Create your tests here.
+
+def derived_availability(locker_unit):
+    """The availability of a locker unit as derived from the activity logs, which is what the occupancy projection replaces."""
+    la = LockerActivity.objects.filter(locker_unit=locker_unit).latest("datetime")
+    if la.type != LockerActivity.ActivityType.LOCK:
+        return True
+    return la.associated_parcel_activity().type == ParcelActivity.ActivityType.WITHDRAW
+
+
+class ParlockFixtures:
+    def setUp(self):
+        cache.clear()
+        caches["local"].clear()
+        self.user = User.objects.create_user("recipient", "recipient@example.com", "password")
+        self.locker_base = LockerBase.objects.create(
+            name="Parlock @ Test", street_address="1 Jalan Test", city="Subang Jaya", state=LockerBase.State.SGR, zip_code="47500", verification_code="v" * 12
+        )
+        self.locker_units = [LockerUnit.objects.create(length=30, width=30, height=30, locker_base=self.locker_base) for i in range(3)]
+
+    def make_parcel(self, tracking_number):
+        parcel = Parcel.objects.create(recipient=self.user, destination_locker=self.locker_base, tracking_number=tracking_number)
+        ParcelActivity(parcel=parcel, type=ParcelActivity.ActivityType.REGISTER).save()
+        return parcel
+
+    def deposit(self, parcel, locker_unit):
+        for activity_type in (ParcelActivity.ActivityType.QUERY, ParcelActivity.ActivityType.CHECKIN):
+            parcel.add_activity(locker_base=self.locker_base, activity_type=activity_type)
+        for activity_type in (ParcelActivity.ActivityType.DEPOSITREQ, ParcelActivity.ActivityType.DEPOSIT):
+            parcel.add_activity(locker_base=self.locker_base, activity_type=activity_type, locker_unit=locker_unit)
+
+    def withdraw(self, parcel, locker_unit):
+        parcel.add_activity(locker_base=None, activity_type=ParcelActivity.ActivityType.WITHDRAWAPP)
+        parcel.add_activity(locker_base=self.locker_base, activity_type=ParcelActivity.ActivityType.WITHDRAWQR)
+        for activity_type in (ParcelActivity.ActivityType.WITHDRAWREQ, ParcelActivity.ActivityType.WITHDRAW):
+            parcel.add_activity(locker_base=self.locker_base, activity_type=activity_type, locker_unit=locker_unit)
+
+
+# a replica is a connection of its own, which can't see the rows of a test wrapped in a transaction. see ReplicaTestCase.
+@override_settings(DATABASE_ROUTERS=[])
+class ParlockTestCase(ParlockFixtures, TestCase):
+    pass
+
+
+class OccupancyTestCase(ParlockTestCase):
+    def assertProjectionMatches(self):
+        for lu in LockerUnit.objects.filter(pk__in=[lu.pk for lu in self.locker_units]):
+            if LockerActivity.objects.filter(locker_unit=lu).exists():
+                self.assertEqual(lu.is_available, derived_availability(lu), repr(lu))
+
+    def test_projection_matches_derived_availability(self):
+        # the projection deliberately keeps a unit occupied while it is unlocked for withdrawal, so compare after every complete deposit or withdrawal.
+        parcels = [self.make_parcel(f"PL{i:04d}") for i in range(6)]
+        for parcel, lu in zip(parcels[:3], self.locker_units):
+            self.deposit(parcel, lu)
+            self.assertProjectionMatches()
+        self.withdraw(parcels[1], self.locker_units[1])
+        self.assertProjectionMatches()
+        self.deposit(parcels[3], self.locker_units[1])
+        self.assertProjectionMatches()
+        for parcel, lu in ((parcels[0], self.locker_units[0]), (parcels[3], self.locker_units[1]), (parcels[2], self.locker_units[2])):
+            self.withdraw(parcel, lu)
+            self.assertProjectionMatches()
+        self.assertTrue(all(lu.is_available for lu in LockerUnit.objects.all()))
+
+    def test_bulk_availability(self):
+        parcel = self.make_parcel("PL0001")
+        self.deposit(parcel, self.locker_units[0])
+        with self.assertNumQueries(2):
+            resp = self.client.post(f"/api/locker/{self.locker_base.id}/units/availability/", {"verification_code": self.locker_base.verification_code})
+        units = {unit["id"]: unit["is_available"] for unit in resp.json()["units"]}
+        self.assertEqual(units, {lu.id: lu.id != self.locker_units[0].id for lu in self.locker_units})
+
+
+class LifecycleTestCase(ParlockTestCase):
+    def test_materialized_state_follows_activities(self):
+        parcel = self.make_parcel("PL0001")
+        lu = self.locker_units[0]
+        steps = [
+            (self.locker_base, ParcelActivity.ActivityType.QUERY, None, None),
+            (self.locker_base, ParcelActivity.ActivityType.CHECKIN, None, None),
+            (self.locker_base, ParcelActivity.ActivityType.DEPOSITREQ, lu, None),
+            (self.locker_base, ParcelActivity.ActivityType.DEPOSIT, lu, lu.id),
+            (None, ParcelActivity.ActivityType.WITHDRAWAPP, None, lu.id),
+            (self.locker_base, ParcelActivity.ActivityType.WITHDRAWQR, None, lu.id),
+            (self.locker_base, ParcelActivity.ActivityType.WITHDRAWREQ, lu, lu.id),
+            (self.locker_base, ParcelActivity.ActivityType.WITHDRAW, lu, None),
+        ]
+        for locker_base, activity_type, locker_unit, current_unit_id in steps:
+            self.assertTrue(parcel.add_activity(locker_base=locker_base, activity_type=activity_type, locker_unit=locker_unit))
+            stored = Parcel.objects.get(pk=parcel.pk)
+            latest = stored.last_seen_activity()
+            self.assertEqual((stored.status, stored.status_datetime, stored.last_activity_id), (latest.type, latest.datetime, latest.id))
+            self.assertEqual(stored.status, activity_type)
+            self.assertEqual(stored.current_locker_unit_id, current_unit_id)
+            self.assertEqual((parcel.status, parcel.current_locker_unit_id), (stored.status, stored.current_locker_unit_id))
+        self.assertTrue(Parcel.objects.get(pk=parcel.pk).is_complete())
+
+    def test_table_covers_every_status(self):
+        self.assertEqual(set(ParcelActivity.TRANSITIONS) - {None}, set(ParcelActivity.ActivityType))
+        for allowed in ParcelActivity.TRANSITIONS.values():
+            self.assertLessEqual(allowed, set(ParcelActivity.ActivityType))
+        terminal = {status for status, allowed in ParcelActivity.TRANSITIONS.items() if not allowed}
+        self.assertEqual(terminal, set(Parcel.COMPLETE_STATUSES))
+
+    def test_illegal_transition_writes_nothing(self):
+        parcel = self.make_parcel("PL0001")
+        activities = ParcelActivity.objects.count(), LockerActivity.objects.count()
+        with self.assertNumQueries(0):
+            self.assertFalse(parcel.add_activity(locker_base=self.locker_base, activity_type=ParcelActivity.ActivityType.DEPOSIT, locker_unit=self.locker_units[0]))
+            self.assertFalse(parcel.add_activity(locker_base=self.locker_base, activity_type=ParcelActivity.ActivityType.WITHDRAWQR))
+        self.assertEqual((ParcelActivity.objects.count(), LockerActivity.objects.count()), activities)
+        resp = self.client.post(
+            f"/api/locker/{self.locker_base.id}/deposit/",
+            {"verification_code": self.locker_base.verification_code, "tracking_number": "PL0001", "unit_id": self.locker_units[0].id, "complete": "True"}
+        )
+        self.assertFalse(resp.json()["success"])
+        self.assertTrue(self.locker_units[0].is_available)
+
+    def test_rechecked_under_lock(self):
+        parcel = self.make_parcel("PL0001")
+        self.deposit(parcel, self.locker_units[0])
+        stale = Parcel.objects.get(pk=parcel.pk)
+        self.withdraw(parcel, self.locker_units[0])
+        # the stale copy still reads DEPOSIT, which WITHDRAWQR may follow.
+        self.assertTrue(stale.can_transition_to(ParcelActivity.ActivityType.WITHDRAWQR))
+        self.assertFalse(stale.add_activity(locker_base=self.locker_base, activity_type=ParcelActivity.ActivityType.WITHDRAWQR))
+        self.assertEqual(stale.status, ParcelActivity.ActivityType.WITHDRAW)
+        self.assertTrue(stale.is_complete())
+        self.assertFalse(stale.can_be_withdrawn())
+        self.assertEqual(ParcelActivity.objects.filter(parcel=parcel, type=ParcelActivity.ActivityType.WITHDRAWQR).count(), 1)
+
+
+class AuthCacheTestCase(ParlockTestCase):
+    def post_online(self, verification_code):
+        return self.client.post(f"/api/locker/{self.locker_base.id}/online/", {"verification_code": verification_code})
+
+    def test_cached_identity(self):
+        self.assertEqual(self.post_online(self.locker_base.verification_code).status_code, 200)
+        # only the ONLINE activity is written, authentication is served from the cache.
+        with self.assertNumQueries(1):
+            self.assertEqual(self.post_online(self.locker_base.verification_code).status_code, 200)
+        # a code that doesn't match the cache may be newer than it, so it is checked against the database.
+        with self.assertNumQueries(1):
+            self.assertEqual(self.post_online("x" * 12).status_code, 400)
+
+    def test_change_v_code_invalidates(self):
+        old_v_code = self.locker_base.verification_code
+        self.assertEqual(self.post_online(old_v_code).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.locker_base.change_v_code()
+        self.assertEqual(self.post_online(old_v_code).status_code, 400)
+        self.assertEqual(self.post_online(self.locker_base.verification_code).status_code, 200)
+
+    def test_code_changed_by_another_process(self):
+        key = LockerBase.auth_cache_key(self.locker_base.id)
+        old_v_code = self.locker_base.verification_code
+        self.assertEqual(LockerBase.authenticate(self.locker_base.id, old_v_code), self.locker_base)
+        # another process changes the code, which leaves the caches of this one as they were.
+        new_v_code = "n" * 12
+        LockerBase.objects.filter(pk=self.locker_base.pk).update(verification_code=new_v_code)
+        self.assertEqual(caches["local"].get(key).verification_code, old_v_code)
+        self.assertEqual(self.post_online(new_v_code).status_code, 200)
+        self.assertEqual((caches["local"].get(key).verification_code, cache.get(key).verification_code), (new_v_code, new_v_code))
+        self.assertEqual(self.post_online(old_v_code).status_code, 400)
+
+
+class ParcelListTestCase(ParlockTestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        Parcel.objects.bulk_create(
+            # pairs of parcels share a status timestamp, so that the id has to break the tie.
+            Parcel(recipient=self.user, destination_locker=self.locker_base, tracking_number=f"PL{i:04d}", status=9 if i % 3 else 5, status_datetime=now - timedelta(minutes=i // 2))
+            for i in range(90)
+        )
+        self.client.force_login(self.user)
+
+    def test_feed_pages_through_everything(self):
+        for status, expected in (("in_progress", self.user.in_progress_parcels()), ("completed", self.user.completed_parcels())):
+            ids, after = [], ""
+            while after is not None:
+                with self.assertNumQueries(3):  # session, user, page
+                    resp = self.client.get("/parcel/feed/", {"status": status, "after": after, "limit": 7}).json()
+                ids += [p["id"] for p in resp["parcels"]]
+                after = resp["next"]
+            self.assertEqual(ids, list(expected.order_by("-status_datetime", "-id").values_list("id", flat=True)))
+        self.assertEqual(self.client.get("/parcel/feed/", {"after": "x"}).status_code, 400)
+
+    def test_list_page(self):
+        with self.assertNumQueries(4):  # session, user, one page per tab
+            resp = self.client.get("/parcel/")
+        self.assertEqual(len(resp.context["completed"]), 20)
+        resp = self.client.get("/parcel/", {"completed_after": resp.context["completed_next"]})
+        self.assertEqual(resp.context["active"], "completed")
+        self.assertEqual(resp.context["completed"][0], self.user.completed_parcels().order_by("-status_datetime", "-id")[20])
+
+    def test_most_used_locker(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.most_used_locker(), self.locker_base)
+        self.assertContains(self.client.get("/lockers/"), "Most used")
+
+
+class ImportTestCase(ParlockTestCase):
+    def test_upload_csv(self):
+        self.make_parcel("PL0000")
+        rows = ["tracking_number,recipient,destination_locker"]
+        rows += [f"PL{i:04d},{'recipient' if i % 2 else 'recipient@example.com'},{self.locker_base.id}" for i in range(1, 6)]
+        rows += ["PL0000,recipient,Parlock @ Test", "PL0001,recipient,Parlock @ Test", "PL0100,nobody,Parlock @ Test", "PL0101,recipient,", "PL0102,recipient,Parlock @ Nowhere"]
+        User.objects.filter(pk=self.user.pk).update(is_admin=True)
+        self.client.force_login(self.user)
+        resp = self.client.post("/parcel/import/", {"manifest": SimpleUploadedFile("manifest.csv", "\n".join(rows).encode())})
+        result = resp.context["result"]
+        self.assertEqual((result.rows, result.created, result.error_count), (10, 5, 5))
+        self.assertEqual([line for line, message in result.errors], [7, 8, 9, 10, 11])
+        parcel = Parcel.objects.get(tracking_number="PL0003")
+        self.assertEqual((parcel.recipient, parcel.destination_locker, parcel.status), (self.user, self.locker_base, ParcelActivity.ActivityType.REGISTER))
+        self.assertEqual(parcel.last_activity, ParcelActivity.objects.get(parcel=parcel, type=ParcelActivity.ActivityType.REGISTER))
+
+    def test_command_jsonl_in_batches(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+            for i in range(45):
+                f.write(json.dumps({"tracking_number": f"PL{i:04d}", "recipient": "recipient", "destination_locker": "Parlock @ Test"}) + "\n")
+            f.write("{not json\n")
+        self.addCleanup(os.remove, f.name)
+        # every batch takes the same number of queries: tracking numbers, recipients, insert, read back ids, insert activities, link them, plus the savepoint.
+        with self.assertNumQueries(3 * 8 + 1):
+            call_command("import_parcels", f.name, batch_size=20, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Parcel.objects.filter(status=ParcelActivity.ActivityType.REGISTER).count(), 45)
+        self.assertEqual(ParcelActivity.objects.count(), 45)
+
+
+class QueryBudgetMixin:
+    @contextmanager
+    def assertQueryBudget(self, budget: int):
+        """Fails if a request made within the block runs more than budget queries. Counted by the metrics middleware, like in production."""
+        with registry.capture() as samples:
+            yield samples
+        self.assertTrue(samples, "No request was measured.")
+        for sample in samples:
+            self.assertLessEqual(sample.queries, budget, f"{sample.view} ran {sample.queries} queries, over its budget of {budget}.")
+
+
+class QueryBudgetTestCase(QueryBudgetMixin, ParlockTestCase):
+    """The budgets hold however many parcels and activities there are, so the views are checked against a few dozen of each."""
+    # (method, path, params, budget), the path is formatted with the fixtures.
+    CENTRAL_BUDGETS = [
+        ("get", "/", {}, 5),
+        ("get", "/dashboard/", {}, 3),
+        ("get", "/parcel/", {}, 4),
+        ("get", "/parcel/feed/", {"status": "completed"}, 3),
+        ("get", "/parcel/{parcel.id}", {}, 6),
+        ("get", "/lockers/", {}, 6),
+        ("get", "/lockers/", {"lat": "3.07", "lon": "101.58"}, 6),
+        ("get", "/metrics/", {}, 2),
+    ]
+    # (method, path, params, budget, payload), taken in order so that PL0000 goes through the deposit of a parcel on the way.
+    # the payload holds what the response has to answer with, a value can be a function of the test case for what depends on the fixtures.
+    API_BUDGETS = [
+        ("post", "/api/locker/{locker_base.id}/online/", {}, 2, {"success": True, "retrieval_keys": lambda t: t.locker_base.retrieval_keys()}),
+        ("post", "/api/locker/{locker_base.id}/register/", {"unit_id": "{unit.id}"}, 4, {"success": True, "id": lambda t: t.locker_units[0].id, "is_available": True}),
+        ("post", "/api/locker/{locker_base.id}/units/availability/", {}, 2, {"success": True, "units": lambda t: [lu.availability() for lu in LockerUnit.objects.order_by("id")]}),
+        ("post", "/api/locker/{locker_base.id}/parcel/", {"tracking_number": "PL0000"}, 7, {"success": True}),
+        ("post", "/api/locker/{locker_base.id}/scandim/", {"tracking_number": "PL0000"}, 7, {"success": True}),
+        ("post", "/api/locker/{locker_base.id}/allocate/", {"tracking_number": "PL0000", "length": 10, "width": 10, "height": 10}, 6, {"success": True, "unit_id": lambda t: t.locker_units[0].id}),
+        ("post", "/api/locker/{locker_base.id}/deposit/", {"tracking_number": "PL0000", "unit_id": "{unit.id}", "complete": "False"}, 8, {"success": True}),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        User.objects.filter(pk=self.user.pk).update(is_admin=True)
+        self.client.force_login(self.user)
+        for i in range(30):
+            parcel = self.make_parcel(f"PL{i:04d}")
+            if i and i < 3:
+                self.deposit(parcel, self.locker_units[i])
+        self.parcel = Parcel.objects.get(tracking_number="PL0001")
+
+    def request(self, method, path, params):
+        fixtures = {"parcel": self.parcel, "locker_base": self.locker_base, "unit": self.locker_units[0]}
+        params = {k: str(v).format(**fixtures) for k, v in params.items()}
+        if method == "post":
+            params["verification_code"] = self.locker_base.verification_code
+        return getattr(self.client, method)(path.format(**fixtures), params)
+
+    def assertPayload(self, resp, payload):
+        """Fails unless the response answers with every key of the payload, encoded the way the views encode it."""
+        expected = json.loads(JsonResponse({k: v(self) if callable(v) else v for k, v in payload.items()}).content)
+        answered = resp.json()
+        self.assertEqual({k: answered.get(k) for k in expected}, expected)
+
+    def test_central_views(self):
+        for method, path, params, budget in self.CENTRAL_BUDGETS:
+            with self.subTest(path=path, params=params), self.assertQueryBudget(budget):
+                self.assertEqual(self.request(method, path, params).status_code, 200)
+
+    def test_api_views(self):
+        for method, path, params, budget, payload in self.API_BUDGETS:
+            with self.subTest(path=path), self.assertQueryBudget(budget):
+                resp = self.request(method, path, params)
+                self.assertEqual(resp.status_code, 200)
+                self.assertPayload(resp, payload)
+
+    def test_metrics_endpoint(self):
+        self.client.post("/metrics/")
+        self.client.get("/parcel/")
+        self.request("post", "/api/locker/{locker_base.id}/online/", {})
+        views = self.client.get("/metrics/").json()["views"]
+        self.assertEqual(views["parcel"]["queries"]["count"], 1)
+        self.assertLessEqual(views["parcel"]["queries"]["max"], 4)
+        self.assertIn("api.views.locker_add_activity", views)
+        self.client.force_login(User.objects.create_user("other", "other@example.com", "password"))
+        self.assertEqual(self.client.get("/metrics/").status_code, 403)
+
+
+class HistogramTestCase(SimpleTestCase):
+    def test_percentiles_within_precision(self):
+        rng = random.Random(0)
+        values = sorted(int(rng.lognormvariate(8, 2)) for i in range(10000))
+        h = Histogram()
+        for v in values:
+            h.record(v)
+        for p in (50, 90, 99, 99.9):
+            exact = values[round(p / 100 * len(values)) - 1]
+            self.assertAlmostEqual(h.percentile(p), exact, delta=exact / 64 + 1)
+        self.assertEqual((h.min, h.max, h.count), (values[0], values[-1], len(values)))
+
+
+class AllocationTestCase(ParlockTestCase):
+    def setUp(self):
+        super().setUp()
+        # the fixture units are 30 x 30 x 30, add a large and a flat one.
+        self.large = LockerUnit.objects.create(length=60, width=60, height=60, locker_base=self.locker_base)
+        self.flat = LockerUnit.objects.create(length=40, width=40, height=10, locker_base=self.locker_base)
+
+    def test_best_fit(self):
+        self.assertEqual(self.locker_base.allocate(30, 5, 5), self.flat)  # fits lying down, in the smallest unit
+        self.assertEqual(self.locker_base.allocate(20, 20, 20), self.locker_units[0])
+        self.assertEqual(self.locker_base.allocate(40, 20, 20), self.large)
+        self.assertIsNone(self.locker_base.allocate(60, 60, 60))
+
+    def test_wear_levelling(self):
+        LockerUnit.objects.filter(pk=self.locker_units[0].pk).update(deposit_count=5)
+        LockerUnit.objects.filter(pk=self.locker_units[1].pk).update(deposit_count=2)
+        self.assertEqual(self.locker_base.allocate(20, 20, 20), self.locker_units[2])
+        self.assertEqual(self.locker_base.allocate(20, 20, 20), self.locker_units[1])  # the first one is reserved
+        self.assertEqual(self.locker_base.allocate(20, 20, 20), self.locker_units[0])
+
+    def test_reservation(self):
+        parcel = self.make_parcel("PL0001")
+        for activity_type in (ParcelActivity.ActivityType.QUERY, ParcelActivity.ActivityType.CHECKIN):
+            parcel.add_activity(locker_base=self.locker_base, activity_type=activity_type)
+        resp = self.client.post(
+            f"/api/locker/{self.locker_base.id}/allocate/",
+            {"verification_code": self.locker_base.verification_code, "tracking_number": "PL0001", "length": 20, "width": 20, "height": 20}
+        ).json()
+        self.assertEqual(resp["unit_id"], self.locker_units[0].id)
+        # asking again for the same parcel gives the reservation back first.
+        self.assertEqual(self.locker_base.allocate(20, 20, 20, parcel=parcel), self.locker_units[0])
+        for activity_type in (ParcelActivity.ActivityType.DEPOSITREQ, ParcelActivity.ActivityType.DEPOSIT):
+            parcel.add_activity(locker_base=self.locker_base, activity_type=activity_type, locker_unit=self.locker_units[0])
+        lu = LockerUnit.objects.get(pk=self.locker_units[0].pk)
+        self.assertEqual((lu.reserved_for, lu.deposit_count), (None, 1))
+        self.assertEqual(self.locker_base.allocate(20, 20, 20), self.locker_units[1])
+        LockerUnit.objects.filter(pk=self.locker_units[1].pk).update(reserved_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.locker_base.allocate(20, 20, 20), self.locker_units[1])  # expired reservation
+
+    def test_invalid_dimensions(self):
+        self.make_parcel("PL0001")
+        for length in ("inf", "-inf", "nan", "-20", "0", "twenty"):
+            resp = self.client.post(
+                f"/api/locker/{self.locker_base.id}/allocate/",
+                {"verification_code": self.locker_base.verification_code, "tracking_number": "PL0001", "length": length, "width": 20, "height": 20}
+            )
+            self.assertEqual(resp.status_code, 400, length)
+        self.assertFalse(LockerUnit.objects.filter(reserved_for__isnull=False).exists())
+
+
+class RetrievalCodeTestCase(ParlockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.parcel = self.make_parcel("PL0001")
+        self.deposit(self.parcel, self.locker_units[0])
+        self.parcel.refresh_from_db()
+
+    def post_withdraw_qr(self, qr_data, **params):
+        return self.client.post(
+            f"/api/locker/{self.locker_base.id}/withdraw-qr/", {"verification_code": self.locker_base.verification_code, "qr_data": qr_data, **params}
+        ).json()
+
+    def test_signed_code(self):
+        code = self.parcel.make_retrieval_code()
+        prefix, parcel_id, unit_id, expiry, signature = code.split("_")
+        self.assertEqual((int(parcel_id), int(unit_id)), (self.parcel.id, self.locker_units[0].id))
+        self.assertEqual(Parcel.verify_retrieval_code(code), self.parcel)
+        self.assertFalse(Parcel.verify_retrieval_code(code[:-1] + ("0" if code[-1] != "0" else "1")))
+        self.assertFalse(Parcel.verify_retrieval_code(code.replace(f"_{unit_id}_", f"_{self.locker_units[1].id}_")))
+        self.assertIsNone(Parcel.verify_retrieval_code("withdraw_1_2"))
+        # an expired code is still accepted if the base reports that it was scanned in time.
+        expired = "_".join((prefix, parcel_id, unit_id, str(int(expiry) - 3600), Parcel.sign_retrieval_code(self.locker_base.retrieval_key, self.parcel.id, int(unit_id), int(expiry) - 3600)))
+        self.assertFalse(Parcel.verify_retrieval_code(expired))
+        self.assertEqual(Parcel.verify_retrieval_code(expired, scanned_at=int(expiry) - 4000), self.parcel)
+        self.assertEqual(self.post_withdraw_qr(code), {"success": True, "unit_id": self.locker_units[0].id})
+
+    def test_scanned_at_bounded(self):
+        now = int(timezone.now().timestamp())
+        expiry = now - 60
+        expired = f"withdraw_{self.parcel.id}_{self.locker_units[0].id}_{expiry}_{Parcel.sign_retrieval_code(self.locker_base.retrieval_key, self.parcel.id, self.locker_units[0].id, expiry)}"
+        self.assertEqual(Parcel.verify_retrieval_code(expired, scanned_at=expiry - 60), self.parcel)
+        # a scan that is older than any base stays offline for, or that hasn't happened yet, can't stretch the expiry.
+        for scanned_at in (0, now - Parcel.MAX_OFFLINE_SKEW - 60, now + 3600, float("nan"), float("-inf")):
+            self.assertFalse(Parcel.verify_retrieval_code(expired, scanned_at=scanned_at), scanned_at)
+        self.assertEqual(self.post_withdraw_qr(expired, scanned_at=0), {"success": False})
+        self.assertEqual(self.post_withdraw_qr(expired, scanned_at=now + 3600), {"success": False})
+
+    def test_rotation_keeps_outstanding_codes(self):
+        code = self.parcel.make_retrieval_code()
+        self.locker_base.refresh_from_db()
+        self.locker_base.change_v_code()
+        self.assertEqual(Parcel.verify_retrieval_code(code), self.parcel)
+        self.locker_base.change_v_code()
+        self.assertFalse(Parcel.verify_retrieval_code(code))
+        self.assertEqual(Parcel.verify_retrieval_code(Parcel.objects.get(pk=self.parcel.pk).make_retrieval_code()), self.parcel)
+
+    def test_used_code_rejected(self):
+        code = self.parcel.make_retrieval_code()
+        self.withdraw(self.parcel, self.locker_units[0])
+        self.assertFalse(Parcel.verify_retrieval_code(code))
+
+
+class AsyncApiTestCase(ParlockFixtures, TransactionTestCase):
+    # the async view records activities from another thread, which can't see the data of a test wrapped in a transaction.
+    def post(self, view, activity_type, data):
+        request = RequestFactory().post(f"/api/locker/{self.locker_base.id}/{activity_type}/", data)
+        if asyncio.iscoroutinefunction(view):
+            view = async_to_sync(view)
+        return view(request, self.locker_base.id, activity_type)
+
+    def test_matches_sync_view(self):
+        data = {"verification_code": self.locker_base.verification_code, "unit_id": self.locker_units[0].id}
+        responses = [self.post(view, "register", data) for view in (api_views.locker_add_activity, api_views.locker_add_activity_async)]
+        self.assertEqual(responses[0].content, responses[1].content)
+        self.assertTrue(json.loads(responses[1].content)["success"])
+        for view in (api_views.locker_add_activity, api_views.locker_add_activity_async):
+            self.assertEqual(self.post(view, "online", {"verification_code": "x" * 12}).status_code, 400)
+            self.assertEqual(self.post(view, "unknown", {"verification_code": self.locker_base.verification_code}).status_code, 404)
+        self.assertEqual(LockerActivity.objects.filter(type=LockerActivity.ActivityType.REGISTER).count(), 2)
+        self.assertEqual(async_to_sync(api_views.locker_add_activity_async)(RequestFactory().get("/"), self.locker_base.id, "online").status_code, 405)
+
+
+@modify_settings(ALLOWED_HOSTS={"append": "127.0.0.1"})
+class FleetSimulatorTestCase(TransactionTestCase):
+    # the virtual bases talk to a server thread, which can't see the data of a test wrapped in a transaction.
+    def test_every_parcel_goes_through(self):
+        # the in-memory SQLite test database locks whole tables between threads, without waiting for them, so the bases can't run at once there.
+        bases = 1 if connection.vendor == "sqlite" else 3
+        specs = seed_fleet(bases=bases, units=4, parcels=5)
+        with local_server() as url:
+            elapsed, stats = run_fleet(url, specs)
+        self.assertEqual(sum(s.errors for s in stats.values()), 0)
+        self.assertEqual(stats["online"].latency.count, bases)
+        self.assertEqual(stats["register"].latency.count, bases * 4)
+        withdrawn = Parcel.objects.filter(destination_locker__in=[spec.id for spec in specs], status=ParcelActivity.ActivityType.WITHDRAW).count()
+        self.assertEqual(withdrawn, bases * 5 - stats["allocate"].rejected)
+        self.assertEqual(stats["withdraw-true"].latency.count, withdrawn)
+        self.assertFalse(LockerUnit.objects.filter(locker_base__in=[spec.id for spec in specs], occupying_parcel__isnull=False).exists())
+        clear_fleet()
+        self.assertFalse(LockerBase.objects.filter(pk__in=[spec.id for spec in specs]).exists())
+
+
+class RoutingTestCase(SimpleTestCase):
+    @staticmethod
+    def serve(view, **cookies):
+        """Runs the view behind ReplicaMiddleware, calling process_view() like the request handler does."""
+        request = RequestFactory().get("/")
+        request.COOKIES.update(cookies)
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            return view(request)
+
+        middleware = ReplicaMiddleware(get_response)
+        return json.loads(middleware(request).content)
+
+    def test_only_marked_views_read_from_replica(self):
+        def read(request):
+            return JsonResponse({"replica": use_replica()})
+
+        def write_then_read(request):
+            before = use_replica()
+            self.assertEqual(ReplicaRouter().db_for_write(Parcel), "default")
+            return JsonResponse({"before": before, "after": use_replica()})
+
+        self.assertEqual(self.serve(read), {"replica": False})
+        self.assertEqual(self.serve(replica_read(read)), {"replica": True})
+        self.assertEqual(self.serve(replica_read(read), parlock_primary_until=str(time.time() + 60)), {"replica": False})
+        self.assertEqual(self.serve(replica_read(read), parlock_primary_until=str(time.time() - 1)), {"replica": True})
+        self.assertEqual(self.serve(replica_read(write_then_read)), {"before": True, "after": False})
+        self.assertFalse(use_replica())
+        self.assertFalse(getattr(api_views.locker_add_activity, "replica_read", False))
+
+
+@skipUnless("replica" in settings.DATABASES, "No replica is configured, see PARLOCK_REPLICA in settings.py.")
+class ReplicaTestCase(ParlockFixtures, TransactionTestCase):
+    databases = {"default", "replica"} if "replica" in settings.DATABASES else {"default"}  # the test runner sets up the databases of skipped tests as well
+
+    def queries(self, method, path, data=None):
+        """Sends the request and returns the number of queries it ran on the primary and on the replica."""
+        with CaptureQueriesContext(connections["default"]) as primary, CaptureQueriesContext(connections["replica"]) as replica:
+            self.assertLess(getattr(self.client, method)(path, data or {}).status_code, 400)
+        return len(primary), len(replica)
+
+    def test_reads_follow_writes(self):
+        parcel = self.make_parcel("PL0001")
+        self.deposit(parcel, self.locker_units[0])
+        self.client.force_login(self.user)
+        primary, replica = self.queries("get", "/parcel/")
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+        # the locker API never reads from the replica.
+        primary, replica = self.queries("post", f"/api/locker/{self.locker_base.id}/units/availability/", {"verification_code": self.locker_base.verification_code})
+        self.assertEqual(replica, 0)
+        # asking for a retrieval code writes, so the parcel list is read from the primary for a while after.
+        self.queries("get", f"/parcel/{parcel.id}/withdraw")
+        self.assertIn(PIN_COOKIE, self.client.cookies)
+        primary, replica = self.queries("get", "/parcel/")
+        self.assertEqual(replica, 0)
+        self.assertGreater(primary, 0)
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class ConcurrentActivityTestCase(ParlockFixtures, TransactionTestCase):
+    SCANS_PER_BASE = 10
+
+    def test_bases_racing_on_tracking_number(self):
+        parcel = self.make_parcel("PL0001")
+        other_base = LockerBase.objects.create(
+            name="Parlock @ Elsewhere", street_address="2 Jalan Test", city="Subang Jaya", state=LockerBase.State.SGR, zip_code="47500", verification_code="w" * 12
+        )
+        barrier = threading.Barrier(2 * self.SCANS_PER_BASE)
+        results = {self.locker_base.pk: [], other_base.pk: []}
+
+        def scan(locker_base):
+            try:
+                p = Parcel.objects.get(tracking_number="PL0001")
+                barrier.wait()
+                results[locker_base.pk].append(p.add_activity(locker_base=locker_base, activity_type=ParcelActivity.ActivityType.QUERY))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=scan, args=(lb,)) for lb in (self.locker_base, other_base) for i in range(self.SCANS_PER_BASE)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertTrue(all(isinstance(pa, ParcelActivity) for pa in results[self.locker_base.pk]))
+        self.assertFalse(any(results[other_base.pk]))
+        queries = ParcelActivity.objects.filter(parcel=parcel, type=ParcelActivity.ActivityType.QUERY)
+        self.assertEqual(queries.count(), self.SCANS_PER_BASE)
+        self.assertEqual(LockerActivity.objects.filter(type=LockerActivity.ActivityType.SCANQRPARCEL, locker_base=self.locker_base).count(), self.SCANS_PER_BASE)
+        self.assertFalse(LockerActivity.objects.filter(locker_base=other_base).exists())
+        self.assertFalse(queries.filter(associated_locker_activity__isnull=True).exists())
+        parcel.refresh_from_db()
+        self.assertEqual(parcel.last_activity, queries.latest("datetime"))
+
+
+@skipUnless(connection.vendor == "postgresql", "locker search uses PostgreSQL full text search")
+class LockerSearchTestCase(ParlockTestCase):
+    def setUp(self):
+        super().setUp()
+        for i, (name, street, city) in enumerate((("Parlock @ South City Plaza", "Persiaran Serdang Perdana", "Seri Kembangan"), ("Parlock @ Sunway Pyramid", "Jalan PJS 11/15", "Bandar Sunway"))):
+            LockerBase.objects.create(name=name, street_address=street, city=city, state=LockerBase.State.SGR, zip_code=f"4330{i}", verification_code=f"search{i:06d}")
+
+    def test_prefix_search(self):
+        self.assertEqual([lb.name for lb in LockerBase.search("sout")], ["Parlock @ South City Plaza"])
+        self.assertEqual([lb.name for lb in LockerBase.search("parlock sun")], ["Parlock @ Sunway Pyramid"])
+        self.assertEqual(len(LockerBase.search("parlock", limit=2)), 2)
+        self.assertFalse(LockerBase.search("!!"))
+
+    def test_typeahead(self):
+        results = self.client.get("/lockers/search/", {"q": "kemb", "limit": 5}).json()["results"]
+        self.assertEqual([r["name"] for r in results], ["Parlock @ South City Plaza"])
+
+    def test_typeahead_limit_is_clamped(self):
+        for limit, count in (("-1", 1), ("0", 1), ("2", 2), ("1000", 3)):
+            resp = self.client.get("/lockers/search/", {"q": "parlock", "limit": limit})
+            self.assertEqual((resp.status_code, len(resp.json()["results"])), (200, count), limit)
+
+    def test_search_uses_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET enable_seqscan = off")
+        self.assertIn("lockerbase_search_idx", LockerBase.search("sunway").explain())
+
+
+class NearestLockerTestCase(ParlockTestCase):
+    def test_index_matches_brute_force(self):
+        rng = random.Random(7)
+        points = [(i, rng.uniform(1.0, 7.0), rng.uniform(99.5, 119.0)) for i in range(500)]
+        index = geo.LockerIndex(points)
+        for i in range(20):
+            lat, lon = rng.uniform(1.0, 7.0), rng.uniform(99.5, 119.0)
+            target = geo.to_unit_vector(lat, lon)
+            brute = sorted(points, key=lambda p: sum((a - b) ** 2 for a, b in zip(geo.to_unit_vector(p[1], p[2]), target)))
+            self.assertEqual([_id for d, _id in index.nearest(lat, lon, k=5)], [p[0] for p in brute[:5]])
+
+    def test_nearest_with_free_capacity(self):
+        self.locker_base.latitude, self.locker_base.longitude = 3.0738, 101.5183
+        self.locker_base.save()
+        coordinates = (("Near", 3.0750, 101.5200), ("Middle", 3.1000, 101.5500), ("Far", 3.5000, 101.9000))
+        bases = {}
+        for i, (name, lat, lon) in enumerate(coordinates):
+            bases[name] = LockerBase.objects.create(
+                name=name, street_address="Jalan Test", city="Subang Jaya", state=LockerBase.State.SGR, zip_code="47500", verification_code=f"near{i:08d}", latitude=lat, longitude=lon
+            )
+            LockerUnit.objects.create(length=30, width=30, height=30, locker_base=bases[name])
+        self.assertEqual([lb.name for lb in self.locker_base.nearby(k=2)], ["Near", "Middle"])
+
+        parcel = Parcel.objects.create(recipient=self.user, destination_locker=bases["Near"], tracking_number="PL0001")
+        ParcelActivity(parcel=parcel, type=ParcelActivity.ActivityType.REGISTER).save()
+        for activity_type in (ParcelActivity.ActivityType.QUERY, ParcelActivity.ActivityType.CHECKIN, ParcelActivity.ActivityType.DEPOSITREQ, ParcelActivity.ActivityType.DEPOSIT):
+            parcel.add_activity(locker_base=bases["Near"], activity_type=activity_type, locker_unit=bases["Near"].locker_units.get())
+        nearest = LockerBase.nearest(3.0738, 101.5183, k=2)
+        self.assertEqual([lb.name for lb in nearest], [self.locker_base.name, "Middle"])
+        self.assertLess(nearest[0].distance, nearest[1].distance)
+
+    def test_invalid_coordinates(self):
+        self.assertEqual(self.client.get("/lockers/", {"lat": "3.07", "lon": "101.58"}).status_code, 200)
+        for lat, lon in (("nan", "101.58"), ("3.07", "inf"), ("-inf", "101.58"), ("91", "101.58"), ("3.07", "-181"), ("north", "101.58")):
+            self.assertEqual(self.client.get("/lockers/", {"lat": lat, "lon": lon}).status_code, 400, (lat, lon))
+
+
+class ArchiveTestCase(ParlockTestCase):
+    def test_archive_keeps_history(self):
+        parcels = [self.make_parcel(f"PL{i:04d}") for i in range(2)]
+        for parcel, lu in zip(parcels, self.locker_units):
+            self.deposit(parcel, lu)
+        self.withdraw(parcels[0], self.locker_units[0])
+        self.locker_base.add_activity(activity_type=LockerActivity.ActivityType.ONLINE)
+        history = [(pa.id, pa.type, pa.associated_locker_activity_id) for pa in parcels[0].activities()]
+        old = timezone.now() - timedelta(days=100)
+        ParcelActivity.objects.update(datetime=old)
+        LockerActivity.objects.update(datetime=old)
+        Parcel.objects.update(status_datetime=old)
+
+        call_command("archive_activities", days=90, stdout=StringIO())
+        self.assertEqual(ActivityArchive.objects.count(), 0)  # not rolled up yet
+        call_command("refresh_rollups", stdout=StringIO())
+        call_command("archive_activities", days=90, stdout=StringIO())
+        self.assertFalse(ParcelActivity.objects.filter(parcel=parcels[0]).exists())
+        self.assertTrue(ParcelActivity.objects.filter(parcel=parcels[1]).exists())  # still in a locker unit
+        self.assertEqual(LockerActivity.objects.filter(type=LockerActivity.ActivityType.ONLINE).count(), 0)
+        self.assertEqual(ActivityArchive.objects.filter(locker_base=self.locker_base).get().activity_count, 1)
+
+        parcels[0].refresh_from_db()
+        # the materialized state outlives the activity it points at.
+        self.assertEqual((parcels[0].status, parcels[0].status_datetime, parcels[0].last_activity_id), (ParcelActivity.ActivityType.WITHDRAW, old, None))
+        self.assertEqual((parcels[0].last_seen_activity().id, parcels[0].last_seen_activity().type), history[0][:2])
+        archived = parcels[0].activities()
+        self.assertEqual(sorted((pa.id, pa.type, pa.associated_locker_activity.id if pa.associated_locker_activity else None) for pa in archived), sorted(history))
+        self.client.force_login(self.user)
+        resp = self.client.get(f"/parcel/{parcels[0].id}")
+        self.assertContains(resp, self.locker_base.name)
+        # running again moves nothing.
+        call_command("archive_activities", days=90, stdout=StringIO())
+        self.assertEqual(ActivityArchive.objects.filter(parcel=parcels[0]).count(), 1)
+
+
+    def test_backfill_after_archive(self):
+        parcels = [self.make_parcel(f"PL{i:04d}") for i in range(2)]
+        for lu in self.locker_units:
+            self.locker_base.add_activity(activity_type=LockerActivity.ActivityType.REGISTER, locker_unit=lu)
+        for parcel, lu in zip(parcels, self.locker_units):
+            self.deposit(parcel, lu)
+        self.withdraw(parcels[0], self.locker_units[0])
+        old = timezone.now() - timedelta(days=100)
+        ParcelActivity.objects.update(datetime=old)
+        LockerActivity.objects.update(datetime=old)
+        Parcel.objects.update(status_datetime=old)
+        LockerUnit.objects.filter(occupying_parcel__isnull=False).update(occupied_since=old)
+        call_command("refresh_rollups", stdout=StringIO())
+        call_command("archive_activities", days=90, stdout=StringIO())
+        self.assertFalse(ParcelActivity.objects.filter(parcel=parcels[0]).exists())
+        self.assertFalse(LockerActivity.objects.filter(type=LockerActivity.ActivityType.REGISTER).exists())
+
+        def state():
+            return (
+                list(Parcel.objects.order_by("pk").values_list("status", "status_datetime", "current_locker_unit")),
+                list(LockerUnit.objects.order_by("pk").values_list("locker_base", "occupying_parcel", "occupied_since", "deposit_count"))
+            )
+
+        archived = state()
+        self.assertEqual([count for *_, count in archived[1]], [1, 1, 0])
+        call_command("backfill_parcel_state", stdout=StringIO())
+        self.assertEqual(state(), archived)
+        self.assertEqual(Parcel.objects.filter(recipient=self.user, status__in=Parcel.COMPLETE_STATUSES).count(), 1)
+
+
+class RollupTestCase(ParlockTestCase):
+    def test_refresh_is_incremental(self):
+        parcels = [self.make_parcel(f"PL{i:04d}") for i in range(2)]
+        for parcel, lu in zip(parcels, self.locker_units):
+            self.deposit(parcel, lu)
+        self.withdraw(parcels[0], self.locker_units[0])
+        start = timezone.localtime(timezone.now() - timedelta(days=1)).replace(hour=1, minute=0, second=0, microsecond=0)
+        ParcelActivity.objects.update(datetime=start + timedelta(minutes=30))
+        ParcelActivity.objects.filter(parcel=parcels[0], type=ParcelActivity.ActivityType.WITHDRAW).update(datetime=start + timedelta(hours=2))
+        LockerActivity.objects.update(datetime=start)
+
+        call_command("refresh_rollups", stdout=StringIO())
+        call_command("refresh_rollups", stdout=StringIO())  # nothing new, nothing counted twice
+        day = ActivityRollup.objects.get(period=ActivityRollup.Period.DAY)
+        self.assertEqual((day.deposits, day.withdrawals, day.scans), (2, 1, 5))
+        self.assertEqual(day.dwell_seconds, 90 * 60)
+        hours = ActivityRollup.objects.filter(period=ActivityRollup.Period.HOUR).order_by("period_start")
+        self.assertEqual([h.occupied_seconds for h in hours], [30 * 60, 60 * 60, 0])
+        self.assertEqual(hours[0].unit_count, 3)
+
+        # activities younger than the lag horizon wait for the next refresh.
+        self.withdraw(parcels[1], self.locker_units[1])
+        call_command("refresh_rollups", stdout=StringIO())
+        self.assertEqual(ActivityRollup.objects.filter(period=ActivityRollup.Period.DAY).aggregate(n=models.Sum("withdrawals"))["n"], 1)
+
+    def test_dashboard(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get("/dashboard/").status_code, 403)
+        User.objects.filter(pk=self.user.pk).update(is_admin=True)
+        with self.assertNumQueries(3):  # session, user, rollups
+            resp = self.client.get("/dashboard/?period=D")
+        self.assertContains(resp, "refresh_rollups")
+
+    def test_home_latest_activities(self):
+        User.objects.filter(pk=self.user.pk).update(is_admin=True)
+        self.client.force_login(self.user)
+        for i in range(3):
+            self.deposit(self.make_parcel(f"PL{i:04d}"), self.locker_units[i])
+        with self.assertNumQueries(5):  # session, user, latest parcel activities, latest locker activities and their parcel activities
+            self.client.get("/")
+
+
+class QueryPlanTestCase(ParlockTestCase):
+    """Asserts that the hot reads on the activity logs are answered from their composite indexes. Set PARLOCK_QUERY_PLAN_ROWS to seed a production-sized log."""
+    SEED_ROWS = int(os.environ.get("PARLOCK_QUERY_PLAN_ROWS", 10000))
+    BATCH_SIZE = 5000
+
+    def setUp(self):
+        super().setUp()
+        Parcel.objects.bulk_create(
+            Parcel(
+                recipient=self.user, destination_locker=self.locker_base, tracking_number=f"QP{i:08d}", status=i % 10 + 1, status_datetime=timezone.now() - timedelta(minutes=i)
+            ) for i in range(self.SEED_ROWS // 10)
+        )
+        self.parcels = list(Parcel.objects.filter(tracking_number__startswith="QP").order_by("id"))
+        LockerUnit.objects.bulk_create(LockerUnit(length=30, width=30, height=30, locker_base=self.locker_base) for i in range(self.SEED_ROWS // 100))
+        self.locker_units = list(LockerUnit.objects.order_by("id"))
+        for start in range(0, self.SEED_ROWS, self.BATCH_SIZE):
+            rows = range(start, min(start + self.BATCH_SIZE, self.SEED_ROWS))
+            las = LockerActivity.objects.bulk_create(
+                LockerActivity(locker_base=self.locker_base, locker_unit=self.locker_units[i % len(self.locker_units)], type=LockerActivity.ActivityType.LOCK) for i in rows
+            )
+            ParcelActivity.objects.bulk_create(
+                ParcelActivity(parcel=self.parcels[i % len(self.parcels)], type=i % 10 + 1) for i in rows
+            )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+            if connection.vendor == "postgresql":
+                # the planner is free to seq scan tables it believes are tiny, which would hide a missing index.
+                cursor.execute("SET enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, plan)
+
+    def test_parcel_activity_plans(self):
+        parcel = self.parcels[len(self.parcels) // 2]
+        self.assertUsesIndex(ParcelActivity.objects.filter(parcel=parcel).order_by("-datetime")[:1], "pa_parcel_datetime_idx")
+        self.assertUsesIndex(
+            ParcelActivity.objects.filter(parcel=parcel, type=ParcelActivity.ActivityType.DEPOSIT).order_by("-datetime")[:1], "pa_parcel_type_datetime_idx"
+        )
+        self.assertUsesIndex(ParcelActivity.objects.order_by("-datetime")[:10], "pa_datetime_idx")
+
+    def test_locker_activity_plans(self):
+        self.assertUsesIndex(LockerActivity.objects.filter(locker_unit=self.locker_units[0]).order_by("-datetime")[:1], "la_unit_datetime_idx")
+        self.assertUsesIndex(LockerActivity.objects.order_by("-datetime")[:10], "la_datetime_idx")
+
+    # SQLite only picks a partial index when the query repeats its condition with literals, and Django binds them as parameters.
+    @skipUnless(connection.vendor == "postgresql", "partial indexes are matched against query parameters by PostgreSQL only")
+    def test_parcel_list_plan(self):
+        cursor = self.parcels[len(self.parcels) // 2].keyset_cursor()
+        self.assertUsesIndex(Parcel.page_queryset(self.user.in_progress_parcels(), after=cursor)[:21], "parcel_recipient_open_idx")
+        self.assertUsesIndex(Parcel.page_queryset(self.user.completed_parcels(), after=cursor)[:21], "parcel_recipient_done_idx")
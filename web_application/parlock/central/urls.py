@@ -7,13 +7,18 @@ from . import views
 
 urlpatterns = [
     path("", views.home, name="home"),
+    path("dashboard/", views.dashboard, name="dashboard"),
+    path("metrics/", views.metrics, name="metrics"),
     path("register/", views.add_user_action, name="register"),
     path("login/", auth_views.LoginView.as_view(), name="login"),
     path("logout/", auth_views.LogoutView.as_view(), name="logout"),
     path("profile/", views.profile, name="profile"),
     path("lockers/", views.lockers, name="locker-view"),
+    path("lockers/search/", views.locker_search, name="locker-search"),
     path("parcel/", views.parcel, name="parcel"),
+    path("parcel/feed/", views.parcel_feed, name="parcel-feed"),
     path("parcel/<int:parcel_id>", views.parcel_details, name="parcel-detail"),
     path("parcel/<int:parcel_id>/withdraw", views.parcel_withdraw_application, name="parcel-withdraw"),
     path("parcel/register/", views.add_parcel_action, name="parcel-register"),
+    path("parcel/import/", views.parcel_import, name="parcel-import"),
 ]
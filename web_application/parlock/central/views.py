@@ -1,24 +1,62 @@
 from django import http
-from django.http.response import HttpResponse, HttpResponseForbidden, HttpResponseGone
-from django.core.exceptions import PermissionDenied
+from django.http.response import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseGone, JsonResponse
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.shortcuts import get_object_or_404, redirect, render
-from .models import LockerActivity, LockerBase, Parcel, ParcelActivity
-from .forms import ParcelForm, UserRegistrationForm
+from django.db.models import Prefetch
+from .models import ActivityRollup, LockerActivity, LockerBase, Parcel, ParcelActivity
+from .forms import ParcelForm, ParcelImportForm, UserRegistrationForm
+from .importer import format_of, import_parcels, read_rows
+from .metrics import registry
+from .routers import replica_read
 from datetime import datetime
-from django.contrib.postgres.search import SearchVector
+import math
 from django.contrib.auth.decorators import login_required
 # Create your views here.
 
 
 # home view
 
+@replica_read
 def home(request):
     context_dict = {}
     if request.user.is_authenticated and request.user.is_admin:
         context_dict["latest_pa"] = ParcelActivity.objects.order_by("-datetime")[:10]
-        context_dict["latest_la"] = LockerActivity.objects.order_by("-datetime")[:10]
+        context_dict["latest_la"] = (
+            LockerActivity.objects.select_related("locker_base")
+            .prefetch_related(Prefetch("parcelactivity_set", queryset=ParcelActivity.objects.only("id", "parcel_id", "associated_locker_activity_id")))
+            .order_by("-datetime")[:10]
+        )
     return render(request, "home.html", context=context_dict)
 
+
+# operations dashboard, only reads the precomputed rollups. see the refresh_rollups command.
+
+@replica_read
+def dashboard(request):
+    if not (request.user.is_authenticated and request.user.is_admin):
+        raise PermissionDenied
+    period = request.GET.get("period", ActivityRollup.Period.HOUR)
+    if period not in ActivityRollup.PERIOD_SECONDS:
+        period = ActivityRollup.Period.HOUR
+    rollups = list(ActivityRollup.objects.filter(period=period).select_related("locker_base").order_by("-period_start", "locker_base__name")[:200])
+    totals = {field: sum(getattr(r, field) for r in rollups) for field in ("deposits", "withdrawals", "scans")}
+    context_dict = {
+        "period": period,
+        "periods": ActivityRollup.Period.choices,
+        "rollups": rollups,
+        "totals": totals,
+    }
+    return render(request, "dashboard.html", context=context_dict)
+
+# request metrics of this process, see metrics.py. POST to start over.
+
+def metrics(request):
+    if not (request.user.is_authenticated and request.user.is_admin):
+        raise PermissionDenied
+    if request.method == "POST":
+        registry.reset()
+    return JsonResponse({"views": registry.snapshot()})
+
 # profile
 
 
@@ -28,22 +66,37 @@ def profile(request):
 # parcel info
 
 
+PARCEL_PAGE_SIZE = 20
+
+
+@replica_read
 @login_required(login_url="login")
 def parcel(request):
-    context_dict = {
-        "in_progress": [],
-        "completed": []
-    }
-    for parcel in request.user.parcels():
-        if parcel.is_complete():
-            context_dict["completed"].append(parcel)
-        else:
-            context_dict["in_progress"].append(parcel)
-
-    context_dict["parcel_dict"] = context_dict
+    # each tab is paged on its own, with ?in_progress_after=<cursor> and ?completed_after=<cursor>.
+    context_dict = {"active": "completed" if "completed_after" in request.GET else "in_progress"}
+    try:
+        for tab, parcels in (("in_progress", request.user.in_progress_parcels()), ("completed", request.user.completed_parcels())):
+            context_dict[tab], context_dict[f"{tab}_next"] = Parcel.page(parcels, after=request.GET.get(f"{tab}_after"), limit=PARCEL_PAGE_SIZE)
+            context_dict[f"{tab}_after"] = request.GET.get(f"{tab}_after", "")
+    except ValidationError:
+        return HttpResponseBadRequest()
     return render(request, "parcel/main.html", context=context_dict)
 
 
+@replica_read
+@login_required(login_url="login")
+def parcel_feed(request):
+    # JSON version of the parcel list: ?status=in_progress|completed&after=<cursor>&limit=<n>, follow "next" for the next page.
+    parcels = request.user.completed_parcels() if request.GET.get("status") == "completed" else request.user.in_progress_parcels()
+    try:
+        limit = min(max(int(request.GET.get("limit", PARCEL_PAGE_SIZE)), 1), 100)
+        page, next_cursor = Parcel.page(parcels, after=request.GET.get("after"), limit=limit)
+    except (ValueError, ValidationError):
+        return HttpResponseBadRequest()
+    return JsonResponse({"parcels": [p.to_dict() for p in page], "next": next_cursor})
+
+
+@replica_read
 @login_required(login_url="login")
 def parcel_details(request, parcel_id):
     context_dict = {}
@@ -74,6 +127,7 @@ def add_parcel_action(request):
         try:
             lb = LockerBase.objects.get(pk=request.GET["locker"])
             context_dict["form"] = ParcelForm({"destination_locker": lb})
+            context_dict["nearby"] = lb.nearby()
         except LockerBase.DoesNotExist:
             context_dict["form"] = ParcelForm()
     else:
@@ -81,6 +135,23 @@ def add_parcel_action(request):
     return render(request, "parcel/register.html", context=context_dict)
 
 
+@login_required(login_url="login")
+def parcel_import(request):
+    # bulk pre-registration of a carrier manifest, see importer.py. admins only.
+    if not request.user.is_admin:
+        raise PermissionDenied
+    context_dict = {}
+    if request.method == "POST":
+        f = ParcelImportForm(request.POST, request.FILES)
+        if f.is_valid():
+            manifest = f.cleaned_data["manifest"]
+            context_dict["result"] = import_parcels(read_rows(manifest.file, format_of(manifest.name)))
+        context_dict["form"] = f
+    else:
+        context_dict["form"] = ParcelImportForm()
+    return render(request, "parcel/import.html", context=context_dict)
+
+
 def add_user_action(request):
     context_dict = {}
     if request.method == "POST":
@@ -118,14 +189,43 @@ def parcel_withdraw_application(request, parcel_id):
             return HttpResponseGone()
 
 
+def coordinates(request):
+    """The latitude and longitude to look for lockers near. Raises ValueError unless both are finite and within range."""
+    latitude, longitude = float(request.GET["lat"]), float(request.GET["lon"])
+    if not (math.isfinite(latitude) and math.isfinite(longitude) and -90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError(f"Invalid coordinates {latitude}, {longitude}.")
+    return latitude, longitude
+
+
+@replica_read
 def lockers(request):
     context_dict = {}
     if request.user.is_authenticated:
-        most_used = [parcel.destination_locker for parcel in request.user.parcels()]
+        most_used = request.user.most_used_locker()
         if most_used:
-            context_dict["most_used"] = max(set(most_used), key=most_used.count)
+            context_dict["most_used"] = most_used
+            context_dict["nearby"] = most_used.nearby()
+    if "lat" in request.GET and "lon" in request.GET:
+        try:
+            latitude, longitude = coordinates(request)
+        except ValueError:
+            return HttpResponseBadRequest()
+        context_dict["nearest"] = LockerBase.nearest(latitude, longitude, k=5)
     if request.method == "POST":
         kw = request.POST.get("keyword", None)
         if kw:
-            context_dict["results"] = [lb for lb in LockerBase.objects.annotate(search=SearchVector("name", "street_address", "city", "state", "zip_code")).filter(search=kw)]
+            context_dict["results"] = LockerBase.search(kw)
     return render(request, "locker/main.html", context=context_dict)
+
+
+@replica_read
+def locker_search(request):
+    # typeahead for the locker search box.
+    try:
+        limit = min(max(int(request.GET.get("limit", 10)), 1), 50)
+    except ValueError:
+        limit = 10
+    results = LockerBase.search(request.GET.get("q", ""), limit=limit)
+    return JsonResponse({
+        "results": [{"id": lb.id, "name": lb.name, "address": lb.address, "rank": lb.rank} for lb in results]
+    })
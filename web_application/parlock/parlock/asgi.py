@@ -12,5 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'parlock.settings')
+os.environ.setdefault('PARLOCK_ASYNC_API', '1')
 
 application = get_asgi_application()
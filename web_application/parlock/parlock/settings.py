@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,9 +42,12 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 ]
 
 MIDDLEWARE = [
+    'central.metrics.MetricsMiddleware',  # first, so that the queries of the other middleware are counted too
+    'central.routers.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,19 +81,63 @@ WSGI_APPLICATION = 'parlock.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
-        'NAME': {database_name},
-        'USER': {username},
-        'PASSWORD': {password},
-        'HOST': {host_ip},
-        'PORT': {port_number},
+# PARLOCK_DB=sqlite runs the project on a local SQLite file instead, e.g. to try out the fleet simulator (manage.py simulate_fleet) offline.
+if os.environ.get('PARLOCK_DB') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            # wait for the write lock instead of failing right away when many locker bases write at once.
+            'OPTIONS': {'timeout': 30},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': {database_name},
+            'USER': {username},
+            'PASSWORD': {password},
+            'HOST': {host_ip},
+            'PORT': {port_number},
+        }
     }
-}
+
+# PARLOCK_REPLICA=<database name> adds a read replica of the default database, which the read-only views are served from. see central/routers.py.
+# It is looked for on the same server unless PARLOCK_REPLICA_HOST is set. With SQLite the name is the path of a second file, which nothing copies the data to.
+if os.environ.get('PARLOCK_REPLICA'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['PARLOCK_REPLICA'],
+        'HOST': os.environ.get('PARLOCK_REPLICA_HOST', DATABASES['default'].get('HOST', '')),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['central.routers.ReplicaRouter']
+REPLICA_PIN_SECONDS = 5  # how long a client that has written reads from the primary, longer than the replica usually lags behind
 
 AUTH_USER_MODEL = 'central.User'
 
+# Serve the locker API with its async views. Switched on by parlock/asgi.py, sync views are kept under WSGI where they're cheaper.
+ASYNC_API = os.environ.get('PARLOCK_ASYNC_API') == '1'
+
+
+# Caches
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# 'default' is shared between workers, point it at memcached or redis in production. 'local' lives in each process and only holds entries for a few seconds.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'parlock-shared',
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'parlock-local',
+        'TIMEOUT': 5,
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
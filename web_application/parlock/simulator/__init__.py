@@ -0,0 +1,7 @@
+"""
+Load simulator for the locker API. Virtual locker bases send the requests that LockerBase.contact_webserver() of locker_base/main.py sends for every parcel,
+concurrently, against a running server, and the latency of every request is recorded per activity type.
+Run it with `python manage.py simulate_fleet`, see central/management/commands/simulate_fleet.py.
+"""
+from .fleet import ActivityStats, VirtualBase, run_fleet
+from .seed import BaseSpec, clear_fleet, seed_fleet
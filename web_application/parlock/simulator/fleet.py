@@ -0,0 +1,131 @@
+"""
+Virtual locker bases, each sending the requests of a real one from a thread of its own.
+"""
+from collections import deque
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+import json
+import random
+import threading
+import time
+from central.metrics import Histogram
+from central.models import Parcel
+
+ACTIVITY_TYPES = ("online", "register", "parcel", "scandim", "allocate", "deposit-false", "deposit-true", "withdraw-qr", "withdraw-false", "withdraw-true")
+
+
+class ActivityStats:
+    """
+    Latencies in microseconds of one activity type across the fleet, with the number of requests the webserver turned down (success false, e.g. no unit free)
+    and of those that failed (an error status or no response).
+    """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rejected = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float, body):
+        self.latency.record(seconds * 1e6)
+        if body is None or body.get("success") is False:
+            with self.lock:
+                if body is None:
+                    self.errors += 1
+                else:
+                    self.rejected += 1
+
+
+class VirtualBase:
+    """
+    Plays a locker base through the main loop of locker_base/main.py: it reports itself online, registers its units,
+    then takes in its parcels one after another (parcel, scandim, allocate, deposit false, deposit true).
+    The recipients collect them (withdraw-qr, withdraw false, withdraw true) once half of the units are occupied, and at the end.
+    """
+
+    def __init__(self, url: str, spec, stats: dict, seed: int = 0):
+        self.url = url
+        self.spec = spec
+        self.stats = stats
+        self.rng = random.Random(seed * 100003 + spec.id)
+        self.retrieval_keys = []
+
+    def post(self, activity_type: str, params: dict = {}, label: str = None):
+        """Sends a request like LockerBase.contact_webserver() does, and returns the JSON response or None when the webserver refused it."""
+        data = urlencode({"verification_code": self.spec.verification_code, **params}).encode()
+        sent = time.perf_counter()
+        try:
+            with urlopen(f"{self.url}/api/locker/{self.spec.id}/{activity_type}/", data=data, timeout=60) as resp:
+                body = json.loads(resp.read())
+        except (HTTPError, URLError, OSError, ValueError):
+            body = None
+        self.stats[label or activity_type].record(time.perf_counter() - sent, body)
+        return body if body and body.get("success", True) else None
+
+    def run(self):
+        resp = self.post("online")
+        if resp is None:
+            return
+        self.retrieval_keys = resp.get("retrieval_keys", [])
+        for unit_id in self.spec.unit_ids:
+            self.post("register", {"unit_id": unit_id})
+        deposited = deque()
+        for parcel_id, tracking_number in self.spec.parcels:
+            unit_id = self.deposit(tracking_number)
+            if unit_id is not None:
+                deposited.append((parcel_id, unit_id))
+            while len(deposited) > len(self.spec.unit_ids) // 2:
+                self.withdraw(*deposited.popleft())
+        while deposited:
+            self.withdraw(*deposited.popleft())
+
+    def deposit(self, tracking_number: str):
+        if self.post("parcel", {"tracking_number": tracking_number}) is None:
+            return None
+        self.post("scandim", {"tracking_number": tracking_number})
+        length, width, height = self.parcel_size()
+        resp = self.post("allocate", {"tracking_number": tracking_number, "length": length, "width": width, "height": height})
+        if resp is None:
+            return None
+        unit_id = resp["unit_id"]
+        self.post("deposit", {"tracking_number": tracking_number, "unit_id": unit_id, "complete": "False"}, label="deposit-false")
+        if self.post("deposit", {"tracking_number": tracking_number, "unit_id": unit_id, "complete": "True"}, label="deposit-true") is None:
+            return None
+        return unit_id
+
+    def withdraw(self, parcel_id: int, unit_id: int):
+        # the code the recipient would have been shown by the webserver, see Parcel.make_retrieval_code().
+        expiry = int(time.time()) + Parcel.RETRIEVAL_CODE_TTL
+        qr_data = f"withdraw_{parcel_id}_{unit_id}_{expiry}_{Parcel.sign_retrieval_code(self.retrieval_keys[0], parcel_id, unit_id, expiry)}"
+        if self.post("withdraw-qr", {"qr_data": qr_data}) is None:
+            return
+        self.post("withdraw", {"qr_data": qr_data, "unit_id": unit_id, "complete": "False"}, label="withdraw-false")
+        self.post("withdraw", {"qr_data": qr_data, "unit_id": unit_id, "complete": "True"}, label="withdraw-true")
+
+    def parcel_size(self):
+        """Courier parcels in mm, mostly small boxes and envelopes with a long tail of large boxes."""
+        length = min(self.rng.lognormvariate(5.5, 0.4), 500)
+        width = length * self.rng.uniform(0.5, 0.9)
+        height = min(width * self.rng.uniform(0.1, 0.8), 500)
+        return round(length, 1), round(width, 1), round(height, 1)
+
+
+def run_fleet(url: str, specs: list, seed: int = 0):
+    """Runs a virtual locker base for each spec at once. Returns the elapsed seconds and the ActivityStats of every activity type."""
+    stats = {activity_type: ActivityStats() for activity_type in ACTIVITY_TYPES}
+    bases = [VirtualBase(url, spec, stats, seed=seed) for spec in specs]
+    start = threading.Barrier(len(bases) + 1)
+
+    def simulate(base):
+        start.wait()
+        base.run()
+
+    threads = [threading.Thread(target=simulate, args=(base,)) for base in bases]
+    for t in threads:
+        t.start()
+    start.wait()
+    began = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - began, stats
@@ -0,0 +1,74 @@
+"""
+Seeds the locker bases, locker units and registered parcels that the virtual locker bases work through, straight into the database the server uses.
+"""
+import random
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from central.models import LockerBase, LockerUnit, Parcel, ParcelActivity, User
+
+BASE_NAME = "Parlock @ Fleet {}"
+RECIPIENT = "fleet_recipient"
+# (length, width, height) of the locker units in mm and their share of the units of a base.
+UNIT_TYPES = (
+    ((450, 350, 120), 0.40),
+    ((450, 350, 250), 0.30),
+    ((450, 350, 400), 0.20),
+    ((600, 450, 600), 0.10),
+)
+
+
+class BaseSpec:
+    """What a virtual locker base needs to know about the locker base it plays."""
+
+    def __init__(self, locker_base: LockerBase, unit_ids: list, parcels: list):
+        self.id = locker_base.id
+        self.verification_code = locker_base.verification_code
+        self.unit_ids = unit_ids
+        self.parcels = parcels  # (parcel id, tracking number) in the order they arrive
+
+    def __repr__(self):
+        return f"BaseSpec(id={self.id}, units={len(self.unit_ids)}, parcels={len(self.parcels)})"
+
+
+def seed_fleet(bases: int, units: int, parcels: int, seed: int = 0) -> list:
+    """Creates the locker bases with their units and parcels registered for them, and returns a BaseSpec of each. Bases left over by an earlier run are replaced."""
+    rng = random.Random(seed)
+    clear_fleet()
+    with transaction.atomic():
+        recipient = User.objects.create_user(RECIPIENT, f"{RECIPIENT}@example.com")
+        specs = []
+        now = timezone.now()
+        for i in range(bases):
+            lb = LockerBase.objects.create(
+                name=BASE_NAME.format(i), street_address=f"{i} Jalan Simulasi", city="Subang Jaya", state=LockerBase.State.SGR, zip_code="47500",
+                verification_code=f"fleet{i:07d}"
+            )
+            dims = rng.choices([d for d, share in UNIT_TYPES], weights=[share for d, share in UNIT_TYPES], k=units)
+            unit_ids = []
+            for length, width, height in dims:
+                lu = LockerUnit(length=length, width=width, height=height, locker_base=lb)
+                lu.save()  # derives the volume and size class, which bulk_create() would skip
+                unit_ids.append(lu.id)
+            created = Parcel.objects.bulk_create(
+                Parcel(recipient=recipient, destination_locker=lb, tracking_number=f"FL{i:05d}{j:06d}", status=ParcelActivity.ActivityType.REGISTER, status_datetime=now)
+                for j in range(parcels)
+            )
+            if not all(p.pk for p in created):
+                # only PostgreSQL returns the ids of bulk inserted rows.
+                created = list(Parcel.objects.filter(destination_locker=lb).order_by("tracking_number"))
+            ParcelActivity.objects.bulk_create(ParcelActivity(parcel=p, type=ParcelActivity.ActivityType.REGISTER) for p in created)
+            Parcel.objects.filter(destination_locker=lb).update(
+                last_activity=Subquery(ParcelActivity.objects.filter(parcel=OuterRef("pk")).values("pk")[:1])
+            )
+            specs.append(BaseSpec(lb, unit_ids, [(p.id, p.tracking_number) for p in created]))
+    return specs
+
+
+def clear_fleet():
+    """Deletes the seeded locker bases along with everything recorded for them."""
+    with transaction.atomic():
+        lbs = LockerBase.objects.filter(name__startswith=BASE_NAME.format(""))
+        LockerUnit.objects.filter(locker_base__in=lbs).delete()
+        lbs.delete()
+        User.objects.filter(username=RECIPIENT).delete()
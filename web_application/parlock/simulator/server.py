@@ -0,0 +1,30 @@
+"""
+A threaded development server run in the simulator's own process, for when no server is given.
+"""
+from contextlib import contextmanager
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+import threading
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class FleetServer(ThreadedWSGIServer):
+    request_queue_size = 1024  # the default of 10 turns a fleet of bases connecting at once away
+
+
+@contextmanager
+def local_server(host: str = "127.0.0.1"):
+    """Serves the project on a free port of the host within the block, and yields its URL."""
+    server = FleetServer((host, 0), QuietRequestHandler, allow_reuse_address=False)
+    server.set_app(WSGIHandler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://{host}:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()